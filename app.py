@@ -1,7 +1,15 @@
 # app.py
 
+from imageforge import startup
+
+startup.begin_page(__file__)  # 初回表示の時間に import も含めるため、最初に呼ぶ
+
+import os
+
 import streamlit as st
-from PIL import Image
+
+from imageforge import artifacts, cache, ingest, scheduler
+from imageforge.preview import CARD_WIDTH, cached_display_image
 
 # --- ページ設定 (変更なし) ---
 st.set_page_config(
@@ -28,6 +36,19 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
+
+def sample_image(path, lossless=False):
+    """カード用に縮小・圧縮したサンプル画像 (ファイルと更新時刻ごとにキャッシュ)"""
+    key = f"{path}:{os.stat(path).st_mtime_ns}"
+
+    def load():
+        # カードの幅で足りるので、JPEG なら縮小してデコードする
+        with open(path, "rb") as f:
+            return ingest.decode(f.read(), max_size=CARD_WIDTH)[0]
+
+    return cached_display_image(key, load, CARD_WIDTH, lossless)
+
+
 # --- メインページコンテンツ ---
 st.title("🖼️ 画像加工ツールボックス")
 st.markdown("---")
@@ -55,7 +76,7 @@ with col1:
             unsafe_allow_html=True,
         )
         try:
-            image = Image.open("assets/sample.png")
+            image = sample_image("assets/sample.png")
             st.image(image, caption="この画像を元に加工しています。")
         except FileNotFoundError:
             st.warning("サンプル画像(assets/sample.png)が見つかりません。")
@@ -77,7 +98,7 @@ with col2:
             unsafe_allow_html=True,
         )
         try:
-            image = Image.open("assets/pixelart_sample.png")
+            image = sample_image("assets/pixelart_sample.png", lossless=True)
             st.image(image, caption="レトロなドット絵に変換。")
         except FileNotFoundError:
             st.warning("サンプル画像(assets/pixelart_sample.png)が見つかりません。")
@@ -98,7 +119,7 @@ with col3:
             unsafe_allow_html=True,
         )
         try:
-            image = Image.open("assets/removed_bg_sample.png")
+            image = sample_image("assets/removed_bg_sample.png")
             st.image(image, caption="背景をきれいに除去。")
         except FileNotFoundError:
             st.warning("サンプル画像(assets/removed_bg_sample.png)が見つかりません。")
@@ -119,7 +140,7 @@ with col4:
             unsafe_allow_html=True,
         )
         try:
-            image = Image.open("assets/fixed_sample.png")
+            image = sample_image("assets/fixed_sample.png")
             st.image(image, caption="自然な風合いに調整。")
         except FileNotFoundError:
             st.warning("サンプル画像(assets/fixed_sample.png)が見つかりません。")
@@ -133,6 +154,77 @@ with col4:
         )
 
 st.markdown("---")
+with st.expander("🗄️ 処理結果キャッシュの統計"):
+    cache_stats = cache.get_cache().stats()
+    lookups = (
+        cache_stats["memory_hits"] + cache_stats["disk_hits"] + cache_stats["misses"]
+    )
+    hit_rate = (lookups - cache_stats["misses"]) / lookups if lookups else 0.0
+    st.write(
+        f"**ヒット**: メモリ {cache_stats['memory_hits']} / ディスク {cache_stats['disk_hits']}"
+        f" / **ミス**: {cache_stats['misses']} (ヒット率 {hit_rate:.0%})"
+    )
+    st.write(
+        f"**メモリ**: {cache_stats['entries']}件, {cache_stats['bytes'] / 1024 / 1024:.1f}MB"
+        f" / {cache_stats['max_bytes'] / 1024 / 1024:.0f}MB"
+        f" (破棄済み {cache_stats['evicted_bytes'] / 1024 / 1024:.1f}MB)"
+    )
+    if "disk_dir" in cache_stats:
+        st.write(
+            f"**ディスク** ({cache_stats['disk_dir']}): {cache_stats['disk_bytes'] / 1024 / 1024:.1f}MB"
+            f" / {cache_stats['disk_max_bytes'] / 1024 / 1024:.0f}MB"
+            f" (破棄済み {cache_stats['disk_evicted_bytes'] / 1024 / 1024:.1f}MB)"
+        )
+    else:
+        st.write(
+            "ディスクキャッシュは無効です (環境変数 IMAGEFORGE_CACHE_DIR で有効化)。"
+        )
+
+with st.expander("🧵 処理の混雑状況"):
+    job_stats = scheduler.get_scheduler().stats()
+    st.write(
+        f"**同時に実行**: {job_stats['running']} / {job_stats['max_workers']}件"
+        f" (1件あたり {job_stats['threads_per_job']}スレッド)"
+        f" / **順番待ち**: {job_stats['queued']} / {job_stats['max_queue']}件"
+    )
+    st.write(
+        f"**完了**: {job_stats['completed']} / **失敗**: {job_stats['failed']}"
+        f" / **取り消し**: {job_stats['cancelled']} / **混雑でお断り**: {job_stats['rejected']}"
+    )
+    if "wait_p50" in job_stats:
+        st.write(
+            f"**待ち時間**: 中央値 {job_stats['wait_p50']:.2f}秒"
+            f" / 最大 {job_stats['wait_max']:.2f}秒"
+        )
+
+with st.expander("🗂️ セッションの画像のメモリ"):
+    # 各ページの元画像・補正結果などは、予算を超えると使われていないセッションからディスクへ退避する
+    store_stats = artifacts.get_store().stats()
+    st.write(
+        f"**メモリ上**: {store_stats['resident_bytes'] / 1024 / 1024:.1f}MB"
+        f" / {store_stats['max_bytes'] / 1024 / 1024:.0f}MB"
+        f" / **ディスクに退避中**: {store_stats['spilled_bytes'] / 1024 / 1024:.1f}MB"
+        f" ({store_stats['spilled_artifacts']} / {store_stats['artifacts']}枚)"
+    )
+    st.write(
+        f"**セッション**: {store_stats['sessions']}"
+        f" (終了して削除 {store_stats['sessions_dropped']})"
+        f" / **退避**: {store_stats['spills']}回 / **読み込み直し**: {store_stats['reloads']}回"
+    )
+
+with st.expander("🚀 起動時間"):
+    # 背景除去モデルと scikit-learn は、最初のページ表示と同時にバックグラウンドで先読みしている
+    st.dataframe(startup.preload_table(), hide_index=True)
+    page_rows = startup.pages_table()
+    if page_rows:
+        st.dataframe(page_rows, hide_index=True)
+    else:
+        st.write(
+            "まだ計測したページはありません (このページの計測は表示の完了後に記録されます)。"
+        )
+
 st.info(
     "このアプリは複数の画像処理機能を一つに統合したものです。個人利用の範囲でお楽しみください。"
 )
+
+startup.end_page(__file__)
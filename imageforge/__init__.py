@@ -0,0 +1,6 @@
+# imageforge/__init__.py
+"""ImageForge の画像処理ロジック (Streamlit 非依存)
+
+各ページ (pages/*.py) と CLI から共通で利用する処理をまとめたパッケージです。
+このパッケージ内のモジュールは Streamlit を import しません。
+"""
@@ -0,0 +1,265 @@
+# imageforge/animation.py
+"""アニメーション GIF / WebP のピクセルアート変換
+
+フレームは1枚ずつデコードして処理し、すぐにファイルへ書き出すので、フレーム数が
+増えてもメモリ使用量はほぼ一定です (同時に保持するのは処理待ちの max_pending 枚だけ)。
+各フレームのピクセルアート化はスレッドプールで並列に行い、書き出しは元の順序で行います。
+
+GIF は 256 色しか使えないため、フレームごとに減色するとフレーム間で色が変わって
+ちらつきます。レトロパレット以外のスタイルでは、まず全フレームのドットの色ヒストグラムを
+集計して (1回目のデコード)、アニメーション全体で共通のパレットを作ってから書き出します
+(2回目のデコード)。WebP はフルカラーなので減色しません。
+"""
+import collections
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+from PIL import GifImagePlugin, Image, ImageSequence, TiffImagePlugin
+
+from imageforge import metrics, scheduler
+from imageforge.pixelart import (
+    CUSTOM_PALETTE,
+    MAX_PALETTE_COLORS,
+    RETRO_PALETTES,
+    apply_palette_style,
+    downsample_grid,
+    palette_colors,
+    palette_indices,
+)
+from imageforge.quantize import (
+    accumulate_histogram,
+    bin_indices,
+    empty_histogram,
+    fit_palette_lut,
+)
+
+# --- 定数 ---
+ANIMATION_FORMATS = {"GIF": "image/gif", "WebP": "image/webp"}
+DEFAULT_DURATION = 100  # フレームの表示時間が無い場合 (ms)
+MAX_PENDING = 8  # 処理待ちにしておく最大フレーム数
+GIF_COLORS = MAX_PALETTE_COLORS
+
+
+# --- 読み込み ---
+def frame_count(image_bytes):
+    """画像のフレーム数 (静止画なら 1)"""
+    with Image.open(BytesIO(image_bytes)) as img:
+        return getattr(img, "n_frames", 1)
+
+
+def iter_frames(image_bytes):
+    """(RGB フレーム, 表示時間 ms) を先頭から1枚ずつ返す (全体を一度にデコードしない)"""
+    with Image.open(BytesIO(image_bytes)) as img:
+        for frame in ImageSequence.Iterator(img):
+            duration = frame.info.get("duration") or DEFAULT_DURATION
+            yield frame.convert("RGB"), int(duration)
+
+
+def _loop_count(image_bytes):
+    with Image.open(BytesIO(image_bytes)) as img:
+        return img.info.get("loop", 0)
+
+
+def _map_ordered(fn, items, workers, max_pending=MAX_PENDING):
+    """fn を並列に適用し、結果を入力順に返す (実行中・待機中は max_pending 件まで)"""
+    with ThreadPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# --- 書き出し ---
+class StreamingGIFWriter:
+    """パレット画像 (P モード) のフレームを1枚ずつ書き出す GIF ライター
+
+    Pillow の save(save_all=True) は全フレームをメモリに保持するため使いません。
+    全フレームが同じパレット (グローバルカラーテーブル) を共有します。
+    """
+
+    def __init__(self, fp, palette, loop=0):
+        self.fp = fp
+        self.palette = np.asarray(palette, dtype=np.uint8).reshape(-1)
+        self.loop = loop
+        self.frames = 0
+
+    def _to_image(self, indices):
+        frame = Image.fromarray(indices, "P")
+        frame.putpalette(self.palette.tobytes())
+        return frame
+
+    def add_frame(self, indices, duration):
+        """パレット番号の配列 (H×W, uint8) を1フレームとして書き出す"""
+        frame = self._to_image(indices)
+        if self.frames == 0:
+            header, _ = GifImagePlugin.getheader(
+                frame, info={"loop": self.loop, "optimize": False, "duration": duration}
+            )
+            for block in header:
+                self.fp.write(block)
+        for block in GifImagePlugin.getdata(frame, duration=duration):
+            self.fp.write(block)
+        self.frames += 1
+
+    def close(self):
+        self.fp.write(b";")  # トレーラー
+
+
+class StreamingWebPWriter:
+    """RGB フレームを1枚ずつ一時ファイルに書き、close() でアニメーション WebP にする
+
+    Pillow の save(save_all=True) は append_images をリストにしてから処理するため、
+    フレームは複数ページの TIFF (一時ファイル) に追記しておき、close() でそれを開いて
+    公開 API の save(save_all=True) で書き出します。TIFF のフレームは seek したときに
+    1枚ずつ読み込まれるので、メモリに置くのは1フレームと圧縮後のデータだけです。
+    """
+
+    def __init__(self, fp, size, loop=0, lossless=True, quality=80):
+        self.fp = fp
+        self.loop = loop
+        self.lossless = lossless
+        self.quality = quality
+        self.frames = 0
+        self._durations = []
+        self._spool = tempfile.TemporaryFile()
+        self._tiff = TiffImagePlugin.AppendingTiffWriter(self._spool)
+
+    def add_frame(self, frame, duration):
+        # 無圧縮で書く (libtiff の圧縮は書き出したデータをメモリに溜めるため)
+        frame.convert("RGB").save(self._tiff, format="TIFF")
+        self._tiff.newFrame()
+        self._durations.append(duration)
+        self.frames += 1
+
+    def close(self):
+        try:
+            self._tiff.finalize()
+            self._spool.seek(0)
+            with Image.open(self._spool) as frames:
+                frames.save(
+                    self.fp,
+                    format="WEBP",
+                    save_all=True,
+                    duration=self._durations,
+                    loop=self.loop,
+                    lossless=self.lossless,
+                    quality=self.quality,
+                )
+        finally:
+            self._spool.close()
+
+
+# --- 共通パレット ---
+def shared_palette(image_bytes, pixel_size, style, method, workers=None):
+    """全フレームのドットの色から、アニメーション共通のパレットを作る
+
+    戻り値は (パレット (N×3, uint8), ヒストグラムのビン → パレット番号 の LUT)。
+    """
+    counts, sums = empty_histogram()
+
+    def grid_pixels(item):
+        frame, _ = item
+        grid = apply_palette_style(downsample_grid(frame, pixel_size, method), style)
+        return np.asarray(grid).reshape(-1, 3)
+
+    for pixels in _map_ordered(grid_pixels, iter_frames(image_bytes), workers):
+        accumulate_histogram(pixels, counts, sums)
+    # 使われないビンの (0, 0, 0) が余分な1色になることがあるので1色空けておく
+    color_lut = fit_palette_lut(counts, sums, k=GIF_COLORS - 1)
+    palette, index = np.unique(color_lut, axis=0, return_inverse=True)
+    return palette, index.reshape(-1).astype(np.uint8)
+
+
+# --- 公開関数 ---
+def render_animation(
+    image_bytes,
+    fp,
+    fmt="GIF",
+    pixel_size=10,
+    style="オリジナル",
+    method="nearest",
+    dither=0.0,
+    custom_palette=(),
+    workers=None,
+    progress=None,
+):
+    """アニメーションの全フレームをピクセルアートに変換して fp に書き出す
+
+    progress には (処理済みフレーム数, 全フレーム数) を受け取る関数を渡せます。
+    imageforge.scheduler で実行した場合は、フレームごとに取り消しを確認します。
+    戻り値は統計情報の dict (frames, seconds, fps, palette_colors)。
+    """
+    start = time.perf_counter()
+    total = frame_count(image_bytes)
+    loop = _loop_count(image_bytes)
+    with Image.open(BytesIO(image_bytes)) as img:
+        size = img.size
+
+    fixed_palette = None
+    if style in RETRO_PALETTES:
+        fixed_palette = tuple(RETRO_PALETTES[style])
+    elif style == CUSTOM_PALETTE and custom_palette:
+        fixed_palette = tuple(custom_palette)
+
+    if fixed_palette is not None and len(fixed_palette) > MAX_PALETTE_COLORS:
+        raise ValueError(
+            f"パレットは{MAX_PALETTE_COLORS}色までです: {len(fixed_palette)}色"
+        )
+
+    if fmt == "GIF":
+        if fixed_palette is not None:
+            palette = palette_colors(fixed_palette)
+            index_lut = None
+        else:
+            with metrics.stage("shared_palette"):
+                palette, index_lut = shared_palette(
+                    image_bytes, pixel_size, style, method, workers
+                )
+        writer = StreamingGIFWriter(fp, palette, loop)
+    else:
+        palette = None
+        writer = StreamingWebPWriter(fp, size, loop)
+
+    def render_frame(item):
+        frame, duration = item
+        grid = downsample_grid(frame, pixel_size, method)
+        if fmt == "WebP":
+            styled = apply_palette_style(grid, style, dither, custom_palette)
+            return styled.resize(size, Image.NEAREST), duration
+        if fixed_palette is not None:
+            # パレット番号のままグリッドを拡大する (ディザはグリッド上で行う)
+            indices = palette_indices(grid, fixed_palette, dither)
+        else:
+            styled = apply_palette_style(grid, style)
+            pixels = np.asarray(styled).reshape(-1, 3)
+            indices = index_lut[bin_indices(pixels)].reshape(grid.height, grid.width)
+        indices = np.asarray(Image.fromarray(indices, "L").resize(size, Image.NEAREST))
+        return indices, duration
+
+    done = 0
+    # フレームの処理はワーカースレッドで行うため、段階はまとめて1つとして記録する
+    with metrics.stage("render_frames"):
+        for result, duration in _map_ordered(
+            render_frame, iter_frames(image_bytes), workers
+        ):
+            scheduler.checkpoint()
+            writer.add_frame(result, duration)
+            done += 1
+            if progress is not None:
+                progress(done, total)
+        writer.close()
+    metrics.annotate(frames=done)
+
+    elapsed = time.perf_counter() - start
+    return {
+        "frames": done,
+        "seconds": elapsed,
+        "fps": done / elapsed if elapsed > 0 else 0.0,
+        "palette_colors": None if palette is None else len(palette),
+    }
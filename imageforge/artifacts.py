@@ -0,0 +1,288 @@
+# imageforge/artifacts.py
+"""セッションごとの大きな画像の置き場所 (メモリの予算を超えたらディスクへ退避)
+
+st.session_state に PIL 画像をそのまま置くと、タブを開いたまま放置されたセッションの
+フル解像度の画像がすべてメモリに残り、同時に開かれたタブの数だけ RSS が増えていきます。
+各ページは画像を SessionArtifacts に預け、使うときに get() で取り出します。
+
+- プロセス全体で、メモリに置く画像の合計を max_bytes までに抑えます。超えた分は
+  最近使われていないセッション (と、その中で最近使われていない画像) から順に、
+  ローカルディスクのファイル (np.memmap) へ書き出してメモリから外します。
+- 退避した画像は、次に get() したときに読み込み直します (metrics の
+  artifact_reloads に数えます)。一度書き出したファイルは、画像を置き換えるか
+  セッションが終わるまで残すので、もう一度退避するときは書き込みません。
+- セッションが終わり、st.session_state とともに SessionArtifacts が破棄されると、
+  そのセッションの画像と退避ファイル (attach_file() で預けたファイルも) を削除します。
+
+画像の参照がページの処理中のローカル変数などに残っている間は、退避してもメモリは
+解放されません (処理が終われば解放されます)。
+
+環境変数で設定できます:
+    IMAGEFORGE_SESSION_MEMORY_MB   メモリに置く画像の合計の上限 (デフォルト: 1024)
+    IMAGEFORGE_SPILL_DIR           退避ファイルを置くディレクトリ (デフォルト: 一時ディレクトリ)
+"""
+import atexit
+import collections
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+
+import numpy as np
+from PIL import Image
+
+from imageforge import metrics
+
+# --- 定数 ---
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+# np.asarray / Image.fromarray で往復できるモード (それ以外の画像は退避しない)
+SPILLABLE_MODES = ("L", "LA", "RGB", "RGBA")
+
+
+def _nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    return value.width * value.height * len(value.getbands())
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class _Entry:
+    """預かった画像1つ (value が None なら退避中)"""
+
+    __slots__ = ("value", "nbytes", "spillable", "layout", "path", "last_used")
+
+    def __init__(self, value):
+        self.value = value
+        self.nbytes = _nbytes(value)
+        self.spillable = isinstance(value, np.ndarray) or value.mode in SPILLABLE_MODES
+        self.layout = None  # 退避ファイルの (種類, モード, dtype, shape)
+        self.path = None
+        self.last_used = time.monotonic()
+
+
+class ArtifactStore:
+    """全セッションの画像をメモリの予算内で持つ (スレッドセーフ)"""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, spill_dir=None):
+        self.max_bytes = max_bytes
+        self._spill_dir = spill_dir
+        self._own_spill_dir = False
+        self._entries = {}  # (セッション, 名前) -> _Entry
+        self._files = {}  # (セッション, 名前) -> attach_file() で預かったパス
+        self._sessions = {}  # セッション -> 最後に使われた時刻
+        self._lock = threading.RLock()
+        self.resident_bytes = 0
+        self.spilled_bytes = 0
+        self.counts = collections.Counter()
+
+    # --- 退避ファイル ---
+    def _spill_path(self, session):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="imageforge-spill-")
+            self._own_spill_dir = True
+        os.makedirs(self._spill_dir, exist_ok=True)
+        return os.path.join(self._spill_dir, f"{session}-{uuid.uuid4().hex}.bin")
+
+    def _spill(self, session, name, entry):
+        if entry.path is None:
+            value = entry.value
+            if isinstance(value, np.ndarray):
+                arr, layout = value, ("array", None)
+            else:
+                arr, layout = np.asarray(value), ("image", value.mode)
+            path = self._spill_path(session)
+            mm = np.memmap(path, dtype=arr.dtype, mode="w+", shape=arr.shape)
+            mm[...] = arr
+            mm.flush()
+            del mm
+            entry.path = path
+            entry.layout = layout + (arr.dtype.str, arr.shape)
+            self.counts["spill_writes"] += 1
+        entry.value = None
+        self.resident_bytes -= entry.nbytes
+        self.spilled_bytes += entry.nbytes
+        self.counts["spills"] += 1
+
+    def _reload(self, entry):
+        kind, mode, dtype, shape = entry.layout
+        mm = np.memmap(entry.path, dtype=np.dtype(dtype), mode="r", shape=shape)
+        arr = np.array(mm)
+        del mm
+        entry.value = arr if kind == "array" else Image.fromarray(arr, mode)
+        self.resident_bytes += entry.nbytes
+        self.spilled_bytes -= entry.nbytes
+        self.counts["reloads"] += 1
+        metrics.count("artifact_reloads")
+
+    def _enforce(self, keep):
+        """メモリの合計が予算を超えていれば、使われていない順に退避する (keep は残す)"""
+        if self.resident_bytes <= self.max_bytes:
+            return
+        candidates = sorted(
+            (
+                (self._sessions.get(session, 0.0), entry.last_used, session, name)
+                for (session, name), entry in self._entries.items()
+                if entry.value is not None and entry.spillable and entry is not keep
+            ),
+        )
+        for _, _, session, name in candidates:
+            if self.resident_bytes <= self.max_bytes:
+                break
+            self._spill(session, name, self._entries[(session, name)])
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            if entry.value is None:
+                self.spilled_bytes -= entry.nbytes
+            else:
+                self.resident_bytes -= entry.nbytes
+            if entry.path is not None:
+                _remove_quietly(entry.path)
+        path = self._files.pop(key, None)
+        if path is not None:
+            _remove_quietly(path)
+
+    # --- 公開メソッド ---
+    def put(self, session, name, value):
+        """画像 (PIL Image / ndarray) を預ける。None なら預けていたものを削除する"""
+        with self._lock:
+            self._discard((session, name))
+            now = time.monotonic()
+            self._sessions[session] = now
+            if value is None:
+                return
+            entry = _Entry(value)
+            self._entries[(session, name)] = entry
+            self.resident_bytes += entry.nbytes
+            self._enforce(keep=entry)
+
+    def get(self, session, name, default=None):
+        """預けた画像を返す (退避中ならディスクから読み込み直す)"""
+        with self._lock:
+            now = time.monotonic()
+            self._sessions[session] = now
+            entry = self._entries.get((session, name))
+            if entry is None:
+                return default
+            entry.last_used = now
+            if entry.value is None:
+                self._reload(entry)
+                self._enforce(keep=entry)
+            return entry.value
+
+    def has(self, session, name):
+        """画像を預けているか (退避中でも読み込まない)"""
+        with self._lock:
+            return (session, name) in self._entries
+
+    def attach_file(self, session, name, path):
+        """セッションが終わったら (または同じ名前で預け直したら) 削除するファイルを預ける"""
+        with self._lock:
+            self._discard((session, name))
+            self._sessions[session] = time.monotonic()
+            if path is not None:
+                self._files[(session, name)] = path
+
+    def drop_session(self, session):
+        """セッションの画像・退避ファイル・預かったファイルをすべて削除する"""
+        with self._lock:
+            keys = [
+                k for k in list(self._entries) + list(self._files) if k[0] == session
+            ]
+            for key in keys:
+                self._discard(key)
+            if self._sessions.pop(session, None) is not None:
+                self.counts["sessions_dropped"] += 1
+
+    def close(self):
+        """すべてのセッションを削除し、自分で作った退避ディレクトリも消す"""
+        with self._lock:
+            for session in list(self._sessions):
+                self.drop_session(session)
+            if self._own_spill_dir and self._spill_dir is not None:
+                shutil.rmtree(self._spill_dir, ignore_errors=True)
+                self._spill_dir = None
+
+    def stats(self):
+        """メモリ上・退避中のバイト数とセッション数"""
+        with self._lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "resident_bytes": self.resident_bytes,
+                "spilled_bytes": self.spilled_bytes,
+                "sessions": len(self._sessions),
+                "artifacts": len(self._entries),
+                "spilled_artifacts": sum(
+                    1 for e in self._entries.values() if e.value is None
+                ),
+                "files": len(self._files),
+                **{
+                    name: self.counts[name]
+                    for name in (
+                        "spills",
+                        "spill_writes",
+                        "reloads",
+                        "sessions_dropped",
+                    )
+                },
+            }
+
+
+# --- セッションごとの窓口 ---
+class SessionArtifacts:
+    """1つのセッションの画像の置き場所 (st.session_state に1つ置く)
+
+    このオブジェクトが破棄されると (セッションの終了時)、預けた画像とファイルを削除します。
+    """
+
+    def __init__(self, store=None):
+        self.store = store or get_store()
+        self.session_id = uuid.uuid4().hex
+        weakref.finalize(self, self.store.drop_session, self.session_id)
+
+    def put(self, name, value):
+        self.store.put(self.session_id, name, value)
+
+    def get(self, name, default=None):
+        return self.store.get(self.session_id, name, default)
+
+    def has(self, name):
+        return self.store.has(self.session_id, name)
+
+    def attach_file(self, name, path):
+        self.store.attach_file(self.session_id, name, path)
+
+    def clear(self):
+        self.store.drop_session(self.session_id)
+
+
+# --- プロセス全体で共有するストア ---
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """環境変数の設定でプロセス共有の ArtifactStore を作って返す"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            try:
+                max_mb = int(os.environ.get("IMAGEFORGE_SESSION_MEMORY_MB", 0))
+            except ValueError:
+                max_mb = 0
+            _store = ArtifactStore(
+                max_bytes=max_mb * 1024 * 1024 if max_mb > 0 else DEFAULT_MAX_BYTES,
+                spill_dir=os.environ.get("IMAGEFORGE_SPILL_DIR") or None,
+            )
+            atexit.register(_store.close)
+        return _store
@@ -0,0 +1,321 @@
+# imageforge/batch.py
+"""AIイラスト補正のバッチ処理 (CLI)
+
+ディレクトリ内の画像すべてに、ページと同じ process_image() を同じ params で適用します。
+処理はプロセスプールで並列化し、完了した画像はマニフェスト (JSON Lines) に追記するため、
+途中でクラッシュしても再実行すれば未処理の画像から再開できます。
+
+使い方:
+    python -m imageforge.batch INPUT_DIR OUTPUT_DIR --params params.json --seed 42
+    python -m imageforge.batch INPUT_DIR OUTPUT_DIR --lut look.cube
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+from imageforge import cache, colorlut, ingest
+from imageforge.correction import DEFAULT_PARAMS, process_image
+from imageforge.inplace import process_image_inplace
+
+# --- 定数 ---
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+MANIFEST_NAME = "manifest.jsonl"
+
+
+# --- パラメータ・マニフェスト ---
+def load_params(spec, lut_path=None):
+    """JSON ファイルのパスまたは JSON 文字列から params を読み込む (未指定の項目はデフォルト値)
+
+    lut_path を渡すと、その .cube ファイルを color_lut に読み込みます。
+    """
+    overrides = {}
+    if spec:
+        if os.path.isfile(spec):
+            with open(spec, encoding="utf-8") as f:
+                overrides = json.load(f)
+        else:
+            overrides = json.loads(spec)
+    if lut_path:
+        with open(lut_path, encoding="utf-8") as f:
+            overrides = {**overrides, "color_lut": f.read()}
+    return merge_params(overrides)
+
+
+def merge_params(overrides):
+    """デフォルト値に overrides (dict) を重ねた params を返す (不正な値なら ValueError)"""
+    if not isinstance(overrides, dict):
+        raise ValueError("パラメータは JSON のオブジェクトで指定してください")
+    unknown = set(overrides) - set(DEFAULT_PARAMS)
+    if unknown:
+        raise ValueError(f"未知のパラメータがあります: {sorted(unknown)}")
+    params = {**DEFAULT_PARAMS, **overrides}
+    if params["color_lut"] is not None:
+        colorlut.parse_cube(params["color_lut"])  # 形式が正しくなければ ValueError
+    return params
+
+
+def params_fingerprint(params, seed):
+    """params・seed・処理の版 (cache.CACHE_VERSION) からマニフェスト照合用のハッシュを作る"""
+    payload = json.dumps(
+        {"params": params, "seed": seed, "version": cache.CACHE_VERSION},
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def read_manifest(path):
+    """マニフェストから完了済みエントリを {入力の相対パス: エントリ} で返す"""
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # クラッシュ時に途中まで書かれた行は無視する
+                continue
+            if entry.get("status") == "ok":
+                done[entry["source"]] = entry
+    return done
+
+
+def append_manifest(f, entry):
+    """1行追記してすぐにディスクへ書き出す"""
+    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def find_images(input_dir, recursive=False):
+    """入力ディレクトリ内の画像を相対パスのソート済みリストで返す"""
+    found = []
+    if recursive:
+        for root, _, files in os.walk(input_dir):
+            for name in files:
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    found.append(os.path.relpath(os.path.join(root, name), input_dir))
+    else:
+        for name in os.listdir(input_dir):
+            if name.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(
+                os.path.join(input_dir, name)
+            ):
+                found.append(name)
+    return sorted(found)
+
+
+def output_path_for(rel_path, output_dir):
+    base, _ = os.path.splitext(rel_path)
+    return os.path.join(output_dir, f"{base}.png")
+
+
+def find_collisions(rel_paths):
+    """同じ出力ファイルになる入力 (a.png と a.jpg など) を {出力: [入力, ...]} で返す"""
+    by_output = {}
+    for rel_path in rel_paths:
+        by_output.setdefault(output_path_for(rel_path, ""), []).append(rel_path)
+    return {out: srcs for out, srcs in by_output.items() if len(srcs) > 1}
+
+
+def source_signature(src_path):
+    """入力ファイルのサイズと更新時刻 (同じ名前のまま差し替えられたファイルを見分ける)"""
+    st = os.stat(src_path)
+    return {"source_size": st.st_size, "source_mtime_ns": st.st_mtime_ns}
+
+
+# --- ワーカー ---
+def _init_worker():
+    # 各プロセスが全コアを使うと過剰なスレッドになるため、OpenCV は1スレッドに制限する
+    import cv2
+
+    cv2.setNumThreads(1)
+
+
+def process_file(src_path, dst_path, params, seed, low_memory=False):
+    """1枚を補正して PNG で保存する (ワーカープロセスで実行)"""
+    start = time.perf_counter()
+    with open(src_path, "rb") as f:
+        data = f.read()
+    if low_memory:
+        # 作業バッファへ直接デコードする (PIL の画像を経由しないので、コピーが1つ少ない)
+        work, _ = ingest.decode_array(data)
+        fixed_pil, _ = process_image_inplace(work, params, seed=seed)
+    else:
+        img_pil, _ = ingest.decode(data)
+        fixed_pil = process_image(img_pil, params, seed=seed)
+    os.makedirs(os.path.dirname(dst_path) or ".", exist_ok=True)
+    # 書き込み途中のファイルを完了済みと誤認しないよう、一時ファイルから置き換える
+    tmp_path = dst_path + ".part"
+    fixed_pil.save(tmp_path, format="PNG")
+    os.replace(tmp_path, dst_path)
+    return time.perf_counter() - start
+
+
+def run_batch(
+    input_dir,
+    output_dir,
+    params,
+    seed=None,
+    workers=None,
+    manifest_path=None,
+    recursive=False,
+    low_memory=False,
+):
+    """ディレクトリ全体を処理し、(成功数, 失敗数, スキップ数) を返す
+
+    出力のファイル名が重なる入力がある場合は、何も処理せずに ValueError を送出します。
+    """
+    images = find_images(input_dir, recursive)
+    collisions = find_collisions(images)
+    if collisions:
+        raise ValueError(
+            "出力のファイル名が重なる画像があります: "
+            + "; ".join(
+                f"{' / '.join(srcs)} → {out}" for out, srcs in collisions.items()
+            )
+        )
+    workers = workers or os.cpu_count() or 1
+    manifest_path = manifest_path or os.path.join(output_dir, MANIFEST_NAME)
+    os.makedirs(output_dir, exist_ok=True)
+
+    fingerprint = params_fingerprint(params, seed)
+    done = read_manifest(manifest_path)
+    todo, skipped = [], 0
+    for rel_path in images:
+        dst_path = output_path_for(rel_path, output_dir)
+        signature = source_signature(os.path.join(input_dir, rel_path))
+        entry = done.get(rel_path)
+        if (
+            entry is not None
+            and entry.get("params") == fingerprint
+            and all(entry.get(k) == v for k, v in signature.items())
+            and os.path.exists(dst_path)
+        ):
+            skipped += 1
+            continue
+        todo.append((rel_path, dst_path, signature))
+
+    ok = failed = 0
+    with open(manifest_path, "a", encoding="utf-8") as manifest, ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker
+    ) as pool:
+        futures = {
+            pool.submit(
+                process_file,
+                os.path.join(input_dir, rel_path),
+                dst_path,
+                params,
+                seed,
+                low_memory,
+            ): (rel_path, dst_path, signature)
+            for rel_path, dst_path, signature in todo
+        }
+        for future in as_completed(futures):
+            rel_path, dst_path, signature = futures[future]
+            entry = {
+                "source": rel_path,
+                "output": os.path.relpath(dst_path, output_dir),
+                "params": fingerprint,
+                **signature,
+            }
+            try:
+                entry["seconds"] = round(future.result(), 3)
+                entry["status"] = "ok"
+                ok += 1
+            except Exception as e:
+                entry["status"] = "error"
+                entry["error"] = f"{type(e).__name__}: {e}"
+                failed += 1
+            append_manifest(manifest, entry)
+            print(
+                f"[{ok + failed}/{len(todo)}] {entry['status']}: {rel_path}",
+                file=sys.stderr,
+            )
+    return ok, failed, skipped
+
+
+# --- CLI ---
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m imageforge.batch",
+        description="AIイラスト補正をディレクトリ単位で一括適用します。",
+    )
+    parser.add_argument("input_dir", help="入力画像のディレクトリ")
+    parser.add_argument("output_dir", help="補正後の PNG を書き出すディレクトリ")
+    parser.add_argument(
+        "--params",
+        help="params の JSON ファイルまたは JSON 文字列 (未指定の項目はデフォルト値)",
+    )
+    parser.add_argument(
+        "--lut",
+        default=None,
+        help="彩度の後に適用するカラー LUT (.cube)。ページから書き出した LUT も使えます",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="ノイズの乱数シード (ページの「乱数シード」と同じ値で同じ結果になります)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="ワーカープロセス数 (デフォルト: CPUコア数)",
+    )
+    parser.add_argument(
+        "--manifest",
+        default=None,
+        help=f"マニフェストのパス (デフォルト: OUTPUT_DIR/{MANIFEST_NAME})",
+    )
+    parser.add_argument(
+        "--recursive", action="store_true", help="サブディレクトリも処理する"
+    )
+    parser.add_argument(
+        "--low-memory",
+        action="store_true",
+        help="省メモリモード (imageforge.inplace) で処理する",
+    )
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        params = load_params(args.params, args.lut)
+    except (OSError, ValueError) as e:
+        print(f"パラメータの読み込みに失敗しました: {e}", file=sys.stderr)
+        return 2
+    start = time.perf_counter()
+    try:
+        ok, failed, skipped = run_batch(
+            args.input_dir,
+            args.output_dir,
+            params,
+            seed=args.seed,
+            workers=args.workers,
+            manifest_path=args.manifest,
+            recursive=args.recursive,
+            low_memory=args.low_memory,
+        )
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        return 2
+    elapsed = time.perf_counter() - start
+    print(
+        f"完了: 成功 {ok} / 失敗 {failed} / スキップ {skipped} ({elapsed:.1f}秒)",
+        file=sys.stderr,
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
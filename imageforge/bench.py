@@ -0,0 +1,408 @@
+# imageforge/bench.py
+"""画像処理関数のマイクロベンチマーク (CLI)
+
+各処理を Streamlit の外で、512px から 8K までの合成画像 (写真風・フラットなイラスト風) に
+適用し、実行時間と最大メモリ使用量を計測して JSON に保存します。以前の結果をベースラインとして
+渡すと、しきい値を超えて遅く (または大きく) なった項目を回帰として報告し、終了コード 1 を返します。
+
+メモリは2種類を記録します:
+    peak_traced_bytes   tracemalloc で計測した Python / NumPy 側の最大確保量
+    peak_rss_bytes      プロセスの RSS の増分 (Linux のみ。PIL / OpenCV / onnxruntime の確保も含む)
+
+使い方:
+    python -m imageforge.bench --output bench.json
+    python -m imageforge.bench --sizes 512 2048 --ops add_noise process_image --baseline bench.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import warnings
+
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw
+
+from imageforge import colorlut, correction, ingest, pixelart
+from imageforge.inplace import PeakTracker
+from imageforge.metrics import RSSPeak
+from imageforge.preview import PREVIEW_WIDTH
+from imageforge.quantize import apply_kmeans_fast
+
+# --- 定数 ---
+SIZES = (512, 1024, 2048, 3840, 7680)  # 長辺の px (3840 = 4K, 7680 = 8K)
+CONTENTS = ("photo", "flat")
+ASPECT = 9 / 16
+REPEAT = 3
+TIME_THRESHOLD = 0.2  # ベースラインから 20% 以上遅くなったら回帰
+MEMORY_THRESHOLD = 0.2
+MIN_SECONDS = 0.005  # これより小さい差は計測誤差として無視する
+MIN_BYTES = 1024 * 1024
+SEED = 0
+
+
+# --- 合成画像 ---
+def synthetic_image(size, content="photo", seed=SEED):
+    """長辺 size px の合成画像 (RGB)
+
+    photo: なめらかなグラデーション + 細かいノイズ (色数が多く、圧縮しにくい)
+    flat: 少ない色の図形を重ねたイラスト風の画像 (平坦な領域とはっきりした境界)
+    """
+    width, height = size, max(1, round(size * ASPECT))
+    rng = np.random.default_rng(seed)
+    if content == "photo":
+        y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+        x = np.linspace(0, 1, width, dtype=np.float32)[None, :]
+        planes = []
+        for _ in range(3):
+            fx, fy, phase = rng.uniform(1, 6, 3)
+            planes.append(0.5 + 0.35 * np.sin(2 * np.pi * (fx * x + fy * y) + phase))
+        img = np.stack(planes, axis=-1) * 255
+        img += rng.normal(0, 8, img.shape).astype(np.float32)
+        return Image.fromarray(np.clip(img, 0, 255).astype(np.uint8))
+    if content == "flat":
+        palette = [tuple(int(c) for c in rng.integers(0, 256, 3)) for _ in range(12)]
+        img = Image.new("RGB", (width, height), palette[0])
+        draw = ImageDraw.Draw(img)
+        for _ in range(60):
+            x0, x1 = sorted(rng.integers(0, width, 2))
+            y0, y1 = sorted(rng.integers(0, height, 2))
+            color = palette[int(rng.integers(1, len(palette)))]
+            if rng.random() < 0.5:
+                draw.rectangle((x0, y0, x1, y1), fill=color)
+            else:
+                draw.ellipse((x0, y0, x1, y1), fill=color, outline=palette[0])
+        return img
+    raise ValueError(f"未知の画像の種類です: {content}")
+
+
+# --- 計測する処理 ---
+def _to_bgr(img):
+    return cv2.cvtColor(np.asarray(img), cv2.COLOR_RGB2BGR)
+
+
+def _jpeg_bytes(img):
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def _remove_background_setup(img, mode="full"):
+    from imageforge import segmentation
+
+    pool = segmentation.get_pool()
+    pool.load()  # モデルの読み込みは計測に含めない
+    return (pool, img, mode)
+
+
+def _remove_background(pool, img, mode="full"):
+    # pages/2_background_remover.py の process_image_rembg() と同じ処理
+    from imageforge import matte
+
+    mask = pool.predict_masks([img], mode)[0]
+    return matte.cutout(img, mask)
+
+
+# 名前 -> (前処理 (計測しない), 計測する処理, 計測する最大の長辺 px or None)
+# 厳密モードの K-Means は 2048px でも1回30秒ほど、8K だと数十分かかるため、デフォルトでは 1024px までにしている
+OPERATIONS = {
+    "add_noise": (
+        lambda img: (img, 0.05, np.random.RandomState(SEED)),
+        correction.add_noise,
+        None,
+    ),
+    "add_chromatic_aberration": (
+        lambda img: (img, 1.0),
+        correction.add_chromatic_aberration,
+        None,
+    ),
+    "apply_kmeans": (
+        lambda img: (_to_bgr(img), 24),
+        correction.apply_kmeans,
+        1024,
+    ),
+    "apply_kmeans_fast": (lambda img: (_to_bgr(img), 24), apply_kmeans_fast, None),
+    "add_vignette": (lambda img: (img, 0.3), correction.add_vignette, None),
+    "adjust_colors": (
+        lambda img: (img, 1.1, 0.98, 0.95),
+        colorlut.adjust_colors,
+        None,
+    ),
+    "decode_jpeg": (lambda img: (_jpeg_bytes(img),), ingest.decode, None),
+    "decode_jpeg_preview": (
+        lambda img: (_jpeg_bytes(img), PREVIEW_WIDTH),
+        ingest.decode,
+        None,
+    ),
+    "decode_jpeg_array": (lambda img: (_jpeg_bytes(img),), ingest.decode_array, None),
+    "process_image": (
+        lambda img: (img, dict(correction.DEFAULT_PARAMS), SEED),
+        correction.process_image,
+        None,
+    ),
+    "create_pixel_art": (lambda img: (img, 10), pixelart.create_pixel_art, None),
+    "quantize_to_16bit": (lambda img: (img,), pixelart.quantize_to_16bit, None),
+    "to_colorful": (lambda img: (img,), pixelart.to_colorful, None),
+    "remove_background": (_remove_background_setup, _remove_background, None),
+    "remove_background_lowres": (
+        lambda img: _remove_background_setup(img, "lowres"),
+        _remove_background,
+        None,
+    ),
+    "remove_background_lowres_refine": (
+        lambda img: _remove_background_setup(img, "lowres_refine"),
+        _remove_background,
+        None,
+    ),
+}
+
+
+# --- 計測 ---
+def run_case(op, image, repeat=REPEAT):
+    """1つの処理を計測する。時間は repeat 回の最小値と中央値、メモリは別の1回で計測する
+
+    (tracemalloc を有効にすると NumPy の処理が遅くなるため、時間の計測とは分けています)
+    """
+    setup, fn, _ = OPERATIONS[op]
+    times = []
+    for _ in range(repeat):
+        args = setup(image)
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+    args = setup(image)
+    with RSSPeak() as rss, PeakTracker() as traced:
+        result = fn(*args)
+        del result
+    return {
+        "seconds_min": min(times),
+        "seconds_median": statistics.median(times),
+        "repeat": repeat,
+        "peak_traced_bytes": traced.peak,
+        "peak_rss_bytes": rss.peak,
+    }
+
+
+def run_benchmarks(
+    ops=None, sizes=SIZES, contents=CONTENTS, repeat=REPEAT, no_limits=False, log=None
+):
+    """全ての組み合わせを計測し、結果の dict (meta, results) を返す"""
+    ops = list(ops or OPERATIONS)
+    results = []
+    for size in sizes:
+        for content in contents:
+            image = synthetic_image(size, content)
+            for op in ops:
+                entry = {
+                    "op": op,
+                    "content": content,
+                    "size": list(image.size),
+                    "side": size,
+                }
+                max_side = OPERATIONS[op][2]
+                if max_side is not None and size > max_side and not no_limits:
+                    entry["skipped"] = (
+                        f"{max_side}px より大きい画像は --no-limits で計測"
+                    )
+                else:
+                    try:
+                        entry.update(run_case(op, image, repeat))
+                    except Exception as e:  # モデルが無い場合など
+                        entry["skipped"] = f"{type(e).__name__}: {e}"
+                results.append(entry)
+                if log is not None:
+                    log(format_entry(entry))
+            del image
+    return {"meta": environment(), "results": results}
+
+
+def environment():
+    """結果の比較に必要な実行環境の情報"""
+    import PIL
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pillow": PIL.__version__,
+        "opencv": cv2.__version__,
+    }
+
+
+# --- ベースラインとの比較 ---
+def _case_key(entry):
+    return (entry["op"], entry["content"], tuple(entry["size"]))
+
+
+def compare(
+    results,
+    baseline,
+    time_threshold=TIME_THRESHOLD,
+    memory_threshold=MEMORY_THRESHOLD,
+    min_seconds=MIN_SECONDS,
+    min_bytes=MIN_BYTES,
+):
+    """ベースラインと比べて、しきい値を超えて悪化した項目のリストを返す
+
+    時間は seconds_min、メモリは peak_traced_bytes と peak_rss_bytes を比べます。
+    差が min_seconds / min_bytes より小さいものは計測誤差として無視します。
+    """
+    base = {_case_key(e): e for e in baseline["results"] if "skipped" not in e}
+    checks = [
+        ("seconds_min", time_threshold, min_seconds),
+        ("peak_traced_bytes", memory_threshold, min_bytes),
+        ("peak_rss_bytes", memory_threshold, min_bytes),
+    ]
+    regressions = []
+    for entry in results["results"]:
+        old = base.get(_case_key(entry))
+        if old is None or "skipped" in entry:
+            continue
+        for metric, threshold, floor in checks:
+            before, after = old.get(metric), entry.get(metric)
+            if before is None or after is None:
+                continue
+            if after - before > floor and after > before * (1 + threshold):
+                regressions.append(
+                    {
+                        "op": entry["op"],
+                        "content": entry["content"],
+                        "size": entry["size"],
+                        "metric": metric,
+                        "baseline": before,
+                        "current": after,
+                        "ratio": after / before if before else float("inf"),
+                    }
+                )
+    return regressions
+
+
+# --- 表示 ---
+def _mb(value):
+    return "-" if value is None else f"{value / 1024 / 1024:.1f}MB"
+
+
+def format_entry(entry):
+    w, h = entry["size"]
+    head = f"{entry['op']:<26} {entry['content']:<6} {w:>5}x{h:<5}"
+    if "skipped" in entry:
+        return f"{head} スキップ ({entry['skipped']})"
+    return (
+        f"{head} {entry['seconds_min'] * 1000:>10.1f}ms"
+        f" (中央値 {entry['seconds_median'] * 1000:.1f}ms)"
+        f"  traced {_mb(entry['peak_traced_bytes'])}  rss {_mb(entry['peak_rss_bytes'])}"
+    )
+
+
+def format_regression(r):
+    w, h = r["size"]
+    if r["metric"] == "seconds_min":
+        before, after = f"{r['baseline'] * 1000:.1f}ms", f"{r['current'] * 1000:.1f}ms"
+    else:
+        before, after = _mb(r["baseline"]), _mb(r["current"])
+    return (
+        f"{r['op']} {r['content']} {w}x{h} {r['metric']}: "
+        f"{before} → {after} (×{r['ratio']:.2f})"
+    )
+
+
+# --- CLI ---
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m imageforge.bench",
+        description="画像処理関数の実行時間と最大メモリ使用量を計測します。",
+    )
+    parser.add_argument(
+        "--ops",
+        nargs="+",
+        choices=list(OPERATIONS),
+        default=None,
+        help="計測する処理 (デフォルト: すべて)",
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=list(SIZES),
+        help=f"画像の長辺 px (デフォルト: {' '.join(map(str, SIZES))})",
+    )
+    parser.add_argument(
+        "--contents",
+        nargs="+",
+        choices=CONTENTS,
+        default=list(CONTENTS),
+        help="合成画像の種類 (photo: 写真風, flat: フラットなイラスト風)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=REPEAT, help="時間を計測する回数 (最小値を比較)"
+    )
+    parser.add_argument(
+        "--no-limits",
+        action="store_true",
+        help="厳密モードの K-Means なども全サイズで計測する (非常に時間がかかります)",
+    )
+    parser.add_argument("--output", default=None, help="結果を保存する JSON のパス")
+    parser.add_argument(
+        "--baseline", default=None, help="比較するベースラインの JSON (以前の --output)"
+    )
+    parser.add_argument(
+        "--time-threshold",
+        type=float,
+        default=TIME_THRESHOLD,
+        help=f"時間の回帰とみなす増加率 (デフォルト: {TIME_THRESHOLD})",
+    )
+    parser.add_argument(
+        "--memory-threshold",
+        type=float,
+        default=MEMORY_THRESHOLD,
+        help=f"メモリの回帰とみなす増加率 (デフォルト: {MEMORY_THRESHOLD})",
+    )
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    # フラットな画像では色数が k より少ないため、K-Means が警告を出す (結果には影響しない)
+    warnings.filterwarnings("ignore", message="Number of distinct clusters")
+    baseline = None
+    if args.baseline:
+        try:
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"ベースラインの読み込みに失敗しました: {e}", file=sys.stderr)
+            return 2
+
+    results = run_benchmarks(
+        args.ops,
+        args.sizes,
+        args.contents,
+        max(1, args.repeat),
+        args.no_limits,
+        log=lambda line: print(line, file=sys.stderr),
+    )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if baseline is None:
+        return 0
+    regressions = compare(results, baseline, args.time_threshold, args.memory_threshold)
+    if not regressions:
+        print("ベースラインからの回帰はありません。", file=sys.stderr)
+        return 0
+    print(f"回帰が {len(regressions)} 件あります:", file=sys.stderr)
+    for r in regressions:
+        print("  " + format_regression(r), file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,308 @@
+# imageforge/cache.py
+"""処理結果のキャッシュ (メモリ + ディスクの2段)
+
+キーは「アップロードされたファイルのバイト列のハッシュ + 処理名 + パラメータ」から
+作ります。st.cache_data のように再実行のたびに画像のピクセルをハッシュし直す必要は
+ありません (ファイルのハッシュはアップロード時に1回計算すれば済みます)。
+
+- メモリ: 合計バイト数に上限のある LRU (プロセス内)
+- ディスク: IMAGEFORGE_CACHE_DIR を設定した場合だけ有効。再起動後も残り、同じホストの
+  複数のサーバープロセスで共有できます。書き込みは一時ファイル + rename で行うので、
+  読み込み側が書きかけのファイルを見ることはありません。合計サイズが上限を超えたら
+  最終アクセスの古いものから削除します。
+
+ディスクの値は pickle で保存します。キャッシュディレクトリはこのアプリのプロセスだけが
+書き込める場所にしてください。
+
+環境変数で設定できます:
+    IMAGEFORGE_CACHE_MB         メモリ上限 (デフォルト: 256)
+    IMAGEFORGE_CACHE_DIR        ディスクキャッシュの場所 (未設定ならディスクは使わない)
+    IMAGEFORGE_DISK_CACHE_MB    ディスク上限 (デフォルト: 2048)
+"""
+import hashlib
+import json
+import os
+import pickle
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from imageforge import metrics
+
+# --- 定数 ---
+MEMORY_CACHE_BYTES = 256 * 1024 * 1024
+DISK_CACHE_BYTES = 2048 * 1024 * 1024
+DISK_TRIM_RATIO = 0.9  # ディスクの上限を超えたら、上限のこの割合まで削除する
+# 出力が変わる処理の変更で上げる。キーに含めるので、古い版のディスクのエントリは使われない
+# (imageforge.batch のマニフェストの照合にも使う)
+# 2: EXIF の向きの反映 (ingest)・省メモリモードの放射状の色収差・ピクセルアートの
+#    nearest の既定・パレットの上限
+CACHE_VERSION = 2
+
+
+# --- キー ---
+def content_hash(data):
+    """バイト列 (または NumPy 配列) の内容のハッシュ (16進文字列)"""
+    if isinstance(data, np.ndarray):
+        digest = hashlib.sha256(f"{data.dtype}{data.shape}".encode())
+        digest.update(memoryview(np.ascontiguousarray(data)).cast("B"))
+        return digest.hexdigest()
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_key(content_key, operation, **params):
+    """処理の版・コンテンツのハッシュ・処理名・パラメータからキャッシュキーを作る"""
+    payload = json.dumps(
+        [CACHE_VERSION, content_key, operation, params], sort_keys=True, default=repr
+    ).encode()
+    return hashlib.sha256(payload).hexdigest()
+
+
+def _sizeof(value):
+    """メモリ上のおおよそのバイト数"""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, Image.Image):
+        return value.width * value.height * len(value.getbands())
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(_sizeof(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_sizeof(v) for v in value.values())
+    return sys.getsizeof(value)
+
+
+class ResultCache:
+    """メモリの LRU とディスクの2段キャッシュ (スレッドセーフ)
+
+    返した値はキャッシュと共有されるので、呼び出し側で書き換えないでください。
+    """
+
+    def __init__(
+        self,
+        max_bytes=MEMORY_CACHE_BYTES,
+        disk_dir=None,
+        disk_max_bytes=DISK_CACHE_BYTES,
+    ):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._disk_bytes = None  # 必要になったときにディレクトリを集計する
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evicted_bytes = 0
+        self.disk_evicted_bytes = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    # --- メモリ ---
+    def _memory_get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def _memory_put(self, key, value):
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self._bytes -= old_size
+                self.evicted_bytes += old_size
+
+    # --- ディスク ---
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + ".pkl")
+
+    def _disk_get(self, key):
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # 壊れたファイルは削除して、無かったものとして扱う
+            _remove_quietly(path)
+            return None
+        _touch_quietly(path)  # 最終アクセス時刻を LRU の順序に使う
+        return (value,)
+
+    def _disk_put(self, key, value):
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+                size = f.tell()
+        except BaseException:
+            _remove_quietly(tmp_path)
+            raise
+        with self._disk_lock:
+            # 同じキーを書き直す場合は、置き換える前のファイルの分を合計から引く
+            try:
+                old_size = os.stat(path).st_size
+            except FileNotFoundError:
+                old_size = 0
+            try:
+                os.replace(tmp_path, path)
+            except BaseException:
+                _remove_quietly(tmp_path)
+                raise
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(n for _, _, n in self._scan_disk())
+            else:
+                self._disk_bytes += size - old_size
+            if self._disk_bytes > self.disk_max_bytes:
+                self._trim_disk()
+
+    def _scan_disk(self):
+        """ディスク上のエントリを (最終アクセス時刻, パス, サイズ) で列挙する"""
+        entries = []
+        for sub in os.scandir(self.disk_dir):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if not entry.name.endswith(".pkl"):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:  # 他のプロセスが削除した
+                    continue
+                entries.append((st.st_mtime, entry.path, st.st_size))
+        return entries
+
+    def _trim_disk(self):
+        # 他のプロセスの書き込みも反映するため、毎回ディレクトリを集計し直す
+        entries = sorted(self._scan_disk())
+        total = sum(size for _, _, size in entries)
+        target = self.disk_max_bytes * DISK_TRIM_RATIO
+        for _, path, size in entries:
+            if total <= target:
+                break
+            if _remove_quietly(path):
+                self.disk_evicted_bytes += size
+            total -= size
+        self._disk_bytes = total
+
+    # --- 公開メソッド ---
+    def get(self, key, default=None):
+        entry = self._memory_get(key)
+        if entry is not None:
+            with self._lock:
+                self.memory_hits += 1
+            metrics.count("cache_memory_hits")
+            return entry[0]
+        if self.disk_dir:
+            entry = self._disk_get(key)
+            if entry is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                metrics.count("cache_disk_hits")
+                self._memory_put(key, entry[0])
+                return entry[0]
+        with self._lock:
+            self.misses += 1
+        metrics.count("cache_misses")
+        return default
+
+    def put(self, key, value, persist=True):
+        """値を登録する。persist=False ならメモリだけに置く"""
+        self._memory_put(key, value)
+        if self.disk_dir and persist:
+            self._disk_put(key, value)
+
+    def get_or_compute(self, key, fn, *args, persist=True, **kwargs):
+        """key の値を返す。無ければ fn(*args, **kwargs) で計算して登録する"""
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = fn(*args, **kwargs)
+            self.put(key, value, persist=persist)
+        return value
+
+    def clear(self):
+        """メモリのエントリを破棄する (ディスクは他のプロセスと共有なので残す)"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            summary = {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evicted_bytes": self.evicted_bytes,
+            }
+        if self.disk_dir:
+            with self._disk_lock:
+                if self._disk_bytes is None:
+                    self._disk_bytes = sum(size for _, _, size in self._scan_disk())
+                summary["disk_dir"] = self.disk_dir
+                summary["disk_bytes"] = self._disk_bytes
+                summary["disk_max_bytes"] = self.disk_max_bytes
+                summary["disk_evicted_bytes"] = self.disk_evicted_bytes
+        return summary
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
+
+
+def _touch_quietly(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+# --- プロセス全体で共有するキャッシュ ---
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _env_mb(name, default_bytes):
+    try:
+        return int(float(os.environ[name]) * 1024 * 1024)
+    except (KeyError, ValueError):
+        return default_bytes
+
+
+def get_cache():
+    """環境変数の設定でプロセス共有のキャッシュを作って返す"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache(
+                max_bytes=_env_mb("IMAGEFORGE_CACHE_MB", MEMORY_CACHE_BYTES),
+                disk_dir=os.environ.get("IMAGEFORGE_CACHE_DIR") or None,
+                disk_max_bytes=_env_mb("IMAGEFORGE_DISK_CACHE_MB", DISK_CACHE_BYTES),
+            )
+        return _cache
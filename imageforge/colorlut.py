@@ -0,0 +1,217 @@
+# imageforge/colorlut.py
+"""画素ごとの色の処理をルックアップテーブルにまとめて適用する
+
+明るさ・コントラスト・彩度は、画素ごとに (全体の平均輝度を除けば) 色だけで決まる処理です。
+ImageEnhance で1つずつ適用すると画像全体を何度も読み書きするため、次のようにまとめます。
+
+- 明るさとコントラストはチャンネルごとの処理なので、256 段階 × 3 チャンネルの 1D LUT に
+  合成し、Image.point() の1回で適用します。ImageEnhance と同じ式・同じ丸め (float32・
+  切り捨て) で表を作るので、結果はビット単位で同じです。コントラストに必要な平均輝度は、
+  先に1回だけ求めて表の入力にします。
+- 彩度や取り込んだ LUT (.cube) のようにチャンネルをまたぐ処理は、3D LUT (格子点の間は
+  三線形補間、ImageFilter.Color3DLUT) に合成して1回で適用します。彩度だけの場合は
+  ImageEnhance.Color の方が速く、丸めも従来と同じなのでそちらを使います
+  (Pillow の 3D LUT は1画素あたりの計算が重く、2K の画像で1回 70ms ほどかかります)。
+
+合成した表はパラメータごとにキャッシュします。3D LUT は標準の .cube 形式で書き出し・
+読み込みができるので、他のツール (DaVinci Resolve・Photoshop など) と色の調整を共有できます。
+"""
+import functools
+import hashlib
+import re
+
+import numpy as np
+from PIL import Image, ImageEnhance, ImageFilter, ImageStat
+
+# --- 定数 ---
+LUT_SIZE = 33  # 合成・書き出しに使う 3D LUT の1辺の格子点の数
+MIN_LUT_SIZE = 2
+MAX_LUT_SIZE = 65  # Pillow の Color3DLUT の上限
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114])  # convert("L") と同じ係数 (ITU-R 601-2)
+
+
+# --- 1D LUT (チャンネルごとの処理) ---
+def _blend_curve(curve, base, factor):
+    # PIL の Image.blend(base, image, factor) と同じ式 (float32・範囲外は切り詰め・切り捨て)
+    out = (curve.astype(np.float32) - np.float32(base)) * np.float32(factor)
+    out += np.float32(base)
+    return np.trunc(np.clip(out, 0, 255)).astype(np.uint8)
+
+
+@functools.lru_cache(maxsize=64)
+def brightness_curve(brightness):
+    """明るさの 1D LUT (入力の値 0〜255 → 出力の値)"""
+    curve = _blend_curve(np.arange(256), 0, brightness)
+    curve.flags.writeable = False
+    return curve
+
+
+@functools.lru_cache(maxsize=64)
+def channel_curve(brightness=1.0, contrast=1.0, mean=0):
+    """明るさ → コントラスト (平均輝度 mean) を合成した 1D LUT"""
+    curve = brightness_curve(brightness)
+    if contrast != 1.0:
+        curve = _blend_curve(curve, mean, contrast)
+    curve.flags.writeable = False
+    return curve
+
+
+def contrast_mean(img, brightness=1.0):
+    """明るさを適用した後の画像の平均輝度 (ImageEnhance.Contrast と同じ丸め)"""
+    if brightness != 1.0:
+        img = img.point(brightness_curve(brightness).tolist() * len(img.getbands()))
+    return int(ImageStat.Stat(img.convert("L")).mean[0] + 0.5)
+
+
+# --- 3D LUT ---
+def _grid(size):
+    """格子点の色 (size^3 × 3, 0〜1)。.cube と同じく R が最も速く変わる順"""
+    levels = np.linspace(0.0, 1.0, size)
+    b, g, r = np.meshgrid(levels, levels, levels, indexing="ij")
+    return np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1)
+
+
+def _table(lut):
+    """Color3DLUT の表を (size^3 × 3) の float 配列にする"""
+    return np.asarray(lut.table, dtype=np.float64).reshape(-1, lut.channels)[:, :3]
+
+
+def sample(lut, colors):
+    """3D LUT を任意の色 (N × 3, 0〜1) で三線形補間して引く"""
+    size = lut.size[0]
+    table = _table(lut)
+    pos = np.clip(colors, 0.0, 1.0) * (size - 1)
+    lo = np.minimum(np.floor(pos).astype(np.int64), size - 2)
+    frac = pos - lo
+    out = np.zeros((len(colors), 3))
+    for corner in range(8):
+        offset = [(corner >> axis) & 1 for axis in range(3)]
+        idx = lo + offset
+        weight = np.prod(
+            [frac[:, a] if offset[a] else 1 - frac[:, a] for a in range(3)], axis=0
+        )
+        flat = idx[:, 0] + idx[:, 1] * size + idx[:, 2] * size * size
+        out += table[flat] * weight[:, None]
+    return out
+
+
+def _saturate(colors, saturation):
+    luma = (colors @ LUMA_WEIGHTS)[:, None]
+    return np.clip(luma + (colors - luma) * saturation, 0.0, 1.0)
+
+
+@functools.lru_cache(maxsize=16)
+def compile_lut(
+    brightness=1.0, contrast=1.0, saturation=1.0, mean=0, look=None, size=LUT_SIZE
+):
+    """明るさ → コントラスト → 彩度 → 取り込んだ LUT (.cube の文字列) を1つの 3D LUT にする
+
+    mean はコントラストの基準にする平均輝度 (contrast_mean() の値) です。
+    """
+    colors = _grid(size)
+    if brightness != 1.0:
+        colors = np.clip(colors * brightness, 0.0, 1.0)
+    if contrast != 1.0:
+        base = mean / 255
+        colors = np.clip(base + (colors - base) * contrast, 0.0, 1.0)
+    if saturation != 1.0:
+        colors = _saturate(colors, saturation)
+    if look is not None:
+        colors = sample(parse_cube(look), colors)
+    return ImageFilter.Color3DLUT(size, colors.ravel().tolist())
+
+
+def apply_lut_array(arr, lut):
+    """3D LUT を uint8 の RGB 配列 (H×W×3) に適用した配列を返す"""
+    return np.asarray(Image.fromarray(arr, "RGB").filter(lut))
+
+
+# --- 公開関数 ---
+def adjust_colors(img, brightness=1.0, contrast=1.0, saturation=1.0, look=None):
+    """明るさ・コントラスト・彩度と取り込んだ LUT (.cube の文字列) を適用する
+
+    look が None なら、ImageEnhance の Brightness → Contrast → Color を順に適用した
+    結果とビット単位で同じです。
+    """
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    if brightness != 1.0 or contrast != 1.0:
+        mean = contrast_mean(img, brightness) if contrast != 1.0 else 0
+        img = img.point(channel_curve(brightness, contrast, mean).tolist() * 3)
+    if look is not None:
+        return img.filter(compile_lut(saturation=saturation, look=look))
+    if saturation != 1.0:
+        img = ImageEnhance.Color(img).enhance(saturation)
+    return img
+
+
+# --- .cube 形式 ---
+def cube_id(text):
+    """.cube の内容を表す短い文字列 (ログ用)"""
+    return "cube:" + hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+
+
+def to_cube(lut, title=None):
+    """3D LUT を .cube 形式 (Adobe / Resolve 互換) の文字列にする"""
+    lines = []
+    if title:
+        lines.append(f'TITLE "{title}"')
+    lines.append(f"LUT_3D_SIZE {lut.size[0]}")
+    lines.append("DOMAIN_MIN 0.0 0.0 0.0")
+    lines.append("DOMAIN_MAX 1.0 1.0 1.0")
+    lines.extend(f"{r:.6f} {g:.6f} {b:.6f}" for r, g, b in np.clip(_table(lut), 0, 1))
+    return "\n".join(lines) + "\n"
+
+
+@functools.lru_cache(maxsize=8)
+def parse_cube(text):
+    """.cube 形式の文字列を 3D LUT (ImageFilter.Color3DLUT) にする
+
+    入力の範囲 (DOMAIN_MIN / DOMAIN_MAX) は 0〜1 のものだけに対応します。
+    形式が正しくない場合は ValueError を送出します。
+    """
+    size = None
+    domain = [[0.0] * 3, [1.0] * 3]
+    values = []
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        keyword = line.split(None, 1)[0]
+        if re.match(r"[A-Za-z_]", keyword):
+            if keyword == "LUT_1D_SIZE":
+                raise ValueError("1D LUT の .cube には対応していません")
+            fields = line.split()[1:]
+            try:
+                if keyword == "LUT_3D_SIZE":
+                    size = int(fields[0])
+                elif keyword == "DOMAIN_MIN":
+                    domain[0] = [float(v) for v in fields[:3]]
+                elif keyword == "DOMAIN_MAX":
+                    domain[1] = [float(v) for v in fields[:3]]
+                elif keyword == "LUT_3D_INPUT_RANGE":
+                    low, high = float(fields[0]), float(fields[1])
+                    domain = [[low] * 3, [high] * 3]
+            except (IndexError, ValueError):
+                raise ValueError(f"{number}行目の {keyword} を読み取れません") from None
+            continue  # TITLE など、色に関係しないキーワードは無視する
+        try:
+            rgb = [float(v) for v in line.split()]
+        except ValueError:
+            raise ValueError(f"{number}行目を読み取れません: {line[:40]}") from None
+        if len(rgb) != 3:
+            raise ValueError(f"{number}行目の値が3つではありません: {line[:40]}")
+        values.append(rgb)
+    if size is None:
+        raise ValueError("LUT_3D_SIZE がありません")
+    if not MIN_LUT_SIZE <= size <= MAX_LUT_SIZE:
+        raise ValueError(
+            f"LUT_3D_SIZE は {MIN_LUT_SIZE}〜{MAX_LUT_SIZE} に対応しています: {size}"
+        )
+    if domain != [[0.0] * 3, [1.0] * 3]:
+        raise ValueError("入力の範囲 (DOMAIN) が 0〜1 以外の LUT には対応していません")
+    if len(values) != size**3:
+        raise ValueError(
+            f"値の数が LUT_3D_SIZE と合いません ({len(values)} 行 / {size**3} 行)"
+        )
+    return ImageFilter.Color3DLUT(size, np.asarray(values).ravel().tolist())
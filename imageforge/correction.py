@@ -0,0 +1,286 @@
+# imageforge/correction.py
+"""AIイラスト補正ツールの画像処理関数
+
+pages/3_Illustration_correction.py と imageforge.batch (CLI) の両方から利用します。
+同じ params と seed を与えれば、ページと CLI でビット単位で同じ結果になります。
+"""
+import threading
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from imageforge import cache, colorlut, lens, metrics, scheduler
+from imageforge.quantize import apply_kmeans_fast
+
+# --- デフォルトパラメータ (サイドバーのスライダー初期値と同じ) ---
+DEFAULT_PARAMS = {
+    "noise_strength": 0.03,
+    "brightness": 1.0,
+    "contrast": 0.98,
+    "saturation": 0.95,
+    "sharpness": 0.4,
+    "chromatic_aberration": 0.4,
+    "vignette_strength": 0.15,
+    "use_kmeans": False,
+    "k_value": 24,
+    "kmeans_mode": "exact",  # "exact" (全画素で学習) / "fast" (ヒストグラム学習)
+    "aberration_mode": "shift",  # "shift" (水平シフト) / "radial" (放射状)
+    "color_lut": None,  # 彩度の後に適用する 3D LUT (.cube の内容の文字列)
+}
+
+
+# --- 画像処理関数 ---
+def add_noise(img_pil, strength=0.05, rng=None):
+    """一様ノイズを加える (rng 未指定時はグローバルな np.random を使用)"""
+    rand = np.random.rand if rng is None else rng.rand
+    img_np = np.array(img_pil).astype(np.float32) / 255.0
+    noise = (rand(*img_np.shape) - 0.5) * (strength * 2)
+    noisy_img = np.clip(img_np + noise, 0, 1)
+    return Image.fromarray((noisy_img * 255).astype(np.uint8))
+
+
+def add_chromatic_aberration(img_pil, strength=1, mode="shift", scale=1.0):
+    """色収差 (処理は imageforge.lens、remap テーブルはキャッシュされる)"""
+    if strength <= 0:
+        return img_pil
+    img_np = np.array(img_pil)
+    return Image.fromarray(
+        lens.apply_chromatic_aberration(img_np, strength, mode, scale)
+    )
+
+
+def apply_kmeans(img_bgr, k=24):
+    # scikit-learn は import だけで1秒以上かかるので、K-Means を使うときに読み込む
+    from sklearn.cluster import KMeans
+
+    with metrics.stage("bilateral_filter"):
+        img_filtered = cv2.bilateralFilter(img_bgr, d=3, sigmaColor=15, sigmaSpace=15)
+    h, w, _ = img_filtered.shape
+    pixels = cv2.cvtColor(img_filtered, cv2.COLOR_BGR2RGB).reshape(-1, 3)
+    with metrics.stage("kmeans_fit"):
+        kmeans = KMeans(n_clusters=k, random_state=42, n_init=5, max_iter=200).fit(
+            pixels
+        )
+    centers = kmeans.cluster_centers_
+    labels = kmeans.labels_
+    new_img = centers[labels].reshape(h, w, 3).astype("uint8")
+    return cv2.cvtColor(new_img, cv2.COLOR_RGB2BGR)
+
+
+def add_vignette(img_pil, strength=0.3):
+    """周辺減光 (ゲインは画像サイズ・強度ごとに imageforge.lens でキャッシュされる)"""
+    img_np = np.array(img_pil)
+    return Image.fromarray(lens.apply_vignette(img_np, strength))
+
+
+def sharpness_sigma(sharpness_val, scale=1.0):
+    """シャープ化 (+) / ぼかし (-) に使うガウスぼかしの sigma。処理しない場合は None"""
+    if sharpness_val > 0:
+        return max(0.5, 1.5 - sharpness_val * 0.1) * scale
+    elif sharpness_val < 0:
+        sigma_val = abs(sharpness_val) * 0.8 + 0.5
+        if sigma_val > 0.3:
+            return sigma_val * scale
+    return None
+
+
+def apply_sharpness(img_bgr, sharpness_val, scale=1.0):
+    """シャープネス調整 (+:アンシャープマスク, -:ガウスぼかし)"""
+    sigma = sharpness_sigma(sharpness_val, scale)
+    if sigma is None:
+        return img_bgr
+    if sharpness_val > 0:
+        original_bgr = img_bgr.copy()
+        blurred = cv2.GaussianBlur(img_bgr, (0, 0), sigma)
+        sharpness_factor = 1.0 + sharpness_val * 0.3
+        img_bgr = cv2.addWeighted(
+            original_bgr, sharpness_factor, blurred, 1 - sharpness_factor, 0
+        )
+        return np.clip(img_bgr, 0, 255).astype(np.uint8)
+    return cv2.GaussianBlur(img_bgr, (0, 0), sigmaX=sigma)
+
+
+def params_for_log(params):
+    """ログ・metrics に出す params (LUT は .cube の内容の代わりに短いハッシュにする)"""
+    if params.get("color_lut") is None:
+        return params
+    return {**params, "color_lut": colorlut.cube_id(params["color_lut"])}
+
+
+def select_kmeans(params):
+    """params["kmeans_mode"] に応じた K-Means 関数を返す"""
+    if params.get("kmeans_mode", "exact") == "fast":
+        return apply_kmeans_fast
+    return apply_kmeans
+
+
+# --- パイプライン ---
+# 補正は次の順に実行する。各段階の結果は「前の段階の結果 + ここに挙げたパラメータ」
+# (と縮小率・ノイズのシード) だけで決まるので、StageMemo で段階ごとに再利用できる
+STAGES = (
+    ("noise", ("noise_strength",)),
+    ("color_adjust", ("brightness", "contrast", "saturation", "color_lut")),
+    ("kmeans", ("use_kmeans", "k_value", "kmeans_mode")),
+    ("sharpness", ("sharpness",)),
+    ("chromatic_aberration", ("chromatic_aberration", "aberration_mode")),
+    ("vignette", ("vignette_strength",)),
+)
+
+
+class StageMemo:
+    """補正の段階ごとに、直前の出力を1つずつ覚えておく (セッションごとに1つ作る)
+
+    スライダーを1つ動かしたときは、その段階と後ろの段階だけを再計算します。
+    覚えておくのは段階ごとに最新の1つだけなので、メモリは画像の枚数 (段階の数) で頭打ちです。
+    覚えた画像は process_image() の戻り値と共有するので、呼び出し側で書き換えないでください。
+
+    store (imageforge.artifacts.SessionArtifacts) を渡すと、画像はそこに預けます
+    (メモリの予算を超えるとディスクへ退避され、使うときに読み込み直されます)。
+    """
+
+    def __init__(self, store=None, prefix="stage_memo"):
+        self._entries = {}  # 段階の名前 -> (キー, 出力の画像 or None)
+        self._lock = threading.Lock()
+        self._store = store
+        self._prefix = prefix
+
+    def get(self, name, key):
+        with self._lock:
+            entry = self._entries.get(name)
+        if entry is None or entry[0] != key:
+            return None
+        if self._store is not None:
+            return self._store.get(f"{self._prefix}/{name}")
+        return entry[1]
+
+    def put(self, name, key, image):
+        with self._lock:
+            if self._store is not None:
+                self._store.put(f"{self._prefix}/{name}", image)
+                image = None
+            self._entries[name] = (key, image)
+
+    def clear(self):
+        with self._lock:
+            if self._store is not None:
+                for name in self._entries:
+                    self._store.put(f"{self._prefix}/{name}", None)
+            self._entries.clear()
+
+
+def _is_noop(name, params):
+    if name == "noise":
+        return params["noise_strength"] <= 0
+    if name == "kmeans":
+        return not params["use_kmeans"]
+    if name == "chromatic_aberration":
+        return params["chromatic_aberration"] <= 0
+    if name == "vignette":
+        return params["vignette_strength"] <= 0
+    return False
+
+
+def _stage_key(prev_key, name, depends, params, seed, scale):
+    """段階の出力のキー (ノイズのシードが決まらない場合は None = 再利用しない)"""
+    if prev_key is None:
+        return None
+    stage_params = {p: params.get(p) for p in depends}
+    if name == "noise" and not _is_noop(name, params):
+        if seed is None:
+            return None
+        stage_params["seed"] = seed
+    return cache.make_key(prev_key, f"correction_{name}", scale=scale, **stage_params)
+
+
+def stage_input_key(input_key, name, params, seed=None, scale=1.0):
+    """段階 name の入力 (その前の段階までの出力) のキー (決まらない場合は None)"""
+    key = input_key
+    for stage, depends in STAGES:
+        if stage == name:
+            return key
+        key = _stage_key(key, stage, depends, params, seed, scale)
+    raise ValueError(f"未知の段階です: {name}")
+
+
+def _run_stage(name, img_pil, params, rng, kmeans_fn, scale):
+    if name == "noise":
+        return add_noise(img_pil, params["noise_strength"] * scale, rng=rng)
+    if name == "color_adjust":
+        return colorlut.adjust_colors(
+            img_pil,
+            params["brightness"],
+            params["contrast"],
+            params["saturation"],
+            params.get("color_lut"),
+        )
+    if name == "kmeans":
+        img_bgr = cv2.cvtColor(np.array(img_pil), cv2.COLOR_RGB2BGR)
+        img_bgr = kmeans_fn(img_bgr, params["k_value"])
+        return Image.fromarray(cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB))
+    if name == "sharpness":
+        if sharpness_sigma(params["sharpness"], scale) is None:
+            return img_pil
+        img_bgr = cv2.cvtColor(np.array(img_pil), cv2.COLOR_RGB2BGR)
+        img_bgr = apply_sharpness(img_bgr, params["sharpness"], scale)
+        return Image.fromarray(cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB))
+    if name == "chromatic_aberration":
+        return add_chromatic_aberration(
+            img_pil,
+            params["chromatic_aberration"],
+            params.get("aberration_mode", "shift"),
+            scale,
+        )
+    if name == "vignette":
+        return add_vignette(img_pil, params["vignette_strength"])
+    raise ValueError(f"未知の段階です: {name}")
+
+
+def process_image(
+    img_pil,
+    params,
+    seed=None,
+    kmeans_fn=None,
+    scale=1.0,
+    memo=None,
+    input_key=None,
+):
+    """補正パイプライン全体を実行する
+
+    seed を指定するとノイズが再現可能になります (None なら従来どおり毎回ランダム)。
+    kmeans_fn にはキャッシュ付きの apply_kmeans などを差し替えられます。
+    scale には、img_pil がプレビュー用に縮小した画像の場合の縮小率を渡します。
+    ぼかしの sigma、色収差のずれ量、ノイズの強さ (縮小で平均化される分) を
+    フル解像度での見た目に合わせて換算します。
+
+    memo (StageMemo) と input_key (img_pil の内容を表すキー) を渡すと、段階ごとの出力を
+    再利用し、パラメータが変わった段階から後ろだけを計算します。ノイズを加える場合は
+    seed も必要です (None だと結果が毎回変わるので、ノイズ以降は再利用しません)。
+
+    各段階の時間とメモリは imageforge.metrics.record() の中で呼ばれた場合に記録されます。
+    imageforge.scheduler で実行した場合は、各段階の前で取り消しを確認します。
+    """
+    if kmeans_fn is None:
+        kmeans_fn = select_kmeans(params)
+    rng = None if seed is None else np.random.RandomState(seed)
+    metrics.annotate(width=img_pil.width, height=img_pil.height)
+    key = input_key if memo is not None else None
+    processed_img = img_pil
+    for name, depends in STAGES:
+        key = _stage_key(key, name, depends, params, seed, scale)
+        if _is_noop(name, params):
+            continue
+        cached = None if key is None else memo.get(name, key)
+        if cached is not None:
+            metrics.count("stage_memo_hits")
+            processed_img = cached
+            continue
+        scheduler.checkpoint()
+        with metrics.stage(name):
+            processed_img = _run_stage(
+                name, processed_img, params, rng, kmeans_fn, scale
+            )
+        if key is not None:
+            memo.put(name, key, processed_img)
+    # すべての段階を飛ばした場合も、入力とは別の画像を返す
+    return processed_img.copy() if processed_img is img_pil else processed_img
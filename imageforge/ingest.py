@@ -0,0 +1,175 @@
+# imageforge/ingest.py
+"""アップロードされた画像の読み込み (ヘッダーの確認・縮小デコード・EXIF の向き)
+
+各ページ・バッチ・HTTP サーバーは、画像のバイト列をここでデコードします。
+
+- 先にヘッダーだけを読んで形式・サイズ・向きを確かめ、画素数が上限
+  (IMAGEFORGE_MAX_PIXELS) を超える画像はデコードせずに ImageTooLarge で断ります
+  (小さなファイルに巨大な画像を詰めた「解凍爆弾」でメモリを使い切らないため)。
+- 表示やモデルの入力など、元より小さい画像で足りる場合は max_size (長辺 px) を渡すと、
+  JPEG は DCT の段階で 1/2・1/4・1/8 に縮小してデコードします (PIL の draft モード)。
+  結果の長辺は max_size 以上なので、必要なら呼び出し側でさらに縮小します。
+- EXIF の向き (Orientation) を適用し、スマートフォンの写真も見た目どおりの向きにします。
+- decode_array() は OpenCV で NumPy の配列へ直接デコードします (PIL の画像を経由しないので、
+  フル解像度のコピーが1つ少なくて済みます)。
+- デコードの時間・縮小率などは戻り値の info と、metrics の "decode" 段階に記録します。
+
+環境変数で設定できます:
+    IMAGEFORGE_MAX_PIXELS   デコードする画像の画素数の上限 (デフォルト: 6400万画素)
+"""
+import math
+import os
+import time
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+from imageforge import metrics
+
+# --- 定数 ---
+DEFAULT_MAX_PIXELS = 64_000_000  # 8000×8000 (RGB で約 190MB)
+REDUCE_FACTORS = (8, 4, 2)  # JPEG を縮小してデコードできる倍率
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)  # 縦横が入れ替わる EXIF の向き
+EXIF_ORIENTATION = 0x0112
+CV2_REDUCED_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+class ImageTooLarge(ValueError):
+    """画素数が上限を超えている"""
+
+
+def max_pixels():
+    """環境変数 IMAGEFORGE_MAX_PIXELS の画素数の上限"""
+    try:
+        value = int(os.environ.get("IMAGEFORGE_MAX_PIXELS", 0))
+    except ValueError:
+        value = 0
+    return value if value > 0 else DEFAULT_MAX_PIXELS
+
+
+# --- ヘッダー ---
+def _header(img):
+    orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+    w, h = img.size
+    if orientation in TRANSPOSED_ORIENTATIONS:
+        w, h = h, w
+    return {
+        "format": img.format,
+        "mode": img.mode,
+        "width": w,  # 向きを適用した後のサイズ
+        "height": h,
+        "orientation": orientation,
+        "frames": getattr(img, "n_frames", 1),
+    }
+
+
+def _check_pixels(info, limit):
+    limit = max_pixels() if limit is None else limit
+    pixels = info["width"] * info["height"]
+    if pixels > limit:
+        raise ImageTooLarge(
+            f"画像が大きすぎます ({info['width']}×{info['height']} ="
+            f" {pixels / 1e6:.1f}M画素。上限は {limit / 1e6:.1f}M画素です)"
+        )
+
+
+def _open(data):
+    try:
+        return Image.open(BytesIO(data))
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e)) from None
+
+
+def probe(data, limit=None):
+    """ヘッダーだけを読んで形式・サイズ (向きを適用した後)・向き・フレーム数を返す
+
+    画素数が上限を超えていれば ImageTooLarge、画像として読めなければ OSError を送出します。
+    """
+    with _open(data) as img:
+        info = _header(img)
+    _check_pixels(info, limit)
+    return info
+
+
+def reduce_factor(info, max_size):
+    """長辺 max_size px 以上を保ったまま JPEG を縮小デコードできる倍率 (1 なら縮小しない)"""
+    if not max_size or info["format"] != "JPEG":
+        return 1
+    long_side = max(info["width"], info["height"])
+    for factor in REDUCE_FACTORS:
+        if math.ceil(long_side / factor) >= max_size:
+            return factor
+    return 1
+
+
+# --- デコード ---
+def decode(data, max_size=None, limit=None):
+    """画像のバイト列を RGB の PIL 画像にデコードし、(画像, info) を返す
+
+    max_size (長辺 px) を渡すと、JPEG は長辺が max_size 以上になる範囲で縮小してデコードします。
+    info はヘッダーの情報に、デコードした倍率 (reduce)・時間 (seconds) を加えたものです。
+    """
+    start = time.perf_counter()
+    with metrics.stage("decode"):
+        img = _open(data)
+        info = _header(img)
+        _check_pixels(info, limit)
+        factor = reduce_factor(info, max_size)
+        if factor > 1:
+            w, h = img.size  # 保存されている向きのサイズ
+            img.draft("RGB", (math.ceil(w / factor), math.ceil(h / factor)))
+        # 向きの適用・RGB への変換は必要なときだけ行う (不要なコピーを作らない)
+        if info["orientation"] != 1:
+            ImageOps.exif_transpose(img, in_place=True)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        else:
+            img.load()
+    info["reduce"] = factor
+    info["seconds"] = time.perf_counter() - start
+    metrics.annotate(decode_reduce=factor)
+    return img, info
+
+
+def decode_array(data, max_size=None, limit=None):
+    """画像のバイト列を RGB の NumPy 配列 (H×W×3, uint8) にデコードし、(配列, info) を返す
+
+    OpenCV が読めない形式 (GIF など) は PIL でデコードして配列にします。
+    """
+    start = time.perf_counter()
+    with _open(data) as img:
+        info = _header(img)
+    _check_pixels(info, limit)
+    factor = reduce_factor(info, max_size)
+    with metrics.stage("decode"):
+        buf = np.frombuffer(data, dtype=np.uint8)
+        # IMREAD_COLOR は EXIF の向きも適用する
+        arr = cv2.imdecode(buf, CV2_REDUCED_FLAGS.get(factor, cv2.IMREAD_COLOR))
+        if arr is not None:
+            cv2.cvtColor(arr, cv2.COLOR_BGR2RGB, dst=arr)
+    if arr is None:
+        img, info = decode(data, max_size, limit)
+        return np.array(img), info  # 書き換えられる配列にする
+    info["reduce"] = factor
+    info["seconds"] = time.perf_counter() - start
+    metrics.annotate(decode_reduce=factor)
+    return arr, info
+
+
+def describe(info):
+    """info を表示用の1行にする"""
+    text = (
+        f"{info['format'] or '?'} {info['width']}×{info['height']}"
+        f" / 読み込み {info['seconds'] * 1000:.0f}ms"
+    )
+    if info.get("reduce", 1) > 1:
+        text += f" (1/{info['reduce']} に縮小してデコード)"
+    if info["orientation"] != 1:
+        text += " / EXIF の向きを適用"
+    return text
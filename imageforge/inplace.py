@@ -0,0 +1,328 @@
+# imageforge/inplace.py
+"""process_image() の省メモリ実行モード
+
+画像全体を1枚の uint8 RGB 作業バッファ (H×W×3) に読み込み、すべての段をその上で
+インプレースに実行します。画素ごとの演算は数百行ずつの帯 (バンド) 単位で
+float32 / float64 の小さな一時領域を使って計算するため、追加メモリは画像サイズではなく
+バンドサイズ (band_bytes) で抑えられます。
+
+従来の process_image() との差:
+    - ノイズ・明るさ・コントラスト・彩度・色収差・ビネットは PIL / NumPy と同じ式・同じ
+      丸め (切り捨て) で計算するため、通常は完全一致します。取り込んだ LUT (color_lut) は
+      彩度と合成した同じ 3D LUT をバンドごとに適用するので、これも一致します。
+    - シャープネス / ぼかしはバンド境界にカーネル半径ぶんののりしろを付けて計算するため
+      一致します。
+    - 許容誤差は各チャンネル ±1 (MAX_ABS_DIFF) とします。浮動小数点の演算順序が
+      ビルドによって異なる場合に限り、この範囲の差が出ることがあります。
+    - K-Means を有効にした場合、scikit-learn が内部で画素配列のコピーを確保するため、
+      その段だけは省メモリになりません。
+"""
+import math
+import tracemalloc
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from imageforge import colorlut, lens, metrics, scheduler
+from imageforge.correction import select_kmeans, sharpness_sigma
+
+# --- 定数 ---
+BAND_BYTES = 8 * 1024 * 1024  # 一時領域1つあたりの目安
+MAX_ABS_DIFF = 1  # 従来パスとの許容誤差 (各チャンネル)
+
+
+# --- 内部ヘルパー ---
+def _band_rows(width, bytes_per_value, band_bytes):
+    return max(1, band_bytes // max(1, width * 3 * bytes_per_value))
+
+
+def _bands(height, rows):
+    for y0 in range(0, height, rows):
+        yield y0, min(height, y0 + rows)
+
+
+def _luma(band):
+    """PIL の convert("L") と同じ整数演算で輝度を求める"""
+    r = band[..., 0].astype(np.int32)
+    g = band[..., 1].astype(np.int32)
+    b = band[..., 2].astype(np.int32)
+    return (r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16
+
+
+def _blend(out, base, factor):
+    """PIL の Image.blend(base, out, factor) と同じ式 (float32・切り捨て)
+
+    out と base は float32 で、結果は out に書き込まれます。
+    """
+    out -= base
+    out *= np.float32(factor)
+    out += base
+    np.clip(out, 0, 255, out=out)
+    np.trunc(out, out=out)
+
+
+def gaussian_radius(sigma):
+    # OpenCV が 8bit 画像で用いるカーネルサイズ (cvRound(sigma*3*2+1)|1) の半径
+    ksize = int(round(sigma * 6 + 1)) | 1
+    return ksize // 2
+
+
+def _blur_inplace(work, sigma, band_bytes, combine=None):
+    """作業バッファをバンド単位でガウスぼかしする
+
+    各バンドは上下にカーネル半径ぶんののりしろを付けて読み出し、書き戻しを
+    1バンド遅らせることで、次のバンドが元の画素をのりしろとして読めるようにします。
+    combine(元画素, ぼかし結果) を渡すと、その戻り値を書き戻します (シャープ化用)。
+    """
+    h, w, _ = work.shape
+    halo = gaussian_radius(sigma)
+    rows = _band_rows(w, 1, band_bytes)
+    pending = None
+    for y0, y1 in _bands(h, rows):
+        top, bottom = max(0, y0 - halo), min(h, y1 + halo)
+        blurred = cv2.GaussianBlur(work[top:bottom], (0, 0), sigma)
+        blurred = blurred[y0 - top : y0 - top + (y1 - y0)]
+        if combine is not None:
+            blurred = combine(work[y0:y1], blurred)
+        if pending is not None:
+            py0, py1, result = pending
+            work[py0:py1] = result
+        pending = (y0, y1, blurred)
+    if pending is not None:
+        py0, py1, result = pending
+        work[py0:py1] = result
+
+
+def _load_work_buffer(img_pil, band_bytes):
+    """PIL 画像をバンドごとに作業バッファへ読み込む (全体のバイト列を一度に作らない)"""
+    w, h = img_pil.size
+    work = np.empty((h, w, 3), dtype=np.uint8)
+    for y0, y1 in _bands(h, _band_rows(w, 1, band_bytes)):
+        work[y0:y1] = np.asarray(img_pil.crop((0, y0, w, y1)))
+    return work
+
+
+# --- バンド単位の画素演算 (imageforge.tiling からも利用) ---
+def noise_brightness_band(band, params, rand):
+    """1パス目: ノイズと明るさをバンドに適用し、バンドの輝度合計を返す
+
+    rand は np.random.rand 互換の関数で、バンドを上から順に渡せば
+    従来と同じ乱数列を消費します。
+    """
+    h, w, _ = band.shape
+    noise_strength = params["noise_strength"]
+    if noise_strength > 0:
+        # 従来と同じく float64 の乱数列を行順に消費する
+        noise = (rand(h, w, 3) - 0.5) * (noise_strength * 2)
+        noise += band.astype(np.float32) / np.float32(255.0)
+        np.clip(noise, 0, 1, out=noise)
+        noise *= 255
+        band[...] = noise.astype(np.uint8)
+    if params["brightness"] != 1.0:
+        tmp = band.astype(np.float32)
+        _blend(tmp, np.float32(0), params["brightness"])
+        band[...] = tmp
+    if params["contrast"] != 1.0:
+        return int(_luma(band).sum())
+    return 0
+
+
+def contrast_mean(luma_sum, pixel_count):
+    """ImageEnhance.Contrast と同じ丸めで画像全体の平均輝度を求める"""
+    return int(luma_sum / pixel_count + 0.5)
+
+
+def contrast_saturation_band(band, params, mean):
+    """2パス目: コントラスト (全体の平均輝度 mean を使用) と彩度 (と LUT) をバンドに適用する"""
+    if params["contrast"] != 1.0:
+        tmp = band.astype(np.float32)
+        _blend(tmp, np.float32(mean), params["contrast"])
+        band[...] = tmp
+    if params.get("color_lut") is not None:
+        lut = colorlut.compile_lut(
+            saturation=params["saturation"], look=params["color_lut"]
+        )
+        band[...] = colorlut.apply_lut_array(band, lut)
+    elif params["saturation"] != 1.0:
+        tmp = band.astype(np.float32)
+        _blend(tmp, _luma(band)[..., None].astype(np.float32), params["saturation"])
+        band[...] = tmp
+
+
+# --- 各段 ---
+def _point_stages(work, params, rng, band_bytes):
+    """ノイズ・明るさ・コントラスト・彩度をバンド単位で適用する"""
+    h, w, _ = work.shape
+    rows = _band_rows(w, 8, band_bytes)
+    rand = np.random.rand if rng is None else rng.rand
+
+    # 1パス目: ノイズと明るさ、コントラスト用の輝度合計
+    # (明るさもこのパスで適用するので、時間は "noise" の段階に含まれる)
+    luma_sum = 0
+    with metrics.stage("noise"):
+        for y0, y1 in _bands(h, rows):
+            luma_sum += noise_brightness_band(work[y0:y1], params, rand)
+
+    # 2パス目: コントラストと彩度
+    if (
+        params["contrast"] == 1.0
+        and params["saturation"] == 1.0
+        and params.get("color_lut") is None
+    ):
+        return
+    mean = contrast_mean(luma_sum, h * w) if params["contrast"] != 1.0 else 0
+    with metrics.stage("color_adjust"):
+        for y0, y1 in _bands(h, rows):
+            contrast_saturation_band(work[y0:y1], params, mean)
+
+
+def _sharpness_stage(work, sharpness_val, band_bytes):
+    sigma = sharpness_sigma(sharpness_val)
+    if sigma is None:
+        return
+    combine = None
+    if sharpness_val > 0:
+        sharpness_factor = 1.0 + sharpness_val * 0.3
+
+        def combine(original, blurred):
+            return cv2.addWeighted(
+                original, sharpness_factor, blurred, 1 - sharpness_factor, 0
+            )
+
+    _blur_inplace(work, sigma, band_bytes, combine)
+
+
+def _chromatic_aberration_stage(work, strength, mode, band_bytes):
+    h, w, _ = work.shape
+    if mode == "radial":
+        _radial_aberration_stage(work, strength, band_bytes)
+        return
+    offset = lens.aberration_offset(w, h, strength)
+    rows = _band_rows(w, 4, band_bytes)
+    for y0, y1 in _bands(h, rows):
+        # R は左へ、B は右へ (ImageChops.offset と同じく端は折り返し)
+        for channel, shift in ((0, -offset), (2, offset)):
+            plane = work[y0:y1, :, channel]
+            plane[...] = lens.blend_channel(plane, np.roll(plane, shift, axis=1))
+
+
+def _radial_aberration_stage(work, strength, band_bytes):
+    """放射状の色収差をバンド単位で適用する
+
+    上下方向にもずれるため、各バンドは上下に最大のずれ + 2 行ののりしろを付けて remap します。
+    バンドは上から順に書き戻すので、上ののりしろは書き換える前の行を取っておいて使います。
+    remap テーブルもバンドごとに作るので、追加メモリはバンドサイズで抑えられます。
+    """
+    h, w, _ = work.shape
+    halo = int(math.ceil(lens.radial_max_shift(w, h, strength))) + 2
+    rows = max(halo, _band_rows(w, 8, band_bytes))
+    saved = {0: None, 2: None}  # チャンネル -> 書き換える前の、次のバンドの上ののりしろ
+    for y0, y1 in _bands(h, rows):
+        top, bottom = max(0, y0 - halo), min(h, y1 + halo)
+        maps = lens.radial_maps_rows(w, h, strength, y0, y1, row_offset=top)
+        for channel, (map_x, map_y) in zip((0, 2), maps):
+            src = work[y0:bottom, :, channel]
+            if saved[channel] is not None:
+                src = np.concatenate([saved[channel], src])
+            src = np.ascontiguousarray(src)
+            # 全体を一度に処理する場合と同じ固定小数点テーブルに変換してから remap する
+            map1, map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+            warped = cv2.remap(
+                src, map1, map2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT
+            )
+            saved[channel] = src[max(0, y1 - halo) - top : y1 - top].copy()
+            work[y0:y1, :, channel] = lens.blend_channel(
+                src[y0 - top : y1 - top], warped
+            )
+
+
+def _vignette_stage(work, strength, band_bytes):
+    h, w, _ = work.shape
+    rows = _band_rows(w, 8, band_bytes)
+    gain = lens.vignette_gain(w, h, strength)
+    for y0, y1 in _bands(h, rows):
+        band = work[y0:y1]
+        band[...] = (band * gain[y0:y1]).astype(np.uint8)
+
+
+# --- 公開関数 ---
+def process_image_inplace(
+    img_pil, params, seed=None, kmeans_fn=None, band_bytes=BAND_BYTES
+):
+    """process_image() と同じ補正を1枚の作業バッファ上で実行する
+
+    img_pil には RGB の uint8 配列 (H×W×3, ingest.decode_array() の結果など) も渡せます。
+    その場合は配列をそのまま作業バッファとして書き換えます (コピーを作らない)。
+
+    戻り値は (補正後の PIL Image, 統計情報の dict) です。統計情報には tracemalloc で
+    計測した NumPy 側の最大確保量 peak_bytes と、画像1枚ぶんのサイズ image_bytes が入ります。
+    各段階の時間は process_image() と同じ段階名で imageforge.metrics に記録されます。
+    """
+    if kmeans_fn is None:
+        kmeans_fn = select_kmeans(params)
+    with PeakTracker() as tracker:
+        rng = None if seed is None else np.random.RandomState(seed)
+        if isinstance(img_pil, np.ndarray):
+            work = img_pil
+        else:
+            work = _load_work_buffer(img_pil.convert("RGB"), band_bytes)
+        _point_stages(work, params, rng, band_bytes)
+        if params["use_kmeans"]:
+            scheduler.checkpoint()
+            with metrics.stage("kmeans"):
+                bgr = cv2.cvtColor(work, cv2.COLOR_RGB2BGR)
+                bgr = kmeans_fn(bgr, params["k_value"])
+                cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=work)
+                del bgr
+        scheduler.checkpoint()
+        with metrics.stage("sharpness"):
+            _sharpness_stage(work, params["sharpness"], band_bytes)
+        if params["chromatic_aberration"] > 0:
+            scheduler.checkpoint()
+            with metrics.stage("chromatic_aberration"):
+                _chromatic_aberration_stage(
+                    work,
+                    params["chromatic_aberration"],
+                    params.get("aberration_mode", "shift"),
+                    band_bytes,
+                )
+        if params["vignette_strength"] > 0:
+            with metrics.stage("vignette"):
+                _vignette_stage(work, params["vignette_strength"], band_bytes)
+        result = Image.fromarray(work)
+    stats = {
+        "peak_bytes": tracker.peak,
+        "image_bytes": work.nbytes,
+        "peak_ratio": tracker.peak / work.nbytes if work.nbytes else math.nan,
+    }
+    return result, stats
+
+
+def measure_peak(fn, *args, **kwargs):
+    """任意の関数を実行し、(戻り値, NumPy 側の最大確保バイト数) を返す
+
+    従来の process_image() との比較用です。
+    """
+    with PeakTracker() as tracker:
+        result = fn(*args, **kwargs)
+    return result, tracker.peak
+
+
+class PeakTracker:
+    """tracemalloc で with ブロック内の最大確保量を測る (入れ子・既存のトレースにも対応)"""
+
+    def __enter__(self):
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start()
+        self._base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        self.peak = 0
+        return self
+
+    def __exit__(self, *exc):
+        self.peak = max(0, tracemalloc.get_traced_memory()[1] - self._base)
+        if self._started:
+            tracemalloc.stop()
+        return False
@@ -0,0 +1,223 @@
+# imageforge/lens.py
+"""ビネット・色収差などのレンズ効果
+
+画像サイズと強度だけで決まる幾何情報 (ビネットのゲイン、放射状色収差の remap テーブル) を
+(種類, 幅, 高さ, 強度) ごとにキャッシュします。同じサイズの画像を繰り返し処理する場合、
+2回目以降は幾何計算をすべて省略し、ゲインの乗算や remap だけを行います。
+キャッシュは合計バイト数の上限付き LRU で、古いものから破棄されます。
+"""
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+# --- 定数 ---
+GEOMETRY_CACHE_BYTES = 512 * 1024 * 1024
+ABERRATION_BLEND = 0.3  # 色ずれ画像を重ねる割合 (従来の Image.blend と同じ)
+ABERRATION_MODES = ("shift", "radial")
+
+
+class GeometryCache:
+    """合計バイト数に上限のある LRU キャッシュ (スレッドセーフ)"""
+
+    def __init__(self, max_bytes=GEOMETRY_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_create(self, key, factory):
+        """key のエントリを返す。無ければ factory() で作って登録する"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        value = factory()
+        size = _nbytes(value)
+        with self._lock:
+            if key not in self._entries and size <= self.max_bytes:
+                self._entries[key] = value
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    _, old = self._entries.popitem(last=False)
+                    self._bytes -= _nbytes(old)
+                    self.evictions += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def _nbytes(value):
+    if isinstance(value, tuple):
+        return sum(v.nbytes for v in value)
+    return value.nbytes
+
+
+geometry_cache = GeometryCache()
+
+
+# --- ビネット ---
+def vignette_gain_rows(w, h, strength, y0, y1):
+    """画像 (w×h) の y0〜y1 行ぶんのビネットゲイン (キャッシュしない、タイル処理用)"""
+    Y, X = np.ogrid[y0:y1, :w]
+    center_y, center_x = h / 2, w / 2
+    distance = np.sqrt((X - center_x) ** 2 + (Y - center_y) ** 2)
+    max_dist = np.sqrt((w / 2) ** 2 + (h / 2) ** 2)
+    vignette = 1.0 - strength * (distance / max_dist) ** 2
+    vignette = np.clip(vignette, 0.0, 1.0)
+    return vignette[..., None]
+
+
+def _make_vignette_gain(w, h, strength):
+    gain = vignette_gain_rows(w, h, strength, 0, h)
+    gain.flags.writeable = False
+    return gain
+
+
+def vignette_gain(w, h, strength):
+    """ビネットのゲイン (H×W×1, float64) をキャッシュから取得する"""
+    key = ("vignette", w, h, float(strength))
+    return geometry_cache.get_or_create(
+        key, lambda: _make_vignette_gain(w, h, strength)
+    )
+
+
+def apply_vignette(img_np, strength):
+    """uint8 RGB 配列にビネットをかける (ゲインとの乗算1回)"""
+    h, w = img_np.shape[:2]
+    return (img_np * vignette_gain(w, h, strength)).astype(np.uint8)
+
+
+# --- 色収差 ---
+def aberration_offset(w, h, strength):
+    """水平シフト量 (ピクセル) を従来と同じ式で求める"""
+    return max(1, int(strength * min(h, w) * 0.002))
+
+
+def blend_channel(plane, shifted_plane):
+    """Image.blend(元, 色ずれ, 0.3) と同じ式で1チャンネルを合成する (float32・切り捨て)"""
+    base = plane.astype(np.float32)
+    out = shifted_plane.astype(np.float32)
+    out -= base
+    out *= np.float32(ABERRATION_BLEND)
+    out += base
+    return out.astype(np.uint8)
+
+
+def roll_subpixel(plane, shift):
+    """水平方向に shift ピクセルずらす (端は折り返し、小数なら隣接2列を線形補間)"""
+    lower = int(np.floor(shift))
+    frac = shift - lower
+    if frac == 0:
+        return np.roll(plane, lower, axis=1)
+    out = np.roll(plane, lower, axis=1).astype(np.float32) * np.float32(1 - frac)
+    out += np.roll(plane, lower + 1, axis=1).astype(np.float32) * np.float32(frac)
+    return out
+
+
+def apply_channel_shift(img_np, strength, scale=1.0):
+    """R を左、B を右へずらして重ねる (端は折り返し、従来の ImageChops.offset と同じ)
+
+    scale < 1 はプレビュー用の縮小画像であることを表し、ずれ量はフル解像度で求めた
+    値を scale 倍した小数ピクセルになります。
+    """
+    h, w = img_np.shape[:2]
+    if scale == 1.0:
+        offset = aberration_offset(w, h, strength)
+    else:
+        offset = aberration_offset(round(w / scale), round(h / scale), strength) * scale
+    return shift_channels(img_np, offset)
+
+
+def shift_channels(img_np, offset):
+    """R を -offset、B を +offset ピクセル水平にずらして重ねる"""
+    out = img_np.copy()
+    for channel, shift in ((0, -offset), (2, offset)):
+        plane = img_np[..., channel]
+        out[..., channel] = blend_channel(plane, roll_subpixel(plane, shift))
+    return out
+
+
+def radial_max_shift(w, h, strength):
+    """放射状色収差の最大ずれ量 (画像の隅、ピクセル)"""
+    return strength * min(h, w) * 0.002
+
+
+def radial_maps_rows(w, h, strength, y0, y1, row_offset=0):
+    """画像 (w×h) の y0〜y1 行ぶんの remap テーブル (float32) を R, B の順に返す
+
+    row_offset を指定すると、参照先の y 座標からその値を引きます
+    (画像の一部だけを切り出して remap する場合に使います)。
+    """
+    # 画像の隅で aberration_offset と同程度 (サブピクセル) のずれになるよう、
+    # R は中心から外側へ、B は内側へ拡大・縮小する
+    radius = np.sqrt((w / 2) ** 2 + (h / 2) ** 2)
+    scale = radial_max_shift(w, h, strength) / radius
+    center_x, center_y = (w - 1) / 2, (h - 1) / 2
+    xs = (np.arange(w, dtype=np.float32) - center_x)[None, :]
+    ys = (np.arange(y0, y1, dtype=np.float32) - center_y)[:, None]
+    maps = []
+    for factor in (1 - scale, 1 + scale):  # R, B
+        map_x = np.broadcast_to(center_x + xs * factor, (y1 - y0, w))
+        map_y = np.broadcast_to(center_y + ys * factor, (y1 - y0, w))
+        # 整数の row_offset は float32 に変換した後で引く (全体処理と同じ値になる)
+        map_y = map_y.astype(np.float32) - np.float32(row_offset)
+        maps.append((map_x.astype(np.float32), map_y))
+    return maps
+
+
+def _make_radial_maps(w, h, strength):
+    maps = []
+    for map_x, map_y in radial_maps_rows(w, h, strength, 0, h):
+        # 固定小数点形式に変換しておくと remap が速くなる
+        maps.extend(cv2.convertMaps(map_x, map_y, cv2.CV_16SC2))
+    return tuple(maps)
+
+
+def radial_maps(w, h, strength):
+    """放射状色収差の remap テーブル (R 用 2枚, B 用 2枚) をキャッシュから取得する"""
+    key = ("radial", w, h, float(strength))
+    return geometry_cache.get_or_create(key, lambda: _make_radial_maps(w, h, strength))
+
+
+def apply_radial_aberration(img_np, strength):
+    """レンズ風の放射状色収差 (中心ほどずれが小さく、周辺ほど大きい)"""
+    h, w = img_np.shape[:2]
+    r_map1, r_map2, b_map1, b_map2 = radial_maps(w, h, strength)
+    out = img_np.copy()
+    for channel, map1, map2 in ((0, r_map1, r_map2), (2, b_map1, b_map2)):
+        plane = np.ascontiguousarray(img_np[..., channel])
+        warped = cv2.remap(
+            plane, map1, map2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT
+        )
+        out[..., channel] = blend_channel(plane, warped)
+    return out
+
+
+def apply_chromatic_aberration(img_np, strength, mode="shift", scale=1.0):
+    """mode に応じて水平シフトまたは放射状の色収差をかける
+
+    放射状のずれ量は画像サイズに比例するため scale による換算は不要です。
+    """
+    if mode == "radial":
+        return apply_radial_aberration(img_np, strength)
+    return apply_channel_shift(img_np, strength, scale)
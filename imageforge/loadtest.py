@@ -0,0 +1,574 @@
+# imageforge/loadtest.py
+"""同時セッションの負荷試験 (CLI)
+
+Streamlit のテスト用 API (streamlit.testing.v1.AppTest) で app.py と各ページを
+ブラウザなしで動かし、N 人の利用者が同時に「ページを開く → 画像をアップロードする →
+スライダーを動かす」を繰り返したときの再実行 (rerun) の時間を計測します。
+同時セッション数を段階的に増やし、それぞれについて次の値を報告します。
+
+- 再実行の時間の p50 / p95 / p99 (全体と、開く・アップロード・スライダーの種類別)
+- スループット (1秒あたりの再実行の回数)
+- サーバープロセスの RSS (開始時・最大・終了時)
+- 失敗した再実行の数 (例外・混雑で断られた処理・タイムアウト)
+
+AppTest はスクリプトを同じプロセスの中で実行するため、共有のスケジューラ・キャッシュ・
+背景除去モデルも実際のサーバーと同じように共有されます。スループットが伸びなくなる
+同時セッション数 (曲線の「膝」) を表示し、以前の結果を --baseline に渡すと、
+しきい値を超えて遅く (または処理量が少なく) なった同時セッション数を回帰として報告し、
+終了コード 1 を返します。
+
+使い方:
+    python -m imageforge.loadtest --concurrency 1 2 4 8 --output load.json
+    python -m imageforge.loadtest --pages 3_Illustration_correction.py --baseline load.json
+"""
+import argparse
+import collections
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+from imageforge import artifacts, bench, metrics, scheduler
+
+# --- 定数 ---
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGES = (
+    "app.py",
+    "pages/1_pixel_art_maker.py",
+    "pages/2_background_remover.py",
+    "pages/3_Illustration_correction.py",
+)
+CONCURRENCY = (1, 2, 4, 8)
+SIZES = (512, 1024, 2048)  # アップロードする画像の長辺 px (この中からランダムに選ぶ)
+ACTIONS = 5  # 1回の利用でスライダーを動かす回数
+ROUNDS = 2  # 1人の利用者が「開く → アップロード → スライダー」を繰り返す回数
+THINK = 0.0  # 操作の間に待つ秒数
+TIMEOUT = 300  # 1回の再実行の上限 (秒)
+SAMPLE_INTERVAL = 0.1  # RSS を読む間隔 (秒)
+KNEE_GAIN = 0.1  # 同時セッションを増やしてもスループットが 10% 以上伸びなければ膝
+LATENCY_THRESHOLD = 0.2  # ベースラインから p95 が 20% 以上遅くなったら回帰
+THROUGHPUT_THRESHOLD = 0.2  # ベースラインからスループットが 20% 以上落ちたら回帰
+MIN_SECONDS = 0.01  # これより小さい差は計測誤差として無視する
+SEED = 0
+KINDS = ("open", "upload", "slider")
+
+
+# --- アップロードする画像 ---
+class ImageSet:
+    """長辺・種類ごとの合成画像の PNG (同じものは1回だけ作る。スレッドセーフ)"""
+
+    def __init__(self, sizes=SIZES, contents=bench.CONTENTS):
+        self.sizes = list(sizes)
+        self.contents = list(contents)
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def pick(self, rng):
+        """ランダムに選んだ画像の (ファイル名, PNG のバイト列) を返す"""
+        size = self.sizes[int(rng.integers(len(self.sizes)))]
+        content = self.contents[int(rng.integers(len(self.contents)))]
+        with self._lock:
+            data = self._data.get((size, content))
+            if data is None:
+                buf = io.BytesIO()
+                bench.synthetic_image(size, content).save(buf, format="PNG")
+                data = self._data[(size, content)] = buf.getvalue()
+        return f"{content}_{size}.png", data
+
+
+# --- 1人の利用者 ---
+def _random_value(slider, rng):
+    """スライダーの範囲・刻みの中から、今と違う値をランダムに選ぶ"""
+    steps = max(1, round((slider.max - slider.min) / slider.step))
+    value = slider.value
+    for _ in range(3):  # 今と同じ値だと再計算されないので、選び直す
+        value = slider.min + int(rng.integers(steps + 1)) * slider.step
+        if value != slider.value:
+            break
+    if isinstance(slider.value, int):
+        return int(value)
+    return round(float(value), 6)
+
+
+def _failures(at):
+    """再実行の結果から失敗の種類を返す (成功なら None)"""
+    if at.exception:
+        return "exception"
+    for error in at.error:
+        if "混み合っています" in str(error.value):
+            return "rejected"
+    return None
+
+
+class Session:
+    """AppTest で1つのページを操作する、1人の利用者"""
+
+    def __init__(
+        self, page, images, rng, actions=ACTIONS, think=THINK, timeout=TIMEOUT
+    ):
+        from streamlit.testing.v1 import AppTest
+
+        self.page = page
+        self.images = images
+        self.rng = rng
+        self.actions = actions
+        self.think = think
+        self.timeout = timeout
+        self.at = AppTest.from_file(os.path.join(ROOT, page), default_timeout=timeout)
+
+    def _rerun(self, kind, action, record):
+        start = time.perf_counter()
+        try:
+            action()
+            self.at.run(timeout=self.timeout)
+        except Exception:  # タイムアウトなど。この利用者はここで終わる
+            record(self.page, kind, time.perf_counter() - start, "failed")
+            return False
+        record(self.page, kind, time.perf_counter() - start, _failures(self.at))
+        if self.think:
+            time.sleep(self.think)
+        return True
+
+    def run(self, record):
+        """ページを開き、画像をアップロードして、スライダーを actions 回動かす"""
+        if not self._rerun("open", lambda: None, record):
+            return
+        if self.at.file_uploader:
+            name, data = self.images.pick(self.rng)
+            upload = lambda: self.at.file_uploader[0].upload(name, data, "image/png")
+            if not self._rerun("upload", upload, record):
+                return
+        for _ in range(self.actions):
+            # アップロード後にしか出ないスライダーもあるので、毎回探し直す
+            sliders = [s for s in self.at.slider if not s.disabled]
+            if sliders:
+                slider = sliders[int(self.rng.integers(len(sliders)))]
+                action = lambda: slider.set_value(_random_value(slider, self.rng))
+                kind = "slider"
+            else:
+                action, kind = (lambda: None), "open"
+            if not self._rerun(kind, action, record):
+                return
+
+
+# --- RSS の記録 ---
+class RSSSampler:
+    """with ブロックの間、一定間隔でプロセスの RSS を読み、開始時・最大・終了時を記録する"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.start = self.peak = self.end = None
+        self._stop = threading.Event()
+
+    def _sample(self):
+        rss = metrics.rss_bytes()
+        if rss is not None:
+            self.peak = rss if self.peak is None else max(self.peak, rss)
+        return rss
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self.start = self._sample()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.end = self._sample()
+        return False
+
+
+# --- 計測 ---
+def _latency_summary(values):
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": metrics.percentile(values, 0.5),
+        "p95": metrics.percentile(values, 0.95),
+        "p99": metrics.percentile(values, 0.99),
+        "max": max(values),
+    }
+
+
+def run_level(
+    concurrency,
+    pages=PAGES,
+    images=None,
+    actions=ACTIONS,
+    rounds=ROUNDS,
+    think=THINK,
+    timeout=TIMEOUT,
+    seed=SEED,
+):
+    """concurrency 人が同時に rounds 回ずつページを操作し、再実行の時間などをまとめる"""
+    images = images or ImageSet()
+    lock = threading.Lock()
+    latencies = collections.defaultdict(list)  # 種類 -> 成功した再実行の秒数
+    by_page = collections.defaultdict(list)
+    failures = collections.Counter()
+
+    def record(page, kind, seconds, failure):
+        with lock:
+            if failure is None:
+                latencies[kind].append(seconds)
+                by_page[page].append(seconds)
+            else:
+                failures[failure] += 1
+
+    def user(index):
+        rng = np.random.default_rng([seed, concurrency, index])
+        for round_ in range(rounds):
+            # 利用者ごと・回ごとに別のページを開く (ページの混ざり方を毎回そろえる)
+            page = pages[(index + round_) % len(pages)]
+            Session(page, images, rng, actions, think, timeout).run(record)
+
+    before = scheduler.get_scheduler().stats()
+    store_before = artifacts.get_store().stats()
+    users = [
+        threading.Thread(target=user, args=(i,), name=f"imageforge-loadtest-{i}")
+        for i in range(concurrency)
+    ]
+    with RSSSampler() as rss:
+        start = time.perf_counter()
+        for t in users:
+            t.start()
+        for t in users:
+            t.join()
+        wall = time.perf_counter() - start
+    after = scheduler.get_scheduler().stats()
+    store = artifacts.get_store().stats()
+
+    everything = [s for values in latencies.values() for s in values]
+    return {
+        "concurrency": concurrency,
+        "seconds": wall,
+        "reruns": len(everything),
+        "failures": dict(failures),
+        "throughput": len(everything) / wall if wall > 0 else 0.0,
+        "latency": _latency_summary(everything),
+        "latency_by_kind": {
+            kind: _latency_summary(latencies[kind]) for kind in KINDS if latencies[kind]
+        },
+        "latency_by_page": {
+            page: _latency_summary(values) for page, values in sorted(by_page.items())
+        },
+        "rss_start_bytes": rss.start,
+        "rss_peak_bytes": rss.peak,
+        "rss_end_bytes": rss.end,
+        # セッションの画像 (imageforge.artifacts) のうち、メモリ上とディスクに退避中の量
+        "artifacts": {
+            "resident_bytes": store["resident_bytes"],
+            "spilled_bytes": store["spilled_bytes"],
+            "spills": store["spills"] - store_before["spills"],
+            "reloads": store["reloads"] - store_before["reloads"],
+        },
+        "scheduler": {
+            "wait_p50": after.get("wait_p50"),
+            "wait_max": after.get("wait_max"),
+            **{
+                name: after[name] - before[name]
+                for name in (
+                    "submitted",
+                    "completed",
+                    "failed",
+                    "cancelled",
+                    "rejected",
+                )
+            },
+        },
+    }
+
+
+def warm_up(pages=PAGES, images=None, timeout=TIMEOUT):
+    """計測の前に各ページを1回ずつ動かし、import やモデルの読み込みを済ませておく"""
+    images = images or ImageSet()
+    rng = np.random.default_rng(SEED)
+    for page in pages:
+        Session(page, images, rng, actions=1, timeout=timeout).run(lambda *args: None)
+
+
+def find_knee(levels, gain=KNEE_GAIN):
+    """スループットが gain 以上伸びなくなる直前の同時セッション数 (最後まで伸びれば None)"""
+    best = None
+    for level in sorted(levels, key=lambda level: level["concurrency"]):
+        if best is not None and level["throughput"] < best["throughput"] * (1 + gain):
+            return best["concurrency"]
+        if best is None or level["throughput"] > best["throughput"]:
+            best = level
+    return None
+
+
+def run_load_test(
+    concurrency=CONCURRENCY,
+    pages=PAGES,
+    sizes=SIZES,
+    actions=ACTIONS,
+    rounds=ROUNDS,
+    think=THINK,
+    timeout=TIMEOUT,
+    warmup=True,
+    log=None,
+):
+    """同時セッション数ごとに run_level() を実行し、結果の dict (meta, levels, knee) を返す"""
+    import streamlit.config
+    import streamlit.logger
+
+    # 非推奨の引数などの警告がセッションの数だけ出るので、エラー以外は表示しない
+    # (AppTest は実行のたびに設定を読み直すので、設定の値も変えておく)
+    streamlit.config.set_option("logger.level", "error")
+    streamlit.logger.set_log_level("error")
+    images = ImageSet(sizes)
+    if warmup:
+        warm_up(pages, images, timeout)
+    levels = []
+    for n in concurrency:
+        level = run_level(n, pages, images, actions, rounds, think, timeout)
+        levels.append(level)
+        if log is not None:
+            log(format_level(level))
+    meta = bench.environment()
+    meta.update(
+        pages=list(pages),
+        sizes=list(sizes),
+        actions=actions,
+        rounds=rounds,
+        think=think,
+        max_jobs=scheduler.get_scheduler().max_workers,
+        threads_per_job=scheduler.get_scheduler().threads_per_job,
+    )
+    return {"meta": meta, "levels": levels, "knee": find_knee(levels)}
+
+
+# --- ベースラインとの比較 ---
+def compare(
+    results,
+    baseline,
+    latency_threshold=LATENCY_THRESHOLD,
+    throughput_threshold=THROUGHPUT_THRESHOLD,
+    min_seconds=MIN_SECONDS,
+):
+    """ベースラインと比べて、同じ同時セッション数で悪化した項目のリストを返す
+
+    再実行の時間は p95 と p99、スループットは1秒あたりの再実行の回数を比べます。
+    """
+    base = {level["concurrency"]: level for level in baseline["levels"]}
+    regressions = []
+    for level in results["levels"]:
+        old = base.get(level["concurrency"])
+        if old is None:
+            continue
+        for metric in ("p95", "p99"):
+            before = old["latency"].get(metric)
+            after = level["latency"].get(metric)
+            if before is None or after is None:
+                continue
+            if after - before > min_seconds and after > before * (
+                1 + latency_threshold
+            ):
+                regressions.append(
+                    {
+                        "concurrency": level["concurrency"],
+                        "metric": metric,
+                        "baseline": before,
+                        "current": after,
+                    }
+                )
+        before, after = old["throughput"], level["throughput"]
+        if after < before * (1 - throughput_threshold):
+            regressions.append(
+                {
+                    "concurrency": level["concurrency"],
+                    "metric": "throughput",
+                    "baseline": before,
+                    "current": after,
+                }
+            )
+    return regressions
+
+
+# --- 表示 ---
+def _ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.0f}ms"
+
+
+def _mb(value):
+    return "-" if value is None else f"{value / 1024 / 1024:.0f}MB"
+
+
+def format_level(level):
+    latency = level["latency"]
+    failures = sum(level["failures"].values())
+    lines = [
+        f"同時 {level['concurrency']:>3} セッション: 再実行 {level['reruns']}回"
+        f" (失敗 {failures}回) {level['throughput']:.2f}回/秒"
+        f"  p50 {_ms(latency.get('p50'))}  p95 {_ms(latency.get('p95'))}"
+        f"  p99 {_ms(latency.get('p99'))}"
+        f"  RSS {_mb(level['rss_start_bytes'])} → 最大 {_mb(level['rss_peak_bytes'])}"
+        f" → {_mb(level['rss_end_bytes'])}"
+    ]
+    store = level.get("artifacts")
+    if store:
+        lines.append(
+            f"    画像  メモリ上 {_mb(store['resident_bytes'])}"
+            f" / 退避中 {_mb(store['spilled_bytes'])}"
+            f" (退避 {store['spills']}回, 読み込み直し {store['reloads']}回)"
+        )
+    for kind, summary in level["latency_by_kind"].items():
+        lines.append(
+            f"    {kind:<7} {summary['count']:>5}回  p50 {_ms(summary['p50'])}"
+            f"  p95 {_ms(summary['p95'])}  p99 {_ms(summary['p99'])}"
+        )
+    if level["failures"]:
+        lines.append(
+            "    失敗: "
+            + ", ".join(f"{k} {v}回" for k, v in sorted(level["failures"].items()))
+        )
+    return "\n".join(lines)
+
+
+def format_regression(r):
+    if r["metric"] == "throughput":
+        before, after = f"{r['baseline']:.2f}回/秒", f"{r['current']:.2f}回/秒"
+    else:
+        before, after = _ms(r["baseline"]), _ms(r["current"])
+    return f"同時 {r['concurrency']} セッション {r['metric']}: {before} → {after}"
+
+
+# --- CLI ---
+def _page_path(name):
+    # "3_Illustration_correction.py" のようにファイル名だけでも指定できる
+    for page in PAGES:
+        if name in (page, os.path.basename(page)):
+            return page
+    raise argparse.ArgumentTypeError(f"未知のページです: {name}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m imageforge.loadtest",
+        description="同時セッション数を増やしながら、ページの再実行の時間・スループット・RSS を計測します。",
+    )
+    parser.add_argument(
+        "--concurrency",
+        nargs="+",
+        type=int,
+        default=list(CONCURRENCY),
+        help=f"同時セッション数 (デフォルト: {' '.join(map(str, CONCURRENCY))})",
+    )
+    parser.add_argument(
+        "--pages",
+        nargs="+",
+        type=_page_path,
+        default=list(PAGES),
+        help="操作するページ (デフォルト: app.py と全ページ)",
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=list(SIZES),
+        help=f"アップロードする画像の長辺 px (デフォルト: {' '.join(map(str, SIZES))})",
+    )
+    parser.add_argument(
+        "--actions",
+        type=int,
+        default=ACTIONS,
+        help=f"1回の利用でスライダーを動かす回数 (デフォルト: {ACTIONS})",
+    )
+    parser.add_argument(
+        "--rounds",
+        type=int,
+        default=ROUNDS,
+        help=f"1人の利用者がページを開き直す回数 (デフォルト: {ROUNDS})",
+    )
+    parser.add_argument(
+        "--think", type=float, default=THINK, help="操作の間に待つ秒数 (デフォルト: 0)"
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=TIMEOUT,
+        help=f"1回の再実行の上限秒数 (デフォルト: {TIMEOUT})",
+    )
+    parser.add_argument(
+        "--no-warmup",
+        action="store_true",
+        help="計測の前に各ページを1回動かす (import・モデルの読み込み) のを省く",
+    )
+    parser.add_argument("--output", default=None, help="結果を保存する JSON のパス")
+    parser.add_argument(
+        "--baseline", default=None, help="比較するベースラインの JSON (以前の --output)"
+    )
+    parser.add_argument(
+        "--latency-threshold",
+        type=float,
+        default=LATENCY_THRESHOLD,
+        help=f"再実行の時間 (p95 / p99) の回帰とみなす増加率 (デフォルト: {LATENCY_THRESHOLD})",
+    )
+    parser.add_argument(
+        "--throughput-threshold",
+        type=float,
+        default=THROUGHPUT_THRESHOLD,
+        help=f"スループットの回帰とみなす減少率 (デフォルト: {THROUGHPUT_THRESHOLD})",
+    )
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    baseline = None
+    if args.baseline:
+        try:
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"ベースラインの読み込みに失敗しました: {e}", file=sys.stderr)
+            return 2
+
+    results = run_load_test(
+        [max(1, n) for n in args.concurrency],
+        args.pages,
+        args.sizes,
+        max(0, args.actions),
+        max(1, args.rounds),
+        max(0.0, args.think),
+        args.timeout,
+        warmup=not args.no_warmup,
+        log=lambda line: print(line, file=sys.stderr),
+    )
+    if results["knee"] is not None:
+        print(
+            f"同時 {results['knee']} セッションを超えるとスループットが伸びなくなります。",
+            file=sys.stderr,
+        )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if baseline is None:
+        return 0
+    regressions = compare(
+        results, baseline, args.latency_threshold, args.throughput_threshold
+    )
+    if not regressions:
+        print("ベースラインからの回帰はありません。", file=sys.stderr)
+        return 0
+    print(f"回帰が {len(regressions)} 件あります:", file=sys.stderr)
+    for r in regressions:
+        print("  " + format_regression(r), file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,224 @@
+# imageforge/matte.py
+"""アルファマット (背景除去のマスク) を使った後処理
+
+背景除去モデルの出力はマスク (L モード、0〜255) だけをキャッシュしておき、
+背景の差し替え・ドロップシャドウ・縁のぼかし/縮小・被写体での切り抜きは
+このマスクと元画像から毎回合成します。どの処理もモデルの再推論は不要で、
+PIL / OpenCV の単純な演算だけで済みます。
+
+縮小した画像で推論したマスクは guided_upsample() で元の画像の輪郭に沿って拡大し、
+compare_mattes() でフル解像度で推論したマスクとの差 (縁の品質) を確かめられます。
+"""
+import cv2
+import numpy as np
+from PIL import Image, ImageChops, ImageOps
+
+from imageforge import metrics
+
+# --- 定数 ---
+BACKGROUND_MODES = ["透明", "単色", "画像"]
+CROP_THRESHOLD = 8  # 切り抜き範囲の判定に使うアルファのしきい値
+SHADOW_BLUR_STEP = 4  # 影のぼかしを縮小して計算するときの、縮小後の sigma の目安
+GUIDED_RADIUS = 4  # ガイデッドフィルタの半径 (マスクの解像度での px)
+GUIDED_EPS = 1e-4  # ガイデッドフィルタの平滑化の強さ (輝度 0〜1 の分散)
+EDGE_BAND = 3  # 縁の品質を比べる範囲 (基準のマスクの境界からの px)
+
+DEFAULT_EFFECTS = {
+    "background_mode": "透明",
+    "background_color": (255, 255, 255),
+    "background_image": None,
+    "erode": 0,  # px。正で縁を縮め、負で広げる
+    "feather": 0,  # 縁をぼかす半径 (px)
+    "shadow": False,
+    "shadow_offset": (12, 12),
+    "shadow_blur": 12,
+    "shadow_opacity": 0.5,
+    "shadow_color": (0, 0, 0),
+    "crop": False,
+    "crop_margin": 16,
+}
+
+
+# --- マスクの加工 ---
+def refine_matte(mask, erode=0, feather=0):
+    """マスクの縁を縮める/広げる (erode px) → ぼかす (feather px)"""
+    if not erode and not feather:
+        return mask
+    alpha = np.asarray(mask)
+    if erode:
+        size = 2 * abs(erode) + 1
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size))
+        op = cv2.erode if erode > 0 else cv2.dilate
+        alpha = op(alpha, kernel)
+    if feather:
+        alpha = cv2.GaussianBlur(alpha, (0, 0), sigmaX=feather / 2)
+    return Image.fromarray(alpha, "L")
+
+
+def subject_bbox(mask, margin=0):
+    """被写体 (アルファがしきい値を超える範囲) の外接矩形。被写体が無ければ None"""
+    inside = np.asarray(mask) > CROP_THRESHOLD
+    rows = np.flatnonzero(inside.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(inside.any(axis=0))
+    w, h = mask.size
+    left, top, right, bottom = cols[0], rows[0], cols[-1] + 1, rows[-1] + 1
+    return (
+        int(max(0, left - margin)),
+        int(max(0, top - margin)),
+        int(min(w, right + margin)),
+        int(min(h, bottom + margin)),
+    )
+
+
+def _box_mean(x, radius):
+    size = 2 * radius + 1
+    return cv2.boxFilter(x, -1, (size, size), borderType=cv2.BORDER_REFLECT)
+
+
+def guided_upsample(guide, mask, radius=GUIDED_RADIUS, eps=GUIDED_EPS):
+    """低解像度のマスクを、フル解像度の画像の輪郭に沿って拡大する (Fast Guided Filter)
+
+    guide はフル解像度の画像 (輝度をガイドに使う)、mask はそれを縮小した大きさのマスクです。
+    フィルタの係数 (マスク ≈ a × 輝度 + b) はマスクの解像度で求めて拡大するので、
+    フル解像度での計算は係数の拡大と1回の積和だけです。
+    """
+    if guide.mode != "L":
+        guide = guide.convert("L")
+    if mask.size == guide.size:
+        return mask
+    small = np.asarray(guide.resize(mask.size, Image.Resampling.BOX), np.float32)
+    small /= 255
+    p = np.asarray(mask, np.float32) / 255
+    mean_i = _box_mean(small, radius)
+    mean_p = _box_mean(p, radius)
+    cov_ip = _box_mean(small * p, radius) - mean_i * mean_p
+    var_i = _box_mean(small * small, radius) - mean_i * mean_i
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    # q = a × I + b を 0〜255 のまま計算する。フル解像度での演算を減らすため、
+    # b は拡大する前に 255 倍して四捨五入の 0.5 も足しておく
+    size = guide.size
+    q = cv2.resize(_box_mean(a, radius), size, interpolation=cv2.INTER_LINEAR)
+    b = _box_mean(b, radius) * 255 + 0.5
+    q *= np.asarray(guide)
+    q += cv2.resize(b, size, interpolation=cv2.INTER_LINEAR)
+    np.clip(q, 0, 255, out=q)
+    return Image.fromarray(q.astype(np.uint8), "L")
+
+
+def compare_mattes(reference, mask, band=EDGE_BAND):
+    """基準のマスクとの差 (0〜1) を返す
+
+    mae は画像全体、edge_mae は基準の境界から band px 以内の平均の差、
+    iou は 50% で二値化した被写体の重なりです。
+    """
+    ref = np.asarray(reference)
+    if mask.size != reference.size:
+        mask = mask.resize(reference.size, Image.Resampling.BILINEAR)
+    alpha = np.asarray(mask)
+    diff = cv2.absdiff(ref, alpha)
+    inside = (ref >= 128).astype(np.uint8)
+    subject = alpha >= 128
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * band + 1, 2 * band + 1))
+    edge = cv2.dilate(inside, kernel) != cv2.erode(inside, kernel)
+    edge |= (ref > 0) & (ref < 255)  # 半透明の部分 (髪の毛など) も縁に含める
+    union = np.count_nonzero(inside | subject)
+    overlap = np.count_nonzero(inside & subject)
+    return {
+        "mae": float(diff.mean()) / 255,
+        "edge_mae": float(diff[edge].mean()) / 255 if edge.any() else 0.0,
+        "iou": float(overlap / union) if union else 1.0,
+    }
+
+
+# --- 合成 ---
+def cutout(image, mask):
+    """背景を透明にした画像 (rembg.remove() の出力と同じ合成)"""
+    return Image.composite(image, Image.new("RGBA", image.size, 0), mask)
+
+
+def make_background(size, mode="透明", color=(255, 255, 255), image=None):
+    """背景レイヤー (RGBA)。画像は縦横比を保ったまま全体を覆うように切り取る"""
+    if mode == "単色":
+        return Image.new("RGBA", size, tuple(color) + (255,))
+    if mode == "画像" and image is not None:
+        return ImageOps.fit(image.convert("RGBA"), size, Image.LANCZOS)
+    return Image.new("RGBA", size, 0)
+
+
+def _soft_blur(alpha, sigma):
+    """大きな sigma のぼかし。影はぼけているので縮小してぼかしてから拡大しても見た目は同じ"""
+    factor = max(1, int(sigma) // SHADOW_BLUR_STEP)
+    if factor == 1:
+        return cv2.GaussianBlur(alpha, (0, 0), sigmaX=sigma)
+    h, w = alpha.shape
+    small = cv2.resize(
+        alpha,
+        (max(1, w // factor), max(1, h // factor)),
+        interpolation=cv2.INTER_AREA,
+    )
+    small = cv2.GaussianBlur(small, (0, 0), sigmaX=sigma / factor)
+    return cv2.resize(small, (w, h), interpolation=cv2.INTER_LINEAR)
+
+
+def drop_shadow(mask, offset=(12, 12), blur=12, opacity=0.5, color=(0, 0, 0)):
+    """マスクをずらしてぼかした影のレイヤー (RGBA)"""
+    alpha = np.asarray(mask)
+    h, w = alpha.shape
+    dx, dy = (int(v) for v in offset)
+    shadow = np.zeros_like(alpha)
+    if abs(dx) < w and abs(dy) < h:
+        shadow[max(0, dy) : h + min(0, dy), max(0, dx) : w + min(0, dx)] = alpha[
+            max(0, -dy) : h - max(0, dy), max(0, -dx) : w - max(0, dx)
+        ]
+    if blur:
+        shadow = _soft_blur(shadow, blur)
+    if opacity != 1:
+        shadow = cv2.convertScaleAbs(shadow, alpha=opacity)
+    planes = [np.full_like(shadow, c) for c in color]
+    return Image.fromarray(cv2.merge(planes + [shadow]), "RGBA")
+
+
+def apply_effects(image, mask, effects=None):
+    """元画像 (RGB) とマスクから、背景・影・縁・切り抜きを反映した RGBA 画像を作る
+
+    背景が透明で影も無い場合は rembg.remove() と同じ画像になります。
+    """
+    effects = {**DEFAULT_EFFECTS, **(effects or {})}
+    with metrics.stage("refine_matte"):
+        mask = refine_matte(mask, effects["erode"], effects["feather"])
+
+    crop_mask = mask
+    if effects["background_mode"] == "透明" and not effects["shadow"]:
+        result = cutout(image, mask)
+    else:
+        result = make_background(
+            image.size,
+            effects["background_mode"],
+            effects["background_color"],
+            effects["background_image"],
+        )
+        if effects["shadow"]:
+            with metrics.stage("drop_shadow"):
+                shadow = drop_shadow(
+                    mask,
+                    effects["shadow_offset"],
+                    effects["shadow_blur"],
+                    effects["shadow_opacity"],
+                    effects["shadow_color"],
+                )
+                result = Image.alpha_composite(result, shadow)
+            # 切り抜くときは影も含める
+            crop_mask = ImageChops.lighter(mask, shadow.getchannel("A"))
+        with metrics.stage("composite"):
+            subject = image.convert("RGBA")
+            subject.putalpha(mask)
+            result = Image.alpha_composite(result, subject)
+
+    if effects["crop"]:
+        bbox = subject_bbox(crop_mask, effects["crop_margin"])
+        if bbox is not None:
+            result = result.crop(bbox)
+    return result
@@ -0,0 +1,120 @@
+# imageforge/mattecompare.py
+"""背景除去の推論モードの比較 (CLI)
+
+実際の画像で、推論のモード (segmentation.MATTE_MODES) ごとの処理時間と、
+フル解像度の画像で推論したマスク (従来の出力) との差を表示します。
+縮小して推論するモードを使ってよいかを、手元の写真で確かめるためのものです。
+
+表示する値:
+    推論        マスクの推論 (縮小・再推論・マスクの拡大を含む) の時間 (repeat 回の最小値)
+    合成        マスクで背景を透明にする時間
+    edge_mae    従来のマスクとの差 (0〜1) の、被写体の境界から数 px 以内の平均
+    mae / iou   画像全体の差の平均 / 50% で二値化した被写体の重なり
+
+使い方:
+    python -m imageforge.mattecompare photo1.jpg photo2.jpg --output compare.json
+"""
+import argparse
+import json
+import sys
+import time
+
+from imageforge import ingest, matte, segmentation
+
+# --- 定数 ---
+REPEAT = 3
+REFERENCE_MODE = "full"
+
+
+def _best_of(fn, repeat):
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def compare_image(image, pool, modes=None, repeat=REPEAT):
+    """1枚の画像をモードごとに処理し、結果の dict のリストを返す (最初は基準のモード)"""
+    modes = [m for m in modes or segmentation.MATTE_MODES if m != REFERENCE_MODE]
+    reference = None
+    rows = []
+    for mode in [REFERENCE_MODE] + modes:
+        seconds, mask = _best_of(lambda: pool.predict_masks([image], mode)[0], repeat)
+        composite_seconds, _ = _best_of(lambda: matte.cutout(image, mask), repeat)
+        if reference is None:
+            reference = mask
+        row = {
+            "mode": mode,
+            "seconds": seconds,
+            "composite_seconds": composite_seconds,
+            "total_seconds": seconds + composite_seconds,
+        }
+        row.update(matte.compare_mattes(reference, mask))
+        rows.append(row)
+    return rows
+
+
+def format_row(row, reference):
+    speedup = reference["total_seconds"] / row["total_seconds"]
+    return (
+        f"  {row['mode']:<14} 推論 {row['seconds'] * 1000:8.1f}ms"
+        f"  合成 {row['composite_seconds'] * 1000:7.1f}ms  (×{speedup:.2f})"
+        f"  edge_mae {row['edge_mae']:.4f}  mae {row['mae']:.4f}  iou {row['iou']:.4f}"
+    )
+
+
+# --- CLI ---
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m imageforge.mattecompare",
+        description="背景除去の推論モードごとの処理時間と、従来のマスクとの差を表示します。",
+    )
+    parser.add_argument("images", nargs="+", help="比べる画像のファイル")
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=[m for m in segmentation.MATTE_MODES if m != REFERENCE_MODE],
+        default=None,
+        help="比べるモード (デフォルト: すべて)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=REPEAT, help="時間を計測する回数 (最小値を表示)"
+    )
+    parser.add_argument("--output", default=None, help="結果を保存する JSON のパス")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    pool = segmentation.get_pool()
+    try:
+        pool.load()  # モデルの読み込みは計測に含めない
+    except Exception as e:
+        print(f"背景除去モデルを読み込めません: {e}", file=sys.stderr)
+        return 2
+
+    results = []
+    for path in args.images:
+        try:
+            with open(path, "rb") as f:
+                image, _ = ingest.decode(f.read())
+        except (OSError, ValueError) as e:
+            print(f"{path}: 読み込めません ({e})", file=sys.stderr)
+            continue
+        rows = compare_image(image, pool, args.modes, max(1, args.repeat))
+        print(f"{path} ({image.width}x{image.height})")
+        for row in rows:
+            print(format_row(row, rows[0]))
+        results.append({"image": path, "size": list(image.size), "modes": rows})
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0 if results else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,301 @@
+# imageforge/metrics.py
+"""処理の段階ごとの時間・メモリの計測と、構造化ログの出力
+
+ページの処理を record() で囲むと、その中で呼ばれた処理関数の stage() の時間と
+メモリ使用量 (RSS の増分) が記録されます。record() の外で stage() を呼んだ場合は
+何もしないので、CLI やベンチマークから呼んでも余計なコストはかかりません。
+現在の記録はスレッド (コンテキスト) ごとに持つため、同時に動いている他のセッションの
+記録と混ざることはありません (ただし RSS はプロセス全体の値なので、同時に重い処理が
+動いていると、その分も含まれます)。
+
+記録が終わると、1回の処理を1行の JSON としてロガー "imageforge.metrics" に INFO で
+出力します。環境変数 IMAGEFORGE_METRICS_FILE を設定すると、同じ行をそのファイルにも
+追記します (JSON Lines)。複数のサーバープロセスから同じファイルに追記できます。
+
+集計:
+    python -m imageforge.metrics metrics.jsonl
+"""
+import argparse
+import collections
+import contextlib
+import contextvars
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar("imageforge_metrics_run", default=None)
+_file_lock = threading.Lock()
+
+
+# --- RSS の計測 (Linux) ---
+def _read_status(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_hwm():
+    # "5" で VmHWM (RSS の最大値) を現在の RSS にリセットできる (Linux 4.0 以降)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class RSSPeak:
+    """with ブロック内のプロセスの RSS の最大増分 (Linux の VmHWM を使う。取れなければ None)"""
+
+    def __enter__(self):
+        self.peak = None
+        self._base = _read_status("VmRSS")
+        self._enabled = self._base is not None and _reset_hwm()
+        return self
+
+    def __exit__(self, *exc):
+        if self._enabled:
+            hwm = _read_status("VmHWM")
+            if hwm is not None:
+                self.peak = max(0, hwm - self._base)
+        return False
+
+
+def rss_bytes():
+    """現在のプロセスの RSS (取れなければ None)"""
+    return _read_status("VmRSS")
+
+
+# --- 記録 ---
+class Run:
+    """1回の処理の記録 (段階ごとの時間・メモリ、カウンター、画像サイズなどの付加情報)"""
+
+    def __init__(self, tool, **fields):
+        self.tool = tool
+        self.fields = fields
+        self.stages = []
+        self.counters = collections.Counter()
+        self.seconds = None
+        self._open = []  # 実行中の段階 [記録, 開始時刻, 開始時の RSS, 最大の RSS]
+        self._start = time.perf_counter()
+
+    def _enter_stage(self, name):
+        # 入れ子の段階で VmHWM をリセットする前に、外側の段階の最大値を確定しておく
+        hwm = _read_status("VmHWM")
+        for outer in self._open:
+            if hwm is not None and outer[3] is not None:
+                outer[3] = max(outer[3], hwm)
+        base = _read_status("VmRSS")
+        if base is not None and not _reset_hwm():
+            base = None
+        path = f"{self._open[-1][0]['stage']}/{name}" if self._open else name
+        # 表示が開始順になるよう、入った時点で記録の枠を作っておく
+        entry = {"stage": path, "seconds": None, "peak_rss_bytes": None}
+        self.stages.append(entry)
+        self._open.append([entry, time.perf_counter(), base, base])
+
+    def _exit_stage(self):
+        hwm = _read_status("VmHWM")
+        for outer in self._open:
+            if hwm is not None and outer[3] is not None:
+                outer[3] = max(outer[3], hwm)
+        entry, start, base, peak = self._open.pop()
+        entry["seconds"] = time.perf_counter() - start
+        if base is not None:
+            entry["peak_rss_bytes"] = max(0, peak - base)
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self._start
+
+    def to_dict(self):
+        return {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "tool": self.tool,
+            **self.fields,
+            "seconds": self.seconds,
+            "stages": self.stages,
+            "counters": dict(self.counters),
+        }
+
+
+@contextlib.contextmanager
+def record(tool, emit=True, **fields):
+    """with ブロック内の処理を記録する。終了時に構造化ログ (と metrics ファイル) に出力する
+
+    fields には画像サイズやパラメータなど、集計に使う情報を渡します (JSON にできる値)。
+    """
+    run = Run(tool, **fields)
+    token = _current.set(run)
+    try:
+        yield run
+    finally:
+        _current.reset(token)
+        run.finish()
+        if emit:
+            emit_run(run)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """処理の1段階の時間と RSS の増分を、実行中の record() に記録する"""
+    run = _current.get()
+    if run is None:
+        yield
+        return
+    run._enter_stage(name)
+    try:
+        yield
+    finally:
+        run._exit_stage()
+
+
+def count(name, n=1):
+    """実行中の record() のカウンター (キャッシュのヒット数など) を増やす"""
+    run = _current.get()
+    if run is not None:
+        run.counters[name] += n
+
+
+def annotate(**fields):
+    """実行中の record() に付加情報を追加する (画像サイズなど、処理の途中で分かるもの)"""
+    run = _current.get()
+    if run is not None:
+        run.fields.update(fields)
+
+
+# --- 出力 ---
+def emit_run(run):
+    line = json.dumps(run.to_dict(), ensure_ascii=False, default=repr)
+    logger.info(line)
+    path = os.environ.get("IMAGEFORGE_METRICS_FILE")
+    if path:
+        try:
+            # 1行を1回の write で追記する (O_APPEND なので他のプロセスの行と混ざらない)
+            with _file_lock, open(path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError:
+            logger.warning("metrics ファイルに書き込めませんでした: %s", path)
+
+
+def stages_table(run):
+    """Run (または to_dict() の結果) を表示用の行 (dict) にする"""
+    data = run.to_dict() if isinstance(run, Run) else run
+    rows = []
+    for s in data["stages"]:
+        depth = s["stage"].count("/")
+        peak = s["peak_rss_bytes"]
+        rows.append(
+            {
+                "段階": "　" * depth + s["stage"].rsplit("/", 1)[-1],
+                "時間 (ms)": round(s["seconds"] * 1000, 1),
+                "RSS 増分 (MB)": None if peak is None else round(peak / 1024 / 1024, 1),
+            }
+        )
+    return rows
+
+
+def totals_table(run):
+    """同じ段階が何度も出てくる処理 (バッチなど) 用に、段階ごとの回数と合計時間をまとめる"""
+    data = run.to_dict() if isinstance(run, Run) else run
+    totals = {}
+    for s in data["stages"]:
+        count, seconds = totals.get(s["stage"], (0, 0.0))
+        totals[s["stage"]] = (count + 1, seconds + s["seconds"])
+    return [
+        {"段階": name, "回数": count, "合計時間 (ms)": round(seconds * 1000, 1)}
+        for name, (count, seconds) in totals.items()
+    ]
+
+
+def describe(run):
+    """Run (または to_dict() の結果) の合計時間とキャッシュの利用状況を1行にする"""
+    data = run.to_dict() if isinstance(run, Run) else run
+    counters = data["counters"]
+    hits = counters.get("cache_memory_hits", 0) + counters.get("cache_disk_hits", 0)
+    text = (
+        f"合計 {data['seconds'] * 1000:.0f}ms"
+        f" / キャッシュ: ヒット {hits}回, ミス {counters.get('cache_misses', 0)}回"
+    )
+    if counters.get("stage_memo_hits"):
+        text += f" / 再利用した段階: {counters['stage_memo_hits']}個"
+    return text
+
+
+# --- 集計 (CLI) ---
+def percentile(values, q):
+    # nearest-rank 法
+    values = sorted(values)
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+def summarize(lines):
+    """metrics ファイルの行から、ツール・段階ごとの回数と時間の統計を作る"""
+    durations = collections.defaultdict(list)
+    counters = collections.defaultdict(collections.Counter)
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        tool = entry.get("tool", "?")
+        if entry.get("seconds") is not None:
+            durations[(tool, "(合計)")].append(entry["seconds"])
+        for s in entry.get("stages", []):
+            durations[(tool, s["stage"])].append(s["seconds"])
+        counters[tool].update(entry.get("counters", {}))
+    summary = []
+    for (tool, name), values in sorted(durations.items()):
+        summary.append(
+            {
+                "tool": tool,
+                "stage": name,
+                "count": len(values),
+                "mean": sum(values) / len(values),
+                "p50": percentile(values, 0.5),
+                "p95": percentile(values, 0.95),
+                "max": max(values),
+            }
+        )
+    return summary, {tool: dict(c) for tool, c in counters.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m imageforge.metrics",
+        description="IMAGEFORGE_METRICS_FILE に記録した処理時間を、ツール・段階ごとに集計します。",
+    )
+    parser.add_argument("files", nargs="+", help="metrics ファイル (JSON Lines)")
+    args = parser.parse_args(argv)
+    lines = []
+    for path in args.files:
+        with open(path, encoding="utf-8") as f:
+            lines.extend(f)
+    summary, counters = summarize(lines)
+    for row in summary:
+        print(
+            f"{row['tool']:<22} {row['stage']:<36} {row['count']:>6}回"
+            f"  平均 {row['mean'] * 1000:9.1f}ms  p50 {row['p50'] * 1000:9.1f}ms"
+            f"  p95 {row['p95'] * 1000:9.1f}ms  最大 {row['max'] * 1000:9.1f}ms"
+        )
+    for tool, c in sorted(counters.items()):
+        if c:
+            print(f"{tool}: " + ", ".join(f"{k} {v}" for k, v in sorted(c.items())))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+# imageforge/pixelart.py
+"""ピクセルアートメーカーの画像処理関数
+
+pages/1_pixel_art_maker.py から利用します。
+
+ドットの色は縮小したグリッド (ドット1つ = 1ピクセル) の上で決め、最後に NEAREST で
+元のサイズへ拡大します。パレット処理もすべてグリッド上で行うので、処理量は元画像の
+画素数ではなくドットの数に比例します。
+
+レトロパレット (NES, ゲームボーイ, PICO-8, CGA, カスタム) への割り当ては、RGB 空間を
+LUT_BITS ビットずつに区切った 3D ルックアップテーブル (各セル → 最も近いパレット色) を
+パレットごとに1回だけ作り、あとは表引きで行います。
+"""
+import functools
+import re
+
+import numpy as np
+from PIL import Image, ImageEnhance
+
+from imageforge import metrics
+
+# --- 定数 ---
+# fmt: off
+RETRO_PALETTES = {
+    # NES (2C02) の基本パレットから重複を除いたもの
+    "NES": [
+        "7C7C7C", "0000FC", "0000BC", "4428BC", "940084", "A80020", "A81000",
+        "881400", "503000", "007800", "006800", "005800", "004058", "000000",
+        "BCBCBC", "0078F8", "0058F8", "6844FC", "D800CC", "E40058", "F83800",
+        "E45C10", "AC7C00", "00B800", "00A800", "00A844", "008888", "F8F8F8",
+        "3CBCFC", "6888FC", "9878F8", "F878F8", "F85898", "F87858", "FCA044",
+        "F8B800", "B8F818", "58D854", "58F898", "00E8D8", "787878", "FCFCFC",
+        "A4E4FC", "B8B8F8", "D8B8F8", "F8B8F8", "F8A4C0", "F0D0B0", "FCE0A8",
+        "F8D878", "D8F878", "B8F8B8", "B8F8D8", "00FCFC", "F8D8F8",
+    ],
+    "ゲームボーイ": ["0F380F", "306230", "8BAC0F", "9BBC0F"],
+    "PICO-8": [
+        "000000", "1D2B53", "7E2553", "008751", "AB5236", "5F574F", "C2C3C7",
+        "FFF1E8", "FF004D", "FFA300", "FFEC27", "00E436", "29ADFF", "83769C",
+        "FF77A8", "FFCCAA",
+    ],
+    # CGA グラフィックモード 4 (パレット1、高輝度)
+    "CGA": ["000000", "55FFFF", "FF55FF", "FFFFFF"],
+}
+# fmt: on
+CUSTOM_PALETTE = "カスタム"
+PALETTE_STYLES = (
+    ["オリジナル", "16ビット風", "モノクロ", "カラフル"]
+    + list(RETRO_PALETTES)
+    + [CUSTOM_PALETTE]
+)
+DOWNSAMPLE_METHODS = {
+    "nearest": "最近傍 (従来)",
+    "average": "平均",
+    "median": "中央値",
+}
+LUT_BITS = 6  # 3D LUT の1チャンネルあたりのビット数 (64 段階)
+MAX_PALETTE_COLORS = (
+    256  # パレット番号を uint8 で持つため (GIF のカラーテーブルも 256 色まで)
+)
+# 16ビット風 (RGB565): R・B は下位3ビット、G は下位2ビットを落とす 1D LUT (Image.point 用)
+RGB565_TABLE = (
+    [v & ~0b111 for v in range(256)]
+    + [v & ~0b11 for v in range(256)]
+    + [v & ~0b111 for v in range(256)]
+)
+BAYER_4X4 = np.array(
+    [[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]], dtype=np.float32
+)
+
+
+# --- 縮小 (ドットの色を決める) ---
+def downsample_grid(image, pixel_size=10, method="nearest"):
+    """ドット1つを1ピクセルとした縮小画像 (グリッド) を作る
+
+    method:
+        "nearest": 各ブロックから1画素を選ぶ (従来の動作)
+        "average": ブロック内の平均色
+        "median": ブロック内のチャンネルごとの中央値 (割り切れない右端・下端の
+            余りの画素は使わない)
+    """
+    original_width, original_height = image.size
+    new_width = max(1, original_width // pixel_size)
+    new_height = max(1, original_height // pixel_size)
+    if method == "average":
+        # BOX フィルタはブロックの面積平均 (割り切れない場合も画素の重みを按分する)
+        return image.convert("RGB").resize((new_width, new_height), Image.BOX)
+    if method == "median":
+        return _median_grid(image, pixel_size, new_width, new_height)
+    return image.resize((new_width, new_height), Image.NEAREST)
+
+
+def _median_grid(image, pixel_size, new_width, new_height):
+    bh = min(pixel_size, image.height // new_height)
+    bw = min(pixel_size, image.width // new_width)
+    arr = np.asarray(image.convert("RGB"))[: new_height * bh, : new_width * bw]
+    blocks = arr.reshape(new_height, bh, new_width, bw, 3).transpose(0, 2, 1, 3, 4)
+    blocks = blocks.reshape(new_height, new_width, bh * bw, 3)
+    return Image.fromarray(np.median(blocks, axis=2).astype(np.uint8), "RGB")
+
+
+def create_pixel_art(image, pixel_size=10, method="nearest"):
+    small_image = downsample_grid(image, pixel_size, method)
+    return small_image.resize(image.size, Image.NEAREST)
+
+
+def quantize_to_16bit(image: Image.Image) -> Image.Image:
+    return image.convert("RGB").point(RGB565_TABLE)
+
+
+def to_grayscale(image: Image.Image) -> Image.Image:
+    return image.convert("L").convert("RGB")
+
+
+def to_colorful(image: Image.Image, factor=2.0) -> Image.Image:
+    enhancer = ImageEnhance.Color(image.convert("RGB"))
+    return enhancer.enhance(factor)
+
+
+# --- レトロパレット ---
+def parse_palette(text):
+    """ "#RRGGBB" (または RRGGBB) を空白・カンマ・改行で区切ったテキストをパレットにする
+
+    Lospec などの .hex ファイル (1行に1色) もそのまま読み込めます。
+    """
+    colors = re.findall(r"#?\b([0-9A-Fa-f]{6})\b", text)
+    return tuple(dict.fromkeys(c.upper() for c in colors))
+
+
+def palette_colors(palette):
+    """16進文字列のパレットを (N×3, uint8) の配列にする"""
+    return np.array(
+        [[int(c[i : i + 2], 16) for i in (0, 2, 4)] for c in palette], dtype=np.uint8
+    )
+
+
+@functools.lru_cache(maxsize=16)
+def palette_lut(palette, bits=LUT_BITS):
+    """RGB の各セル (2^bits)^3 → 最も近いパレット色の番号 の 3D LUT
+
+    palette は16進文字列のタプル (lru_cache のキーにするため)。パレットごとに1回だけ作ります。
+    """
+    colors = palette_colors(palette).astype(np.float32)
+    levels = 1 << bits
+    # セルの中心の色で距離を測る
+    centers = (np.arange(levels, dtype=np.float32) + 0.5) * (256 / levels)
+    lut = np.empty((levels, levels, levels), dtype=np.uint8)
+    g, b = np.meshgrid(centers, centers, indexing="ij")
+    gb = np.stack([g.ravel(), b.ravel()], axis=1)
+    for r_index, r in enumerate(centers):
+        cells = np.column_stack([np.full(len(gb), r, dtype=np.float32), gb])
+        dist = ((cells[:, None, :] - colors[None, :, :]) ** 2).sum(axis=2)
+        lut[r_index] = np.argmin(dist, axis=1).reshape(levels, levels)
+    lut.flags.writeable = False
+    return lut
+
+
+def palette_indices(image, palette, dither=0.0, bits=LUT_BITS):
+    """グリッド画像の各ドットに最も近いパレット色の番号 (H×W, uint8)
+
+    dither > 0 で 4×4 の組織的ディザをかけます。
+    """
+    palette = tuple(palette)
+    arr = np.asarray(image.convert("RGB"), dtype=np.float32)
+    if dither > 0:
+        # パレットの色の間隔の目安 (1チャンネルあたりの段階数から求める)
+        spread = dither * 255 / max(1, round(len(palette) ** (1 / 3)))
+        h, w, _ = arr.shape
+        threshold = np.tile(BAYER_4X4, (h // 4 + 1, w // 4 + 1))[:h, :w]
+        arr = arr + ((threshold + 0.5) / 16 - 0.5)[..., None] * spread
+    q = np.clip(arr, 0, 255).astype(np.uint8) >> (8 - bits)
+    return palette_lut(palette, bits)[q[..., 0], q[..., 1], q[..., 2]]
+
+
+def map_to_palette(image, palette, dither=0.0, bits=LUT_BITS):
+    """グリッド画像の各ドットをパレット色に置き換える (dither > 0 で 4×4 の組織的ディザ)"""
+    index = palette_indices(image, palette, dither, bits)
+    return Image.fromarray(palette_colors(tuple(palette))[index], "RGB")
+
+
+def apply_palette_style(
+    image: Image.Image, style: str, dither=0.0, custom_palette=()
+) -> Image.Image:
+    if style in RETRO_PALETTES:
+        return map_to_palette(image, RETRO_PALETTES[style], dither)
+    elif style == CUSTOM_PALETTE:
+        if not custom_palette:
+            return image.convert("RGB")
+        return map_to_palette(image, custom_palette, dither)
+    elif style == "16ビット風":
+        return quantize_to_16bit(image)
+    elif style == "モノクロ":
+        return to_grayscale(image)
+    elif style == "カラフル":
+        return to_colorful(image)
+    else:  # "オリジナル"
+        return image.convert("RGB")
+
+
+def render_pixel_art(
+    image,
+    pixel_size=10,
+    style="オリジナル",
+    method="nearest",
+    dither=0.0,
+    custom_palette=(),
+    scale=None,
+):
+    """フル解像度のピクセルアート (パレット処理はグリッド上で行ってから拡大する)
+
+    scale を指定すると、元のサイズではなく 1ドット = scale×scale px で出力します
+    (scale=1 ならドット数そのままのネイティブサイズ)。
+    """
+    with metrics.stage("downsample"):
+        grid = downsample_grid(image, pixel_size, method)
+    with metrics.stage("palette"):
+        styled = apply_palette_style(grid, style, dither, custom_palette)
+    if scale is None:
+        size = image.size
+    else:
+        size = (styled.width * scale, styled.height * scale)
+    if size == styled.size:
+        return styled
+    with metrics.stage("upscale"):
+        return styled.resize(size, Image.NEAREST)
@@ -0,0 +1,105 @@
+# imageforge/preview.py
+"""低解像度のライブプレビュー
+
+スライダーを動かすたびにフル解像度で処理すると大きな画像では操作が重くなるため、
+表示カラムの幅に縮小したプロキシ画像で処理してプレビューします。
+フル解像度の処理はダウンロード時にだけ行います。
+
+解像度に依存するパラメータ (ぼかしの sigma、色収差のずれ量、ノイズの粒度) は
+process_image(..., scale=...) 側で縮小率に合わせて換算されます。
+ピクセルアートはフル解像度と同じドットのグリッドを作ってから表示サイズに拡大するため、
+プレビューと最終結果のドットの位置・色は完全に一致します。
+
+ブラウザに送る画像も、st.image() にフル解像度の画像を渡すと再実行のたびに数MBの PNG に
+なるため、表示幅に縮小して JPEG / WebP にした表示用の画像 (display_image) を送ります。
+フル解像度の画像はダウンロードにだけ使います。
+"""
+from io import BytesIO
+
+from PIL import Image
+
+from imageforge import cache, metrics
+from imageforge.pixelart import apply_palette_style, downsample_grid
+
+# --- 定数 ---
+PREVIEW_WIDTH = 800  # 表示カラム (約500px) の高DPI表示にも足りる幅
+CARD_WIDTH = 560  # トップページの4カラムのカード (約280px) 用
+DISPLAY_QUALITY = 85
+DISPLAY_WEBP_METHOD = (
+    0  # 表示用は速さを優先する (method=4 の 1/3〜1/10 の時間で、サイズは1〜4割増)
+)
+
+
+def make_proxy(img_pil, max_width=PREVIEW_WIDTH):
+    """プレビュー用に縮小した画像と縮小率 (プロキシ幅 / 元の幅) を返す"""
+    w, h = img_pil.size
+    if w <= max_width:
+        return img_pil, 1.0
+    new_h = max(1, round(h * max_width / w))
+    proxy = img_pil.resize((max_width, new_h), Image.LANCZOS, reducing_gap=3.0)
+    return proxy, max_width / w
+
+
+def preview_pixel_art(
+    image,
+    pixel_size,
+    style,
+    max_width=PREVIEW_WIDTH,
+    method="nearest",
+    dither=0.0,
+    custom_palette=(),
+):
+    """ピクセルアートのプレビュー
+
+    ドットのグリッドとパレット処理はフル解像度 (render_pixel_art) と同じものを使い、
+    表示サイズへ NEAREST で拡大するだけなので、ドットの位置・色は最終結果と一致します。
+    """
+    with metrics.stage("downsample"):
+        grid = downsample_grid(image, pixel_size, method)
+    with metrics.stage("palette"):
+        grid = apply_palette_style(grid, style, dither, custom_palette)
+    w, h = image.size
+    if w > max_width:
+        w, h = max_width, max(1, round(h * max_width / w))
+    with metrics.stage("upscale"):
+        return grid.resize((w, h), Image.NEAREST)
+
+
+# --- 表示用の画像 ---
+def display_image(image, max_width=PREVIEW_WIDTH, lossless=False):
+    """画面表示用に縮小・圧縮した画像のバイト列
+
+    透明部分のある画像は WebP (アルファ付き)、lossless=True (ピクセルアートなど、
+    にじむと困る画像) は可逆 WebP、それ以外は JPEG にします。
+    """
+    if image.width > max_width:
+        size = (max_width, max(1, round(image.height * max_width / image.width)))
+        if lossless:
+            image = image.resize(size, Image.NEAREST)
+        else:
+            image = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+    buf = BytesIO()
+    if lossless:
+        image.save(buf, format="WEBP", lossless=True, method=DISPLAY_WEBP_METHOD)
+    elif image.mode in ("RGBA", "LA", "P"):
+        image.save(
+            buf, format="WEBP", quality=DISPLAY_QUALITY, method=DISPLAY_WEBP_METHOD
+        )
+    else:
+        image.convert("RGB").save(buf, format="JPEG", quality=DISPLAY_QUALITY)
+    return buf.getvalue()
+
+
+def cached_display_image(key, image, max_width=PREVIEW_WIDTH, lossless=False):
+    """display_image() を key (画像の内容を表すキー) と表示幅ごとにメモリにキャッシュする
+
+    image には画像を返す関数も渡せます (キャッシュにあれば画像自体を作らずに済む)。
+    """
+    cache_key = cache.make_key(key, "display", max_width=max_width, lossless=lossless)
+
+    def render():
+        source = image() if callable(image) else image
+        with metrics.stage("display_encode"):
+            return display_image(source, max_width, lossless)
+
+    return cache.get_cache().get_or_compute(cache_key, render, persist=False)
@@ -0,0 +1,117 @@
+# imageforge/quantize.py
+"""K-Means減色の高速モード
+
+従来の apply_kmeans() (厳密モード) は全画素で KMeans を学習するため、4K画像では
+数十秒かかります。高速モードでは次の手順で処理します。
+
+1. 厳密モードと同じバイラテラルフィルタをかける
+2. 各チャンネルを上位 HIST_BITS ビットで量子化した色ヒストグラムを作り、
+   ビンごとの平均色を「出現回数で重み付けしたサンプル」として KMeans を学習する
+3. ビン → 最も近い重心 の対応表 (LUT) を作り、全画素をその表引きで置き換える
+
+学習データは画素数ではなくビン数 (最大 2^(3*HIST_BITS)) で決まるため、画像サイズに
+ほぼ依存しません。
+"""
+import cv2
+import numpy as np
+
+from imageforge import metrics
+
+# --- 定数 ---
+HIST_BITS = 5  # 1チャンネルあたりのビット数 (32 段階 → 最大 32768 ビン)
+KMEANS_MODES = ("exact", "fast")
+
+
+# --- 内部ヘルパー ---
+def _sq_distances(colors, centers):
+    """色 (N×3) と重心 (K×3) の二乗距離 (N×K)"""
+    return (
+        (colors**2).sum(1)[:, None]
+        - 2 * colors @ centers.T
+        + (centers**2).sum(1)[None, :]
+    )
+
+
+# --- ヒストグラム・LUT ---
+def bin_indices(pixels_rgb, bits=HIST_BITS):
+    """各画素 (N×3, RGB) のヒストグラムのビン番号"""
+    shift = 8 - bits
+    q = (pixels_rgb >> shift).astype(np.int32)
+    return (q[:, 0] << (2 * bits)) | (q[:, 1] << bits) | q[:, 2]
+
+
+def accumulate_histogram(pixels_rgb, counts, sums, bits=HIST_BITS):
+    """画素 (N×3, RGB) をヒストグラム (counts, sums) に加算し、ビン番号を返す
+
+    sums はビンごとの RGB 合計 (float64) です。合計は整数値なので加算順に依らず正確で、
+    画像を分割して加算しても一括の場合と同じヒストグラムになります。
+    """
+    bin_index = bin_indices(pixels_rgb, bits)
+    n_bins = 1 << (3 * bits)
+    counts += np.bincount(bin_index, minlength=n_bins)
+    for c in range(3):
+        sums[:, c] += np.bincount(bin_index, weights=pixels_rgb[:, c], minlength=n_bins)
+    return bin_index
+
+
+def empty_histogram(bits=HIST_BITS):
+    n_bins = 1 << (3 * bits)
+    return np.zeros(n_bins, dtype=np.int64), np.zeros((n_bins, 3), dtype=np.float64)
+
+
+def fit_palette_lut(counts, sums, k=24, bits=HIST_BITS):
+    """ヒストグラムで KMeans を学習し、ビン → 重心色 (RGB, uint8) の LUT を返す"""
+    # import に1秒以上かかるため、実際に学習するときに読み込む (起動時は imageforge.startup が先読み)
+    from sklearn.cluster import KMeans
+
+    used = np.flatnonzero(counts)
+    weights = counts[used].astype(np.float64)
+    colors = sums[used] / weights[:, None]
+
+    k_eff = min(k, len(colors))
+    kmeans = KMeans(n_clusters=k_eff, random_state=42, n_init=5, max_iter=200)
+    kmeans.fit(colors, sample_weight=weights)
+    centers = kmeans.cluster_centers_
+
+    bin_labels = np.argmin(_sq_distances(colors, centers), axis=1)
+    palette = centers.astype("uint8")
+    lut = np.zeros((1 << (3 * bits), 3), dtype=np.uint8)
+    lut[used] = palette[bin_labels]
+    return lut
+
+
+def bilateral_prefilter(img_bgr):
+    """K-Means の前処理 (厳密モードと同じバイラテラルフィルタ、半径1ピクセル)"""
+    return cv2.bilateralFilter(img_bgr, d=3, sigmaColor=15, sigmaSpace=15)
+
+
+# --- 公開関数 ---
+def apply_kmeans_fast(img_bgr, k=24, bits=HIST_BITS):
+    """ヒストグラム学習 + LUT 割り当てによる高速 K-Means 減色 (BGR → BGR)"""
+    with metrics.stage("bilateral_filter"):
+        img_filtered = bilateral_prefilter(img_bgr)
+    h, w, _ = img_filtered.shape
+    pixels = cv2.cvtColor(img_filtered, cv2.COLOR_BGR2RGB).reshape(-1, 3)
+    with metrics.stage("kmeans_fit"):
+        counts, sums = empty_histogram(bits)
+        bin_index = accumulate_histogram(pixels, counts, sums, bits)
+        lut = fit_palette_lut(counts, sums, k, bits)
+    # 全画素は LUT の表引きで割り当てる
+    with metrics.stage("kmeans_assign"):
+        new_img = lut[bin_index].reshape(h, w, 3)
+    return cv2.cvtColor(new_img, cv2.COLOR_RGB2BGR)
+
+
+def color_error(result_bgr, reference_bgr):
+    """2枚の BGR 画像の色差 (CIE76 ΔE) を {"mean", "p95", "max"} で返す
+
+    高速モードと厳密モードの結果を比較するために使います。
+    """
+    lab_a = cv2.cvtColor(result_bgr.astype(np.float32) / 255.0, cv2.COLOR_BGR2LAB)
+    lab_b = cv2.cvtColor(reference_bgr.astype(np.float32) / 255.0, cv2.COLOR_BGR2LAB)
+    delta_e = np.sqrt(((lab_a - lab_b) ** 2).sum(axis=2))
+    return {
+        "mean": float(delta_e.mean()),
+        "p95": float(np.percentile(delta_e, 95)),
+        "max": float(delta_e.max()),
+    }
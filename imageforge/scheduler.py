@@ -0,0 +1,333 @@
+# imageforge/scheduler.py
+"""サーバー全体で共有する重い処理のスケジューラ
+
+Streamlit はセッションごとに別スレッドでページを実行するため、そのままでは同時に
+使っている人数分のバイラテラルフィルタや K-Means がコアを奪い合い、全員が遅くなります。
+各ページの重い処理 (補正・プレビュー・背景除去・アニメーション変換など) は run() で
+このスケジューラに渡し、決まった数のワーカースレッドで順番に実行します。
+
+- 同時に実行するのは max_workers 件まで。それ以上は到着順に待ち行列に並び、
+  呼び出し側には待ち順を知らせます (on_wait)。
+- 待ち行列が max_queue 件を超えたら、新しい処理は QueueFull で断ります。
+- OpenCV・BLAS/OpenMP (scikit-learn)・onnxruntime のスレッド数は、1件あたり
+  threads_per_job (= CPU の予算 / max_workers) に揃えます。
+- 待っている間にページが再実行されたり (パラメータの変更)、セッションが閉じられたり
+  すると、run() を抜ける時点で処理を取り消します。待ち行列にあればそのまま外し、
+  実行中なら次の checkpoint() で Cancelled を送出して打ち切ります。
+
+環境変数で設定できます:
+    IMAGEFORGE_CPU_BUDGET   重い処理に使うコア数 (デフォルト: 使える CPU の数)
+    IMAGEFORGE_MAX_JOBS     同時に実行する処理の数 (デフォルト: コア数の半分、最低1)
+    IMAGEFORGE_MAX_QUEUE    待ち行列の上限 (デフォルト: 32)
+"""
+import collections
+import contextvars
+import logging
+import os
+import threading
+import time
+
+# --- 定数 ---
+DEFAULT_MAX_QUEUE = 32
+POLL_INTERVAL = 0.2  # 待っている間に on_wait を呼ぶ間隔 (秒)
+WAIT_WINDOW = 200  # 統計に使う直近の待ち時間の数
+
+_current_job = contextvars.ContextVar("imageforge_scheduler_job", default=None)
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(RuntimeError):
+    """待ち行列がいっぱいで、新しい処理を受け付けられない"""
+
+
+class Cancelled(Exception):
+    """処理が取り消された"""
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def limit_threads(threads):
+    """OpenCV・BLAS・OpenMP が1回の処理で使うスレッド数を揃える (プロセス全体の設定)"""
+    # これから読み込まれるライブラリ (scikit-learn の OpenMP など) は環境変数を読む
+    for name in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ.setdefault(name, str(threads))
+    import cv2
+
+    cv2.setNumThreads(threads)
+    # 読み込み済みのライブラリ (NumPy の BLAS など) は threadpoolctl で変更する
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=threads)
+
+
+class Job:
+    """スケジューラに渡した1件の処理"""
+
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.state = "queued"  # queued / running / done / failed / cancelled
+        self.progress = None  # report_progress() で報告された (完了数, 全体の数)
+        self.submitted = time.perf_counter()
+        self.started = None
+        self._context = contextvars.copy_context()
+        self._cancel_requested = threading.Event()
+        self._finished = threading.Event()
+        self._result = None
+        self._error = None
+        self._scheduler = None
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    @property
+    def cancel_requested(self):
+        return self._cancel_requested.is_set()
+
+    def position(self):
+        """待ち行列での順番 (1 から。実行中・終了後は 0)"""
+        return self._scheduler.position(self)
+
+    def cancel(self):
+        """処理を取り消す (待ち行列にあれば外し、実行中なら次の checkpoint() で打ち切る)"""
+        self._cancel_requested.set()
+        self._scheduler._discard(self)
+
+    def wait(self, timeout=None):
+        """終わるまで待つ (timeout 秒以内に終われば True)"""
+        return self._finished.wait(timeout)
+
+    def add_done_callback(self, fn):
+        """終わったら fn(job) を呼ぶ (終わったスレッドから。もう終わっていればすぐ呼ぶ)
+
+        asyncio のイベントループなど、スレッドを止めずに結果を受け取りたい場合に使います。
+        """
+        with self._callbacks_lock:
+            if not self._finished.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def result(self):
+        """処理の戻り値を返す (終わるまで待つ。失敗・取り消しなら例外を送出する)"""
+        self._finished.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def _finish(self, state, result=None, error=None):
+        self.state = state
+        self._result = result
+        self._error = error
+        with self._callbacks_lock:
+            self._finished.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+class Scheduler:
+    """決まった数のワーカースレッドで、重い処理を到着順に実行する (スレッドセーフ)"""
+
+    def __init__(self, max_workers=1, max_queue=DEFAULT_MAX_QUEUE, threads_per_job=1):
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self.threads_per_job = max(1, threads_per_job)
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._workers = []
+        self._running = 0
+        self._waits = collections.deque(maxlen=WAIT_WINDOW)
+        self.counts = collections.Counter()
+
+    def submit(self, fn, *args, **kwargs):
+        """処理を待ち行列に入れて Job を返す (いっぱいなら QueueFull)"""
+        job = Job(fn, args, kwargs)
+        job._scheduler = self
+        with self._cond:
+            idle = self.max_workers - self._running
+            if len(self._queue) - idle >= self.max_queue:
+                self.counts["rejected"] += 1
+                raise QueueFull(
+                    "サーバーが混み合っています。しばらくしてからもう一度お試しください。"
+                )
+            self._queue.append(job)
+            self.counts["submitted"] += 1
+            if len(self._workers) < self.max_workers:
+                worker = threading.Thread(
+                    target=self._work,
+                    name=f"imageforge-scheduler-{len(self._workers)}",
+                    daemon=True,
+                )
+                self._workers.append(worker)
+                worker.start()
+            self._cond.notify()
+        return job
+
+    def position(self, job):
+        with self._cond:
+            try:
+                return self._queue.index(job) + 1
+            except ValueError:
+                return 0
+
+    def _discard(self, job):
+        with self._cond:
+            try:
+                self._queue.remove(job)
+            except ValueError:
+                return
+            self.counts["cancelled"] += 1
+        job._finish("cancelled", error=Cancelled())
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                job = self._queue.popleft()
+                self._running += 1
+                job.state = "running"
+                job.started = time.perf_counter()
+                self._waits.append(job.started - job.submitted)
+            try:
+                # 呼び出し元のコンテキスト (metrics.record() の記録など) で実行する
+                job._context.run(self._execute, job)
+            except BaseException:
+                # 完了時のコールバックの例外などでワーカーを減らさない
+                logger.exception("スケジューラのワーカーで例外が発生しました")
+            finally:
+                with self._cond:
+                    self._running -= 1
+
+    def _execute(self, job):
+        token = _current_job.set(job)
+        try:
+            checkpoint()
+            result = job.fn(*job.args, **job.kwargs)
+        except Cancelled as e:
+            job._finish("cancelled", error=e)
+        except BaseException as e:
+            # SystemExit や Streamlit の再実行の例外も失敗として終わらせ、待っている側を起こす
+            job._finish("failed", error=e)
+        else:
+            job._finish("done", result=result)
+        finally:
+            _current_job.reset(token)
+        with self._cond:
+            self.counts["completed" if job.state == "done" else job.state] += 1
+
+    def stats(self):
+        """同時実行数・待ち行列・待ち時間の統計"""
+        with self._cond:
+            waits = sorted(self._waits)
+            summary = {
+                "max_workers": self.max_workers,
+                "threads_per_job": self.threads_per_job,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queued": len(self._queue),
+                **{
+                    name: self.counts[name]
+                    for name in (
+                        "submitted",
+                        "completed",
+                        "failed",
+                        "cancelled",
+                        "rejected",
+                    )
+                },
+            }
+        if waits:
+            summary["wait_p50"] = waits[len(waits) // 2]
+            summary["wait_max"] = waits[-1]
+        return summary
+
+
+# --- 処理側から呼ぶ関数 ---
+def checkpoint():
+    """実行中の処理が取り消されていれば Cancelled を送出する (スケジューラの外では何もしない)"""
+    job = _current_job.get()
+    if job is not None and job.cancel_requested:
+        raise Cancelled()
+
+
+def report_progress(done, total):
+    """実行中の処理の進み具合を報告する (呼び出し側の on_wait で表示できる)"""
+    job = _current_job.get()
+    if job is not None:
+        job.progress = (done, total)
+
+
+def run(fn, *args, on_wait=None, **kwargs):
+    """fn(*args, **kwargs) を共有のスケジューラで実行し、終わるまで待って結果を返す
+
+    待っている間は POLL_INTERVAL ごとに on_wait(job) を呼びます (待ち順や進み具合の表示用)。
+    on_wait の中で例外が起きた場合 (Streamlit の再実行・停止など) や、待っている間に
+    割り込まれた場合は、処理を取り消してから例外をそのまま送出します。
+    スケジューラの処理の中から呼んだ場合は、その場で実行します (ワーカーを2つ占有しない)。
+    """
+    if _current_job.get() is not None:
+        return fn(*args, **kwargs)
+    job = get_scheduler().submit(fn, *args, **kwargs)
+    try:
+        if on_wait is not None:
+            on_wait(job)
+            while not job.wait(POLL_INTERVAL):
+                on_wait(job)
+        return job.result()
+    except BaseException:
+        job.cancel()
+        raise
+
+
+def describe_wait(job):
+    """待ち順・進み具合を表示用の文にする (実行中で進み具合の報告がなければ None)"""
+    position = job.position()
+    if position:
+        return f"⏳ 順番待ちです ({position}番目)。他の処理が終わりしだい開始します..."
+    if job.progress is not None:
+        done, total = job.progress
+        return f"⚙️ 処理中です... {done}/{total}"
+    return None
+
+
+# --- プロセス全体で共有するスケジューラ ---
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def configured_budget():
+    """環境変数の設定から (同時に実行する処理の数, 1件あたりのスレッド数) を返す"""
+    budget = max(1, _env_int("IMAGEFORGE_CPU_BUDGET", _cpu_count()))
+    max_workers = max(1, _env_int("IMAGEFORGE_MAX_JOBS", budget // 2))
+    return max_workers, max(1, budget // max_workers)
+
+
+def get_scheduler():
+    """環境変数の設定でプロセス共有のスケジューラを作って返す (スレッド数の上限もここで設定)"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            max_workers, threads_per_job = configured_budget()
+            limit_threads(threads_per_job)
+            _scheduler = Scheduler(
+                max_workers=max_workers,
+                max_queue=_env_int("IMAGEFORGE_MAX_QUEUE", DEFAULT_MAX_QUEUE),
+                threads_per_job=threads_per_job,
+            )
+        return _scheduler
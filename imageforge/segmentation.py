@@ -0,0 +1,404 @@
+# imageforge/segmentation.py
+"""背景除去 (rembg) の推論セッション管理
+
+rembg.remove() をセッション無しで呼ぶと、新しい画像のたびに ONNX モデルを読み込み直します。
+ここではサーバープロセス全体で共有するセッションプールを1つだけ作り、起動時に
+サンプル画像で1回推論してウォームアップしておきます。
+
+複数枚をまとめて処理する場合は iter_remove_background() を使います。デコードは
+スレッドで先読みし (先読みする枚数には上限があります)、u2net 系のモデルでは
+batch_size 枚ずつ1回の推論にまとめます。
+
+モデルの入力は 320×320 なので、フル解像度の画像を渡しても細部は推論に使われません。
+推論のモード (MATTE_MODES) に "lowres" を選ぶと、長辺 WORK_SIZE px に縮小した画像で
+推論し、マスクは元の画像の輪郭に沿って拡大します (matte.guided_upsample)。
+"lowres_refine" はさらに、被写体の周りを切り出してもう一度推論し、縁を細かくします。
+
+環境変数で設定できます:
+    IMAGEFORGE_REMBG_MODEL          モデル名 (デフォルト: u2net)
+    IMAGEFORGE_REMBG_POOL_SIZE      同時に推論できるセッション数 (デフォルト: 1)
+    IMAGEFORGE_ORT_INTRA_THREADS    onnxruntime の intra-op スレッド数
+                                    (0 = 自動。デフォルトは imageforge.scheduler の1件あたりのスレッド数)
+    IMAGEFORGE_ORT_INTER_THREADS    onnxruntime の inter-op スレッド数 (0 = 自動)
+"""
+import collections
+import contextlib
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from imageforge import ingest, matte, metrics, scheduler
+
+# --- 定数 ---
+DEFAULT_MODEL = "u2net"
+SAMPLE_IMAGE_PATH = "assets/sample.png"
+LATENCY_WINDOW = 200  # 統計に使う直近の推論回数
+BATCH_SIZE = 4  # まとめて推論する枚数
+MAX_PENDING = 8  # デコード済みで推論待ちにしておく最大枚数
+DECODE_WORKERS = 2
+
+# 入力を 320x320 に縮小して推論するモデル (rembg の U2netSession / U2netpSession と同じ前処理)
+BATCHABLE_MODELS = ("u2net", "u2netp")
+U2NET_MEAN = (0.485, 0.456, 0.406)
+U2NET_STD = (0.229, 0.224, 0.225)
+U2NET_SIZE = (320, 320)
+
+# 推論のモード -> 表示名
+MATTE_MODES = {
+    "full": "フル解像度の画像で推論",
+    "lowres": "縮小して推論 (高速)",
+    "lowres_refine": "縮小して推論 + 被写体の周りを再推論",
+}
+WORK_SIZE = 512  # 縮小して推論するときの長辺 px
+REFINE_MARGIN = 0.1  # 再推論する範囲の余白 (被写体の外接矩形の長辺に対する割合)
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+class SessionPool:
+    """rembg の推論セッションを使い回すプール (スレッドセーフ)"""
+
+    def __init__(
+        self,
+        model_name=DEFAULT_MODEL,
+        size=1,
+        intra_op_threads=0,
+        inter_op_threads=0,
+    ):
+        self.model_name = model_name
+        self.size = max(1, size)
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.load_seconds = None
+        self.warmup_seconds = None
+        self._sessions = queue.Queue()
+        self._load_lock = threading.Lock()
+        self._loaded = False
+        self._stats_lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.inference_count = 0
+
+    def _new_session(self):
+        import onnxruntime as ort
+        from rembg import new_session
+
+        sess_opts = ort.SessionOptions()
+        sess_opts.intra_op_num_threads = self.intra_op_threads
+        sess_opts.inter_op_num_threads = self.inter_op_threads
+        return new_session(self.model_name, sess_opts=sess_opts)
+
+    def load(self):
+        """セッションをまだ作っていなければ作る (2回目以降は何もしない)"""
+        with self._load_lock:
+            if self._loaded:
+                return
+            start = time.perf_counter()
+            for _ in range(self.size):
+                self._sessions.put(self._new_session())
+            self.load_seconds = time.perf_counter() - start
+            self._loaded = True
+
+    @contextlib.contextmanager
+    def session(self):
+        """空いているセッションを1つ借りる (全て使用中なら空くまで待つ)"""
+        self.load()
+        session = self._sessions.get()
+        try:
+            yield session
+        finally:
+            self._sessions.put(session)
+
+    def remove(self, image, **kwargs):
+        """rembg.remove() をプールのセッションで実行する"""
+        from rembg import remove
+
+        with self.session() as session:
+            start = time.perf_counter()
+            result = remove(image, session=session, **kwargs)
+            elapsed = time.perf_counter() - start
+        self._record(elapsed, 1)
+        return result
+
+    def predict_masks(self, images, mode="full", work_size=WORK_SIZE):
+        """複数の画像のアルファマット (L モード、画像と同じサイズ) をまとめて推論する
+
+        mode は MATTE_MODES のどれかです。画像の向き (EXIF) は呼び出し側で補正しておきます。
+        """
+        if mode not in MATTE_MODES:
+            raise ValueError(f"未知の推論モードです: {mode}")
+        if mode == "full":
+            return self._infer(images)
+        with metrics.stage("matte_downscale"):
+            small = [model_input(img, work_size) for img in images]
+        masks = self._infer(small)
+        del small
+        boxes = [None] * len(images)
+        if mode == "lowres_refine":
+            boxes = [refine_box(img, mask) for img, mask in zip(images, masks)]
+            targets = [i for i, box in enumerate(boxes) if box is not None]
+            if targets:
+                with metrics.stage("matte_refine"):
+                    crops = [
+                        model_input(images[i], work_size, boxes[i]) for i in targets
+                    ]
+                    for i, mask in zip(targets, self._infer(crops)):
+                        masks[i] = mask
+        with metrics.stage("matte_upsample"):
+            return [
+                upsample_mask(img, mask, box)
+                for img, mask, box in zip(images, masks, boxes)
+            ]
+
+    def _infer(self, images):
+        """画像と同じサイズのマスクを推論する (前処理・後処理は rembg と同じ)"""
+        with self.session() as session, metrics.stage("matte_inference"):
+            start = time.perf_counter()
+            if _supports_batching(session):
+                masks = _predict_masks_batched(session, images)
+            else:
+                masks = [session.predict(img)[0] for img in images]
+            elapsed = time.perf_counter() - start
+        # バッチの所要時間を1枚あたりに均して記録する
+        self._record(elapsed / len(images), len(images))
+        return masks
+
+    def remove_batch(self, images, mode="full"):
+        """複数の画像の背景をまとめて除去し、RGBA 画像のリストを返す
+
+        mode が "full" なら、結果は remove() をデフォルト引数で1枚ずつ呼んだ場合と
+        同じ処理 (マスク推論 → そのままアルファとして合成) です。EXIF の向きは
+        読み込み時 (ingest.decode) に反映済みの画像を渡してください。
+        """
+        masks = self.predict_masks(images, mode)
+        return [matte.cutout(img, mask) for img, mask in zip(images, masks)]
+
+    def _record(self, latency, count):
+        with self._stats_lock:
+            self._latencies.extend([latency] * count)
+            self.inference_count += count
+
+    def warm_up(self, sample_path=SAMPLE_IMAGE_PATH):
+        """サンプル画像で1回推論し、初回リクエストの遅延をなくす"""
+        self.load()
+        start = time.perf_counter()
+        if os.path.exists(sample_path):
+            with Image.open(sample_path) as img:
+                sample = img.convert("RGB")
+            sample.thumbnail((320, 320))
+            with self.session() as session:
+                session.predict(sample)
+        self.warmup_seconds = time.perf_counter() - start
+
+    def stats(self):
+        """モデルの読み込み時間と推論レイテンシの統計"""
+        with self._stats_lock:
+            latencies = sorted(self._latencies)
+            count = self.inference_count
+        summary = {
+            "model": self.model_name,
+            "pool_size": self.size,
+            "intra_op_threads": self.intra_op_threads,
+            "inter_op_threads": self.inter_op_threads,
+            "load_seconds": self.load_seconds,
+            "warmup_seconds": self.warmup_seconds,
+            "inferences": count,
+        }
+        if latencies:
+            summary["latency_mean"] = sum(latencies) / len(latencies)
+            summary["latency_p50"] = latencies[len(latencies) // 2]
+            summary["latency_max"] = latencies[-1]
+        return summary
+
+
+# --- バッチ推論 ---
+def _supports_batching(session):
+    """u2net 系で、モデルの入力のバッチ次元が可変なら True"""
+    if getattr(session, "model_name", None) not in BATCHABLE_MODELS:
+        return False
+    batch_dim = session.inner_session.get_inputs()[0].shape[0]
+    return not isinstance(batch_dim, int)
+
+
+def _predict_masks_batched(session, images):
+    """U2netSession.predict() と同じ前処理・後処理で、複数枚を1回の推論で処理する"""
+    inputs = [
+        session.normalize(img, U2NET_MEAN, U2NET_STD, U2NET_SIZE) for img in images
+    ]
+    input_name = next(iter(inputs[0]))
+    batch = np.concatenate([x[input_name] for x in inputs])
+    preds = session.inner_session.run(None, {input_name: batch})[0][:, 0, :, :]
+
+    masks = []
+    for img, pred in zip(images, preds):
+        # 正規化は1枚ずつ (バッチ全体の最大・最小を使うと結果が変わる)
+        pred = (pred - pred.min()) / (pred.max() - pred.min())
+        mask = Image.fromarray((pred.clip(0, 1) * 255).astype("uint8"), mode="L")
+        masks.append(mask.resize(img.size, Image.Resampling.LANCZOS))
+    return masks
+
+
+# --- 縮小して推論するモード ---
+def model_input(image, work_size=WORK_SIZE, box=None):
+    """推論に渡す、長辺 work_size px に縮小した画像 (box を渡すとその範囲だけ)
+
+    元の画像の方が小さければ縮小しません。
+    """
+    left, top, right, bottom = box or (0, 0, *image.size)
+    w, h = right - left, bottom - top
+    scale = work_size / max(w, h)
+    if scale >= 1:
+        return image if box is None else image.crop(box)
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    # reducing_gap: まず整数分の1に縮小してから補間する (フル解像度のコピーを作らない)
+    return image.resize(size, Image.Resampling.BILINEAR, box=box, reducing_gap=2.0)
+
+
+def refine_box(image, mask):
+    """縮小して推論したマスクから、再推論する範囲 (元の画像の座標)。被写体が無ければ None"""
+    bbox = matte.subject_bbox(mask)
+    if bbox is None:
+        return None
+    sx, sy = image.width / mask.width, image.height / mask.height
+    left, top, right, bottom = bbox
+    margin = REFINE_MARGIN * max((right - left) * sx, (bottom - top) * sy)
+    return (
+        max(0, int(left * sx - margin)),
+        max(0, int(top * sy - margin)),
+        min(image.width, int(right * sx + margin + 0.5)),
+        min(image.height, int(bottom * sy + margin + 0.5)),
+    )
+
+
+def upsample_mask(image, mask, box=None):
+    """縮小して推論したマスクを、画像の輪郭に沿って画像と同じサイズにする
+
+    box を渡すと、mask はその範囲のマスクとみなし、範囲の外は背景 (0) にします。
+    """
+    guide = image.convert("L")
+    if box is None:
+        return matte.guided_upsample(guide, mask)
+    full = Image.new("L", image.size, 0)
+    full.paste(matte.guided_upsample(guide.crop(box), mask), box[:2])
+    return full
+
+
+def _decode(data):
+    return ingest.decode(data)[0]
+
+
+def iter_remove_background(
+    sources,
+    pool=None,
+    mode="full",
+    batch_size=BATCH_SIZE,
+    max_pending=MAX_PENDING,
+    decode_workers=DECODE_WORKERS,
+):
+    """(名前, 画像バイト列) を順に受け取り、(名前, RGBA画像 or None, エラー or None) を返す
+
+    結果は入力と同じ順に1枚ずつ返すので、呼び出し側で保存してから次を受け取れば
+    メモリに残る画像は高々 max_pending + batch_size 枚です。デコードに失敗した画像は
+    エラーとして返し、残りの処理は続けます。mode は推論のモード (MATTE_MODES) です。
+    """
+    pool = pool or get_pool()
+    sources = iter(sources)
+    pending = collections.deque()  # (名前, デコード中の Future)
+
+    with ThreadPoolExecutor(decode_workers) as executor:
+
+        def fill():
+            # 推論待ちが上限に達するまで次の画像のデコードを投入する
+            while len(pending) < max_pending:
+                item = next(sources, None)
+                if item is None:
+                    return
+                name, data = item
+                pending.append((name, executor.submit(_decode, data)))
+
+        fill()
+        while pending:
+            # デコードに失敗した画像も入力順を保つため、エラーとしてバッチに残す
+            batch = []
+            decoded = []
+            while pending and len(decoded) < batch_size:
+                name, future = pending.popleft()
+                try:
+                    image = future.result()
+                except Exception as e:
+                    batch.append([name, None, e])
+                    continue
+                decoded.append(len(batch))
+                batch.append([name, image, None])
+            fill()
+            if decoded:
+                try:
+                    results = pool.remove_batch([batch[i][1] for i in decoded], mode)
+                except Exception as e:
+                    results = [None] * len(decoded)
+                    for i in decoded:
+                        batch[i][2] = e
+                for i, result in zip(decoded, results):
+                    batch[i][1] = result
+                del results
+            while batch:
+                yield tuple(batch.pop(0))
+
+
+# --- プロセス全体で共有するプール ---
+_pool = None
+_pool_lock = threading.Lock()
+_warmup_thread = None
+
+
+def get_pool():
+    """環境変数の設定でプロセス共有のプールを作って返す (セッションの読み込みは遅延)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SessionPool(
+                model_name=os.environ.get("IMAGEFORGE_REMBG_MODEL", DEFAULT_MODEL),
+                size=_env_int("IMAGEFORGE_REMBG_POOL_SIZE", 1),
+                # 他のセッションの処理とコアを奪い合わないよう、スケジューラの予算に合わせる
+                intra_op_threads=_env_int(
+                    "IMAGEFORGE_ORT_INTRA_THREADS", scheduler.configured_budget()[1]
+                ),
+                inter_op_threads=_env_int("IMAGEFORGE_ORT_INTER_THREADS", 0),
+            )
+        return _pool
+
+
+def _warm_up_quietly(sample_path):
+    # 失敗してもサーバーは止めない (最初の推論時にもう一度読み込みを試みる)
+    try:
+        get_pool().warm_up(sample_path)
+    except Exception:
+        logger.warning("背景除去モデルのウォームアップに失敗しました", exc_info=True)
+
+
+def start_warmup(sample_path=SAMPLE_IMAGE_PATH):
+    """バックグラウンドスレッドでモデルの読み込みとウォームアップを始める (1プロセス1回)"""
+    global _warmup_thread
+    with _pool_lock:
+        if _warmup_thread is not None:
+            return _warmup_thread
+        _warmup_thread = threading.Thread(
+            target=_warm_up_quietly,
+            args=(sample_path,),
+            name="imageforge-rembg-warmup",
+            daemon=True,
+        )
+        _warmup_thread.start()
+        return _warmup_thread
@@ -0,0 +1,524 @@
+# imageforge/server.py
+"""3つのツールをブラウザなしで呼び出すための HTTP サーバー (CLI)
+
+他のサービスから、AIイラスト補正・ピクセルアート・背景除去を HTTP で呼び出せます。
+標準ライブラリの asyncio だけで動くので、追加のパッケージは要りません。
+
+- 接続の受け付けとリクエストの読み書きは asyncio のイベントループで行い、
+  画像の処理 (デコード → 処理 → エンコード) はページと同じ共有のスケジューラ
+  (imageforge.scheduler) のワーカーで実行します。同時に実行する数・待ち行列の上限も
+  ページと同じ IMAGEFORGE_MAX_JOBS / IMAGEFORGE_MAX_QUEUE に従い、あふれた
+  リクエストには 503 を返します。
+- 同じ画像 (内容のハッシュ) を同じエンドポイント・パラメータで処理するリクエストが
+  処理中に届いた場合は、新しく計算せずに処理中の結果を待って同じものを返します
+  (重複したアップロードが集中しても計算は1回)。
+- 結果は chunked 転送で少しずつ書き出し、相手が受け取るのを待ちながら送ります。
+- GET /stats で待ち行列の深さと、エンドポイントごとのレイテンシ (p50 / p95 / p99) を
+  JSON で返します。
+
+エンドポイント (本文はアップロードする画像のバイト列そのもの):
+    POST /correct            AIイラスト補正 (params=JSON, seed, format)
+    POST /pixelart           ピクセルアート (pixel_size, style, method, dither, palette,
+                             scale, format)
+    POST /remove-background  背景除去 (format, matte)
+    GET  /stats              待ち行列の深さ・エンドポイントごとのレイテンシ
+    GET  /health             動作確認
+
+使い方:
+    python -m imageforge.server --port 8765
+    curl --data-binary @in.png "http://127.0.0.1:8765/pixelart?pixel_size=8&style=PICO-8" -o out.png
+"""
+import argparse
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import sys
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+from imageforge import (
+    cache,
+    correction,
+    encoding,
+    ingest,
+    metrics,
+    scheduler,
+    segmentation,
+)
+from imageforge.batch import merge_params
+from imageforge.correction import process_image
+from imageforge.pixelart import (
+    DOWNSAMPLE_METHODS,
+    MAX_PALETTE_COLORS,
+    PALETTE_STYLES,
+    parse_palette,
+    render_pixel_art,
+)
+
+logger = logging.getLogger(__name__)
+
+# --- 定数 ---
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+MAX_BODY_MB = 50  # アップロードできる画像の上限
+CHUNK_SIZE = 64 * 1024  # 結果を書き出す単位
+KEEPALIVE_TIMEOUT = 30  # 次のリクエストを待つ秒数
+MAX_HEADERS = 100
+LATENCY_WINDOW = 1000  # 統計に使う直近のリクエストの数
+REMOVER_FORMATS = ("png", "webp", "jpeg")  # 透明部分があるのでパレット PNG は使わない
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    411: "Length Required",
+    413: "Payload Too Large",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class HTTPError(Exception):
+    """クライアントに返すエラー (ステータスコードとメッセージ)"""
+
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+# --- クエリの読み取り ---
+def _int(query, name, default, low, high):
+    value = query.get(name)
+    if value in (None, ""):
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f"{name} は整数で指定してください: {value}") from None
+    if not low <= number <= high:
+        raise ValueError(f"{name} は {low}〜{high} で指定してください: {number}")
+    return number
+
+
+def _choice(query, name, default, choices):
+    value = query.get(name) or default
+    if value not in choices:
+        raise ValueError(f"{name} は {', '.join(choices)} のいずれかです: {value}")
+    return value
+
+
+# --- エンドポイント (parse はイベントループで、run はスケジューラのワーカーで実行) ---
+def parse_correction(query):
+    """補正のクエリ: params (batch の --params と同じ JSON), seed, format"""
+    try:
+        overrides = json.loads(query.get("params") or "{}")
+    except json.JSONDecodeError as e:
+        raise ValueError(f"params の JSON を読み取れません: {e}") from None
+    return {
+        "params": merge_params(overrides),
+        "seed": _int(query, "seed", None, 0, 2**32 - 1),
+        "fmt": _choice(query, "format", "png", list(encoding.OUTPUT_FORMATS)),
+    }
+
+
+def run_correction(body, params, seed, fmt):
+    with metrics.record(
+        "server_correction", params=correction.params_for_log(params), fmt=fmt
+    ):
+        fixed_pil = process_image(ingest.decode(body)[0], params, seed=seed)
+        return encoding.encode_image(fixed_pil, fmt)
+
+
+def parse_pixelart(query):
+    """ピクセルアートのクエリ: ページのサイドバーと同じ項目"""
+    style = _choice(query, "style", "オリジナル", PALETTE_STYLES)
+    options = {
+        "pixel_size": _int(query, "pixel_size", 10, 2, 50),
+        "style": style,
+        "method": _choice(query, "method", "nearest", list(DOWNSAMPLE_METHODS)),
+        "scale": _int(query, "scale", None, 1, 8),
+        "fmt": _choice(query, "format", "png_palette", list(encoding.OUTPUT_FORMATS)),
+    }
+    try:
+        options["dither"] = float(query.get("dither") or 0.0)
+    except ValueError:
+        raise ValueError("dither は 0〜1 の数で指定してください") from None
+    if not 0.0 <= options["dither"] <= 1.0:
+        raise ValueError("dither は 0〜1 の数で指定してください")
+    palette = parse_palette(query.get("palette", ""))
+    if len(palette) > MAX_PALETTE_COLORS:
+        raise ValueError(f"palette は{MAX_PALETTE_COLORS}色までです: {len(palette)}色")
+    options["custom_palette"] = palette
+    return options
+
+
+def run_pixelart(body, fmt, **options):
+    with metrics.record(
+        "server_pixelart",
+        **{k: v for k, v in options.items() if k != "custom_palette"},
+        fmt=fmt,
+    ):
+        image, _ = ingest.decode(body)
+        return encoding.encode_image(render_pixel_art(image, **options), fmt)
+
+
+def parse_background_removal(query):
+    """背景除去のクエリ: format, matte (推論のモード)"""
+    return {
+        "fmt": _choice(query, "format", "png", REMOVER_FORMATS),
+        "matte_mode": _choice(query, "matte", "full", list(segmentation.MATTE_MODES)),
+    }
+
+
+def run_background_removal(body, fmt, matte_mode="full"):
+    with metrics.record("server_background_removal", fmt=fmt, matte_mode=matte_mode):
+        image, _ = ingest.decode(body)
+        cutout = segmentation.get_pool().remove_batch([image], matte_mode)[0]
+        return encoding.encode_image(cutout, fmt)
+
+
+ENDPOINTS = {
+    "/correct": (parse_correction, run_correction),
+    "/pixelart": (parse_pixelart, run_pixelart),
+    "/remove-background": (parse_background_removal, run_background_removal),
+}
+
+
+# --- リクエスト ---
+class Request:
+    """読み取った HTTP リクエスト1件"""
+
+    def __init__(self, method, target, version, headers, body):
+        self.method = method
+        parts = urlsplit(target)
+        self.path = parts.path
+        self.query = dict(parse_qsl(parts.query, keep_blank_values=True))
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+
+async def _readline(reader):
+    """1行読む (ストリームの上限より長い行は 431 にする)"""
+    try:
+        return await reader.readline()
+    except (ValueError, asyncio.LimitOverrunError):
+        raise HTTPError(431, "リクエスト行またはヘッダーが長すぎます") from None
+
+
+async def read_request(reader, writer, max_body):
+    """リクエストを1件読む (接続が閉じられた・待ちきれなかった場合は None)"""
+    try:
+        line = await asyncio.wait_for(_readline(reader), KEEPALIVE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return None
+    if not line.strip():
+        return None
+    try:
+        method, target, version = line.decode("latin-1").split()
+    except ValueError:
+        raise HTTPError(400, "リクエスト行を読み取れません") from None
+    headers = {}
+    for _ in range(MAX_HEADERS):
+        line = await _readline(reader)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    else:
+        raise HTTPError(400, "ヘッダーが多すぎます")
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise HTTPError(411, "Content-Length を指定してください")
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise HTTPError(400, "Content-Length を読み取れません") from None
+    if length < 0:
+        raise HTTPError(400, "Content-Length を読み取れません")
+    if length > max_body:
+        raise HTTPError(413, f"画像が大きすぎます (上限 {max_body // 1024 // 1024}MB)")
+    if length and headers.get("expect", "").lower() == "100-continue":
+        writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        await writer.drain()
+    body = await reader.readexactly(length) if length else b""
+    return Request(method.upper(), target, version, headers, body)
+
+
+async def send_response(writer, status, body, content_type, headers=(), stream=False):
+    """レスポンスを書き出す (stream=True なら chunked 転送で少しずつ送る)"""
+    lines = [
+        f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+        f"Content-Type: {content_type}",
+        *(f"{name}: {value}" for name, value in headers),
+    ]
+    lines.append(
+        "Transfer-Encoding: chunked" if stream else f"Content-Length: {len(body)}"
+    )
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+    if not stream:
+        writer.write(body)
+        await writer.drain()
+        return
+    view = memoryview(body)
+    for offset in range(0, len(view), CHUNK_SIZE):
+        chunk = view[offset : offset + CHUNK_SIZE]
+        writer.write(f"{len(chunk):X}\r\n".encode("ascii"))
+        writer.write(chunk)
+        writer.write(b"\r\n")
+        await writer.drain()  # 相手が受け取るまで次を書かない
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+
+# --- 統計 ---
+class EndpointStats:
+    """エンドポイントごとのリクエスト数・相乗り数・レイテンシ"""
+
+    def __init__(self):
+        self.statuses = collections.Counter()
+        self.coalesced = 0
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def record(self, status, seconds):
+        self.statuses[status] += 1
+        self._latencies.append(seconds)
+
+    def summary(self):
+        latencies = list(self._latencies)
+        result = {
+            "requests": sum(self.statuses.values()),
+            "coalesced": self.coalesced,
+            "statuses": {str(k): v for k, v in sorted(self.statuses.items())},
+        }
+        if latencies:
+            result["latency"] = {
+                "p50": metrics.percentile(latencies, 0.5),
+                "p95": metrics.percentile(latencies, 0.95),
+                "p99": metrics.percentile(latencies, 0.99),
+                "max": max(latencies),
+            }
+        return result
+
+
+# --- サーバー ---
+class ProcessingServer:
+    """画像処理の HTTP サーバー (処理中の同じリクエストはまとめて1回だけ計算する)"""
+
+    def __init__(self, max_body=MAX_BODY_MB * 1024 * 1024):
+        self.max_body = max_body
+        self.connections = 0
+        self.waiting = 0  # 結果を待っているリクエストの数 (相乗りを含む)
+        self._in_flight = {}  # キー -> 結果を受け取る asyncio.Future
+        self._stats = {path: EndpointStats() for path in ENDPOINTS}
+
+    async def compute(self, path, key, fn, body, options):
+        """fn(body, **options) の結果を返す。同じキーが処理中ならその結果を待つ"""
+        future = self._in_flight.get(key)
+        if future is not None:
+            self._stats[path].coalesced += 1
+            coalesced = True
+        else:
+            loop = asyncio.get_running_loop()
+            job = scheduler.get_scheduler().submit(fn, body, **options)  # QueueFull
+            future = self._in_flight[key] = loop.create_future()
+            job.add_done_callback(
+                lambda job: loop.call_soon_threadsafe(self._settle, key, future, job)
+            )
+            coalesced = False
+        self.waiting += 1
+        try:
+            # 待っている接続が切れても、相乗りしている他のリクエストのために処理は続ける
+            return await asyncio.shield(future), coalesced
+        finally:
+            self.waiting -= 1
+
+    def _settle(self, key, future, job):
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+        try:
+            future.set_result(job.result())
+        except Exception as e:
+            future.set_exception(e)
+
+    async def handle(self, reader, writer):
+        """1つの接続のリクエストを順に処理する (keep-alive に対応)"""
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    request = await read_request(reader, writer, self.max_body)
+                except HTTPError as e:
+                    await self._send_error(writer, e)
+                    break
+                if request is None:
+                    break
+                await self.dispatch(request, writer)
+                if not request.keep_alive:
+                    break
+        except (
+            ConnectionError,
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+        ):
+            pass  # 相手が途中で切断した
+        finally:
+            self.connections -= 1
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def dispatch(self, request, writer):
+        start = time.perf_counter()
+        status = 500
+        try:
+            if request.path == "/stats" and request.method == "GET":
+                status = 200
+                await self._send_json(writer, status, self.stats())
+            elif request.path == "/health" and request.method == "GET":
+                status = 200
+                await self._send_json(writer, status, {"status": "ok"})
+            elif request.path in ENDPOINTS:
+                status = await self._process(request, writer)
+            else:
+                raise HTTPError(404, f"不明なパスです: {request.path}")
+        except HTTPError as e:
+            status = e.status
+            await self._send_error(writer, e)
+        finally:
+            stats = self._stats.get(request.path)
+            if stats is not None:
+                stats.record(status, time.perf_counter() - start)
+
+    async def _process(self, request, writer):
+        if request.method != "POST":
+            raise HTTPError(405, "POST で画像を送ってください", {"Allow": "POST"})
+        if not request.body:
+            raise HTTPError(400, "本文に画像のバイト列を入れてください")
+        parse, run = ENDPOINTS[request.path]
+        try:
+            options = parse(request.query)
+        except ValueError as e:
+            raise HTTPError(400, str(e)) from None
+        # 大きな画像のハッシュでイベントループを止めない (hashlib は GIL を手放す)
+        content_key = await asyncio.get_running_loop().run_in_executor(
+            None, cache.content_hash, request.body
+        )
+        key = cache.make_key(content_key, request.path, **options)
+        try:
+            data, coalesced = await self.compute(
+                request.path, key, run, request.body, options
+            )
+        except scheduler.QueueFull as e:
+            raise HTTPError(503, str(e), {"Retry-After": "1"}) from None
+        except ingest.ImageTooLarge as e:
+            raise HTTPError(413, str(e)) from None
+        except (OSError, ValueError) as e:
+            raise HTTPError(400, f"画像を処理できません: {e}") from None
+        except Exception as e:
+            logger.exception("処理中にエラーが発生しました: %s", request.path)
+            raise HTTPError(500, f"処理中にエラーが発生しました: {e}") from None
+        await send_response(
+            writer,
+            200,
+            data,
+            encoding.OUTPUT_FORMATS[options["fmt"]]["mime"],
+            [("X-ImageForge-Coalesced", "1" if coalesced else "0")],
+            stream=request.version != "HTTP/1.0",
+        )
+        return 200
+
+    async def _send_json(self, writer, status, payload, headers=()):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        await send_response(
+            writer, status, body, "application/json; charset=utf-8", headers
+        )
+
+    async def _send_error(self, writer, error):
+        await self._send_json(
+            writer, error.status, {"error": str(error)}, list(error.headers.items())
+        )
+
+    def stats(self):
+        """待ち行列の深さ・処理中の計算の数・エンドポイントごとの統計"""
+        return {
+            "connections": self.connections,
+            "waiting_requests": self.waiting,
+            "in_flight": len(self._in_flight),
+            "scheduler": scheduler.get_scheduler().stats(),
+            "endpoints": {path: s.summary() for path, s in self._stats.items()},
+        }
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT, ready=None):
+        """host:port で待ち受ける (ready には待ち受けを始めたサーバーを渡す)"""
+        server = await asyncio.start_server(self.handle, host, port)
+        if ready is not None:
+            ready(server)
+        async with server:
+            await server.serve_forever()
+
+
+# --- CLI ---
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m imageforge.server",
+        description="AIイラスト補正・ピクセルアート・背景除去を HTTP で呼び出せるサーバーを起動します。",
+    )
+    parser.add_argument(
+        "--host",
+        default=DEFAULT_HOST,
+        help=f"待ち受けるアドレス (デフォルト: {DEFAULT_HOST})",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=DEFAULT_PORT,
+        help=f"ポート (デフォルト: {DEFAULT_PORT})",
+    )
+    parser.add_argument(
+        "--max-mb",
+        type=int,
+        default=MAX_BODY_MB,
+        help=f"アップロードできる画像の上限 MB (デフォルト: {MAX_BODY_MB})",
+    )
+    parser.add_argument(
+        "--no-warmup",
+        action="store_true",
+        help="起動時に背景除去モデルを読み込まない (最初の背景除去のときに読み込む)",
+    )
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if not args.no_warmup:
+        segmentation.start_warmup()
+    server = ProcessingServer(max_body=max(1, args.max_mb) * 1024 * 1024)
+
+    def ready(listener):
+        for sock in listener.sockets:
+            host, port = sock.getsockname()[:2]
+            print(f"待ち受けを開始しました: http://{host}:{port}", file=sys.stderr)
+
+    try:
+        asyncio.run(server.serve(args.host, args.port, ready))
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        print(f"待ち受けを開始できません: {e}", file=sys.stderr)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+# imageforge/startup.py
+"""起動時間の計測と、重い依存ライブラリのバックグラウンド先読み
+
+scikit-learn (K-Means) や rembg (onnxruntime・pymatting) は import だけで1秒以上かかるため、
+各モジュールでは使う関数の中で import し、ページを開いただけでは読み込みません。
+代わりに最初のページを表示し終えた直後から、バックグラウンドスレッドで次の順に先読みします。
+
+- scikit-learn: import と小さな K-Means の学習 (初回だけかかる初期化を済ませる)
+- 背景除去モデル: セッションの読み込みとサンプル画像でのウォームアップ
+
+ページ (app.py を含む) は先頭で begin_page(__file__)、最後で end_page(__file__) を呼びます。
+プロセス内で最初に表示したときの時間 (import を含む) を記録し、トップページの
+「🚀 起動時間」に表示します。同じ内容はロガー "imageforge.startup" と
+imageforge.metrics の記録 (tool = "page_first_render") にも出力します。
+"""
+import contextvars
+import logging
+import os
+import threading
+import time
+
+from imageforge import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# --- プロセスの起動時刻 ---
+def _process_age():
+    """プロセスが起動してからの秒数 (Linux の /proc から。取れなければ None)"""
+    try:
+        with open("/proc/self/stat") as f:
+            # 2番目のフィールド (実行ファイル名) は空白を含みうるので ")" の後ろから数える
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# 取れない環境では、このモジュールを最初に import した時刻で代用する
+PROCESS_START = time.perf_counter() - (_process_age() or 0.0)
+
+
+# --- 先読み ---
+def _preload_sklearn():
+    import numpy as np
+    from sklearn.cluster import KMeans
+
+    pixels = np.random.default_rng(0).random((256, 3))
+    KMeans(n_clusters=4, random_state=42, n_init=1, max_iter=10).fit(pixels)
+
+
+def _preload_rembg():
+    from imageforge import segmentation
+
+    segmentation.start_warmup().join()
+    # ウォームアップの失敗はログに出るだけなので、読み込めたかどうかで判定する
+    if segmentation.get_pool().load_seconds is None:
+        raise RuntimeError("背景除去モデルを読み込めませんでした")
+
+
+PRELOADS = [
+    ("scikit-learn (K-Means)", _preload_sklearn),
+    ("背景除去モデル (rembg)", _preload_rembg),
+]
+
+_preload_lock = threading.Lock()
+_preload_thread = None
+_preload_status = {}  # 名前 -> {"state", "seconds"}
+
+
+def _run_preloads():
+    for name, fn in PRELOADS:
+        _preload_status[name] = {"state": "running", "seconds": None}
+        start = time.perf_counter()
+        try:
+            fn()
+            state = "done"
+        except Exception:
+            # 失敗しても、実際に使うときにもう一度読み込みを試みる
+            logger.warning("%s の先読みに失敗しました", name, exc_info=True)
+            state = "failed"
+        _preload_status[name] = {
+            "state": state,
+            "seconds": time.perf_counter() - start,
+        }
+
+
+def start_preload():
+    """バックグラウンドスレッドで重い依存ライブラリの先読みを始める (1プロセス1回)"""
+    global _preload_thread
+    with _preload_lock:
+        if _preload_thread is None:
+            for name, _ in PRELOADS:
+                _preload_status[name] = {"state": "waiting", "seconds": None}
+            _preload_thread = threading.Thread(
+                target=_run_preloads, name="imageforge-preload", daemon=True
+            )
+            _preload_thread.start()
+        return _preload_thread
+
+
+# --- ページの表示時間 ---
+_page_start = contextvars.ContextVar("imageforge_page_start", default=None)
+_pages_lock = threading.Lock()
+_pages = {}  # ページ名 -> 表示時間の記録
+
+
+def _page_name(path):
+    return os.path.basename(path)
+
+
+def begin_page(path):
+    """ページのスクリプトの先頭で呼ぶ (以降の import も表示時間に含める)"""
+    _page_start.set((_page_name(path), time.perf_counter()))
+
+
+def end_page(path):
+    """ページのスクリプトの最後で呼ぶ。プロセス内で最初の表示ならログにも出力する
+
+    先読みもここで始めます (表示中のページの import と GIL を取り合わないように)。
+    """
+    start_preload()
+    started = _page_start.get()
+    name = _page_name(path)
+    if started is None or started[0] != name:
+        return
+    _page_start.set(None)
+    now = time.perf_counter()
+    seconds = now - started[1]
+    with _pages_lock:
+        entry = _pages.get(name)
+        first = entry is None
+        if first:
+            entry = _pages[name] = {
+                "first_seconds": seconds,
+                "since_process_start": now - PROCESS_START,
+                "renders": 0,
+            }
+        entry["renders"] += 1
+        entry["last_seconds"] = seconds
+    if first:
+        run = metrics.Run(
+            "page_first_render",
+            page=name,
+            since_process_start=entry["since_process_start"],
+        )
+        run.seconds = seconds
+        metrics.emit_run(run)
+        logger.info(
+            "%s の初回表示: %.0fms (プロセス起動から %.1f秒)",
+            name,
+            seconds * 1000,
+            entry["since_process_start"],
+        )
+
+
+# --- 表示用 ---
+PRELOAD_STATES = {
+    "waiting": "待機中",
+    "running": "読み込み中",
+    "done": "完了",
+    "failed": "失敗",
+}
+
+
+def pages_table():
+    """ページごとの初回表示時間を表示用の行 (dict) にする"""
+    with _pages_lock:
+        items = sorted(_pages.items(), key=lambda item: item[1]["since_process_start"])
+        return [
+            {
+                "ページ": name,
+                "初回表示 (ms)": round(entry["first_seconds"] * 1000, 1),
+                "プロセス起動から (秒)": round(entry["since_process_start"], 1),
+                "直近の表示 (ms)": round(entry["last_seconds"] * 1000, 1),
+                "表示回数": entry["renders"],
+            }
+            for name, entry in items
+        ]
+
+
+def preload_table():
+    """先読みの状態と所要時間を表示用の行 (dict) にする"""
+    return [
+        {
+            "先読み": name,
+            "状態": PRELOAD_STATES[status["state"]],
+            "時間 (ms)": (
+                None if status["seconds"] is None else round(status["seconds"] * 1000)
+            ),
+        }
+        for name, status in list(_preload_status.items())
+    ]
@@ -0,0 +1,372 @@
+# imageforge/tiling.py
+"""超大判画像向けのタイル (ストリップ) 処理
+
+16K×16K のような画像でも、メモリ使用量を memory_budget 程度に抑えて process_image() と
+同じ補正を行います。画像は横幅いっぱいの帯 (ストリップ) に分割して処理します。
+色収差の水平シフトは画像の左右端で折り返すため、横方向には分割しません。
+
+処理の流れ:
+    1. 入力をディスク上の作業ファイル (np.memmap) に展開する
+    2. ノイズ・明るさ (乱数列の順序を保つため上から順に処理) と輝度合計の集計
+    3. コントラスト・彩度 (全体の平均輝度を使用、並列)
+    4. K-Means: バイラテラルフィルタ後の色ヒストグラムを全ストリップで集計し、
+       重心を1回だけ学習してから LUT で割り当てる (並列)
+    5. シャープネス・色収差・ビネットを、カーネル半径ぶんののりしろ付きで処理し (並列)、
+       上から順に PNG エンコーダへ書き出す
+
+各段の計算は process_image() と同じ式・同じ丸めで行うため、タイル境界に継ぎ目は出ず、
+K-Means 高速モード ("fast") の process_image() と完全に一致します。K-Means は
+ストリップ単位で全画素を学習できないため、kmeans_mode に関わらず高速モードで処理します。
+入力が PNG / JPEG の場合、デコード時だけは PIL が画像1枚ぶんのメモリを使います
+(np.save で保存した .npy を渡すとデコードも含めて予算内に収まります)。画像ファイルは
+ページと同じく imageforge.ingest でデコードするので、画素数の上限 (max_pixels、
+デフォルトは IMAGEFORGE_MAX_PIXELS) を確かめ、EXIF の向きも適用します。
+
+使い方:
+    python -m imageforge.tiling INPUT OUTPUT.png --params params.json --budget-mb 512
+"""
+import argparse
+import collections
+import math
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from imageforge import ingest, lens
+from imageforge.correction import DEFAULT_PARAMS, apply_sharpness, sharpness_sigma
+from imageforge.inplace import (
+    PeakTracker,
+    contrast_mean,
+    contrast_saturation_band,
+    gaussian_radius,
+    noise_brightness_band,
+)
+from imageforge.quantize import (
+    accumulate_histogram,
+    bilateral_prefilter,
+    bin_indices,
+    empty_histogram,
+    fit_palette_lut,
+)
+
+# --- 定数 ---
+DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024
+# ストリップ1行・1画素あたりに必要な作業メモリの目安 (float64 のノイズ + 一時配列)
+BYTES_PER_PIXEL = 64
+BILATERAL_HALO = 1  # bilateralFilter(d=3) の半径
+
+
+# --- PNG のストリーミング書き出し ---
+class StreamingPNGWriter:
+    """RGB 画像を上から順に行単位で PNG に書き出す (画像全体をメモリに持たない)"""
+
+    def __init__(self, path, width, height, compress_level=6):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self._tmp_path = path + ".part"
+        self._file = open(self._tmp_path, "wb")
+        self._compressor = zlib.compressobj(compress_level)
+        self._prev_row = np.zeros((width, 3), dtype=np.uint8)
+        self._file.write(b"\x89PNG\r\n\x1a\n")
+        # 8bit RGB, 圧縮方式0, フィルタ方式0, インターレースなし
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        self._file.write(struct.pack(">I", len(data)))
+        self._file.write(kind)
+        self._file.write(data)
+        self._file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def write_rows(self, rows):
+        """rows (n×width×3, uint8) を追記する"""
+        n = rows.shape[0]
+        # フィルタ "Up" (種類2): 1行上との差分を書くと圧縮率が上がる
+        previous = np.concatenate([self._prev_row[None], rows[:-1]])
+        filtered = np.empty((n, 1 + self.width * 3), dtype=np.uint8)
+        filtered[:, 0] = 2
+        filtered[:, 1:] = (rows - previous).reshape(n, -1)
+        data = self._compressor.compress(filtered.tobytes())
+        if data:
+            self._chunk(b"IDAT", data)
+        self._prev_row = rows[-1].copy()
+        self.rows_written += n
+
+    def close(self):
+        if self.rows_written != self.height:
+            self._file.close()
+            os.remove(self._tmp_path)
+            raise ValueError(
+                f"書き込まれた行数 ({self.rows_written}) が画像の高さ ({self.height}) と一致しません"
+            )
+        self._chunk(b"IDAT", self._compressor.flush())
+        self._chunk(b"IEND", b"")
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+
+# --- 内部ヘルパー ---
+def _strips(height, rows):
+    return [(y0, min(height, y0 + rows)) for y0 in range(0, height, rows)]
+
+
+def _strip_rows(width, memory_budget, workers):
+    # 並列に処理中のストリップと、書き出し待ちのストリップの両方が予算内に収まるようにする
+    in_flight = workers * 2
+    return max(16, memory_budget // (width * BYTES_PER_PIXEL * in_flight))
+
+
+def _load_source(src, tmp_dir, rows, max_pixels=None):
+    """入力 (パス / バイト列 / PIL Image / ndarray) を作業用の memmap (H×W×3, uint8) に展開する"""
+    if isinstance(src, (str, os.PathLike)):
+        if str(src).endswith(".npy"):
+            src = np.load(src, mmap_mode="r")
+        else:
+            with open(src, "rb") as f:
+                src = f.read()
+    if isinstance(src, (bytes, bytearray)):
+        # 画素数の上限の確認と EXIF の向きの適用は、ページと同じ ingest で行う
+        src, _ = ingest.decode(bytes(src), limit=max_pixels)
+    if isinstance(src, np.ndarray):
+        h, w = src.shape[:2]
+        get_rows = lambda y0, y1: src[y0:y1, :, :3]
+    else:
+        img = src.convert("RGB") if src.mode != "RGB" else src
+        w, h = img.size
+        get_rows = lambda y0, y1: np.asarray(img.crop((0, y0, w, y1)))
+    work = np.memmap(
+        os.path.join(tmp_dir, "work.u8"), dtype=np.uint8, mode="w+", shape=(h, w, 3)
+    )
+    for y0, y1 in _strips(h, rows):
+        work[y0:y1] = get_rows(y0, y1)
+    return work
+
+
+def _kmeans_filter_strip(work, filtered, y0, y1):
+    """バイラテラルフィルタ (のりしろ1行) をかけ、ストリップのヒストグラムを返す"""
+    h = work.shape[0]
+    top, bottom = max(0, y0 - BILATERAL_HALO), min(h, y1 + BILATERAL_HALO)
+    # bilateralFilter はチャンネル順に依存しないため RGB のまま処理する
+    strip = bilateral_prefilter(np.ascontiguousarray(work[top:bottom]))
+    strip = strip[y0 - top : y1 - top]
+    filtered[y0:y1] = strip
+    counts, sums = empty_histogram()
+    accumulate_histogram(strip.reshape(-1, 3), counts, sums)
+    return counts, sums
+
+
+def _finish_strip(work, params, y0, y1, halo_sharp, halo_radial):
+    """シャープネス・色収差・ビネットをかけた最終ストリップを返す"""
+    h, w, _ = work.shape
+    halo = halo_sharp + halo_radial
+    top, bottom = max(0, y0 - halo), min(h, y1 + halo)
+    src = np.ascontiguousarray(work[top:bottom])
+    # シャープネス: 色収差ののりしろ分まで正しい値が残るように切り出す
+    src = apply_sharpness(src, params["sharpness"])
+    keep_top = max(0, y0 - halo_radial)
+    keep_bottom = min(h, y1 + halo_radial)
+    src = src[keep_top - top : keep_bottom - top]
+
+    strength = params["chromatic_aberration"]
+    if strength > 0:
+        if params.get("aberration_mode", "shift") == "radial":
+            out = src[y0 - keep_top : y1 - keep_top].copy()
+            maps = lens.radial_maps_rows(w, h, strength, y0, y1, row_offset=keep_top)
+            for channel, (map_x, map_y) in zip((0, 2), maps):
+                plane = np.ascontiguousarray(src[..., channel])
+                # 全体処理と同じ固定小数点テーブルに変換してから remap する
+                map1, map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+                warped = cv2.remap(
+                    plane, map1, map2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT
+                )
+                out[..., channel] = lens.blend_channel(
+                    plane[y0 - keep_top : y1 - keep_top], warped
+                )
+        else:
+            strip = src[y0 - keep_top : y1 - keep_top]
+            out = lens.shift_channels(strip, lens.aberration_offset(w, h, strength))
+    else:
+        out = src[y0 - keep_top : y1 - keep_top]
+
+    if params["vignette_strength"] > 0:
+        gain = lens.vignette_gain_rows(w, h, params["vignette_strength"], y0, y1)
+        out = (out * gain).astype(np.uint8)
+    return np.ascontiguousarray(out)
+
+
+# --- 公開関数 ---
+def process_image_tiled(
+    src,
+    dst_path,
+    params,
+    seed=None,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+    workers=None,
+    tmp_dir=None,
+    max_pixels=None,
+):
+    """src を補正して dst_path (PNG) に書き出し、統計情報の dict を返す
+
+    src には画像ファイルのパス・バイト列、.npy のパス、PIL Image、(H×W×3) の ndarray を
+    渡せます。画像ファイルの画素数が max_pixels (None なら IMAGEFORGE_MAX_PIXELS) を
+    超える場合は ingest.ImageTooLarge を送出します。
+    """
+    start = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    rng = None if seed is None else np.random.RandomState(seed)
+    rand = np.random.rand if rng is None else rng.rand
+
+    with tempfile.TemporaryDirectory(
+        dir=tmp_dir, prefix="imageforge-tiles-"
+    ) as work_dir, PeakTracker() as tracker, ThreadPoolExecutor(workers) as pool:
+        probe_rows = 256
+        work = _load_source(src, work_dir, probe_rows, max_pixels)
+        h, w, _ = work.shape
+        rows = _strip_rows(w, memory_budget, workers)
+        strips = _strips(h, rows)
+
+        # 1. ノイズ・明るさ (乱数列の順序を従来と揃えるため上から順に)
+        luma_sum = 0
+        for y0, y1 in strips:
+            luma_sum += noise_brightness_band(work[y0:y1], params, rand)
+
+        # 2. コントラスト・彩度 (画素ごとの処理なので並列)
+        mean = contrast_mean(luma_sum, h * w) if params["contrast"] != 1.0 else 0
+        list(
+            pool.map(
+                lambda s: contrast_saturation_band(work[s[0] : s[1]], params, mean),
+                strips,
+            )
+        )
+
+        # 3. K-Means: 全体のヒストグラムで重心を1回だけ学習する
+        if params["use_kmeans"]:
+            filtered = np.memmap(
+                os.path.join(work_dir, "filtered.u8"),
+                dtype=np.uint8,
+                mode="w+",
+                shape=(h, w, 3),
+            )
+            counts, sums = empty_histogram()
+            for strip_counts, strip_sums in pool.map(
+                lambda s: _kmeans_filter_strip(work, filtered, *s), strips
+            ):
+                counts += strip_counts
+                sums += strip_sums
+            lut = fit_palette_lut(counts, sums, params["k_value"])
+
+            def assign(strip):
+                y0, y1 = strip
+                pixels = np.asarray(filtered[y0:y1]).reshape(-1, 3)
+                work[y0:y1] = lut[bin_indices(pixels)].reshape(y1 - y0, w, 3)
+
+            list(pool.map(assign, strips))
+            del filtered
+
+        # 4. 近傍を参照する段をのりしろ付きで処理し、上から順に書き出す
+        sigma = sharpness_sigma(params["sharpness"])
+        halo_sharp = gaussian_radius(sigma) if sigma is not None else 0
+        halo_radial = 0
+        if (
+            params["chromatic_aberration"] > 0
+            and params.get("aberration_mode", "shift") == "radial"
+        ):
+            shift = lens.radial_max_shift(w, h, params["chromatic_aberration"])
+            halo_radial = int(math.ceil(shift)) + 2
+        writer = StreamingPNGWriter(dst_path, w, h)
+        pending = collections.deque()
+        for y0, y1 in strips:
+            pending.append(
+                pool.submit(
+                    _finish_strip, work, params, y0, y1, halo_sharp, halo_radial
+                )
+            )
+            if len(pending) >= workers * 2:
+                writer.write_rows(pending.popleft().result())
+        while pending:
+            writer.write_rows(pending.popleft().result())
+        writer.close()
+        del work
+
+    return {
+        "width": w,
+        "height": h,
+        "strips": len(strips),
+        "rows_per_strip": rows,
+        "workers": workers,
+        "peak_bytes": tracker.peak,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+# --- CLI ---
+def main(argv=None):
+    from imageforge.batch import load_params
+
+    parser = argparse.ArgumentParser(
+        prog="python -m imageforge.tiling",
+        description="超大判画像をメモリ使用量を抑えてタイル処理で補正します。",
+    )
+    parser.add_argument("input", help="入力画像 (PNG / JPEG / .npy)")
+    parser.add_argument("output", help="出力 PNG のパス")
+    parser.add_argument("--params", help="params の JSON ファイルまたは JSON 文字列")
+    parser.add_argument(
+        "--lut", default=None, help="彩度の後に適用するカラー LUT (.cube)"
+    )
+    parser.add_argument("--seed", type=int, default=None, help="ノイズの乱数シード")
+    parser.add_argument(
+        "--budget-mb",
+        type=int,
+        default=DEFAULT_MEMORY_BUDGET // (1024 * 1024),
+        help="作業メモリの目安 (MB)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="スレッド数 (デフォルト: CPUコア数)"
+    )
+    parser.add_argument(
+        "--tmp-dir", default=None, help="作業ファイルを置くディレクトリ"
+    )
+    parser.add_argument(
+        "--max-pixels",
+        type=int,
+        default=None,
+        help="入力画像の画素数の上限 (デフォルト: 環境変数 IMAGEFORGE_MAX_PIXELS)",
+    )
+    args = parser.parse_args(argv)
+    try:
+        params = load_params(args.params, args.lut)
+    except (OSError, ValueError) as e:
+        print(f"パラメータの読み込みに失敗しました: {e}", file=sys.stderr)
+        return 2
+    try:
+        stats = process_image_tiled(
+            args.input,
+            args.output,
+            params,
+            seed=args.seed,
+            memory_budget=args.budget_mb * 1024 * 1024,
+            workers=args.workers,
+            tmp_dir=args.tmp_dir,
+            max_pixels=args.max_pixels,
+        )
+    except (OSError, ValueError) as e:
+        print(f"入力画像を処理できません: {e}", file=sys.stderr)
+        return 2
+    print(
+        f"完了: {stats['width']}×{stats['height']} を {stats['strips']} ストリップで処理"
+        f" ({stats['seconds']:.1f}秒, 最大確保量 {stats['peak_bytes'] / 1024 / 1024:.0f}MB)",
+        file=sys.stderr,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,33 @@
 # pages/3_🕹️_ピクセルアートメーカー.py
+from imageforge import startup
+
+startup.begin_page(__file__)  # 初回表示の時間に import も含めるため、最初に呼ぶ
+
 import streamlit as st
-import numpy as np
-from PIL import Image, ImageEnhance
-import io
 import os
+import tempfile
+
+from PIL import Image
+
+from imageforge import (
+    animation,
+    artifacts,
+    cache,
+    encoding,
+    ingest,
+    metrics,
+    scheduler,
+)
+from imageforge.pixelart import (
+    CUSTOM_PALETTE,
+    DOWNSAMPLE_METHODS,
+    MAX_PALETTE_COLORS,
+    PALETTE_STYLES,
+    RETRO_PALETTES,
+    parse_palette,
+    render_pixel_art,
+)
+from imageforge.preview import PREVIEW_WIDTH, cached_display_image, preview_pixel_art
 
 # --- CSSでメインコンテンツの幅を調整 ---
 st.markdown(
@@ -22,45 +46,164 @@ st.markdown("お気に入りの画像をレトロなドット絵に変換しま
 st.info("👈 サイドバーから画像をアップロードし、スタイルを選択してください。")
 
 
-# --- 画像処理関数 ---
-@st.cache_data
-def create_pixel_art(image, pixel_size=10):
-    original_width, original_height = image.size
-    new_width = max(1, original_width // pixel_size)
-    new_height = max(1, original_height // pixel_size)
-    small_image = image.resize((new_width, new_height), Image.NEAREST)
-    return small_image.resize((original_width, original_height), Image.NEAREST)
+# --- 画像処理関数 (imageforge.pixelart に集約) ---
+def run_job(fn, *args, **kwargs):
+    """重い処理をサーバー共有のスケジューラで実行する (待っている間は待ち順を表示)
+
+    設定が変わってページが再実行されると、待ち行列の処理は取り消されます。
+    """
+    status = st.empty()
+
+    def on_wait(job):
+        message = scheduler.describe_wait(job)
+        if message:
+            status.info(message)
+        else:
+            status.empty()
+
+    try:
+        return scheduler.run(fn, *args, on_wait=on_wait, **kwargs)
+    finally:
+        status.empty()
+
+
+def load_image(image_bytes, upload_key):
+    """アップロードされた画像をデコードし、(画像, ingest の info) を返す (メモリにキャッシュ)"""
+    key = cache.make_key(upload_key, "ingest_decode")
+    return cache.get_cache().get_or_compute(
+        key, ingest.decode, image_bytes, persist=False
+    )
+
+
+def render_preview(image, upload_key, pixel_size, style, options):
+    """表示サイズのプレビュー (元画像・ピクセルサイズ・スタイルごとにメモリにキャッシュ)"""
+    key = cache.make_key(
+        upload_key,
+        "pixelart_preview",
+        pixel_size=pixel_size,
+        style=style,
+        max_width=PREVIEW_WIDTH,
+        **options,
+    )
+    return cache.get_cache().get_or_compute(
+        key,
+        preview_pixel_art,
+        image,
+        pixel_size,
+        style,
+        PREVIEW_WIDTH,
+        persist=False,
+        **options,
+    )
+
+
+def show_image(key, image, lossless=False):
+    """表示用に縮小・圧縮した画像を表示し、送ったバイト数を返す"""
+    data = cached_display_image(key, image, PREVIEW_WIDTH, lossless)
+    st.image(data, use_container_width=True)
+    return len(data)
+
+
+def count_frames(image_bytes, upload_key):
+    key = cache.make_key(upload_key, "frame_count")
+    return cache.get_cache().get_or_compute(
+        key, animation.frame_count, image_bytes, persist=False
+    )
 
 
-@st.cache_data
-def quantize_to_16bit(image: Image.Image) -> Image.Image:
-    arr = np.array(image.convert("RGB"))
-    arr[..., 0] = (arr[..., 0] >> 3) << 3  # R
-    arr[..., 1] = (arr[..., 1] >> 2) << 2  # G
-    arr[..., 2] = (arr[..., 2] >> 3) << 3  # B
-    return Image.fromarray(arr, "RGB")
+def render_animation_file(image_bytes, fmt, pixel_size, style, options):
+    """全フレームを変換して一時ファイルに書き出し、(パス, 統計情報) を返す
 
+    スケジューラのワーカーで実行し、進み具合は scheduler.report_progress() で知らせる。
+    """
+    suffix = "." + fmt.lower()
+    fd, path = tempfile.mkstemp(prefix="imageforge_anim_", suffix=suffix)
+    try:
+        with os.fdopen(fd, "wb") as fp, metrics.record(
+            "pixelart_animation", fmt=fmt, pixel_size=pixel_size, style=style
+        ):
+            stats = animation.render_animation(
+                image_bytes,
+                fp,
+                fmt,
+                pixel_size,
+                style,
+                workers=scheduler.get_scheduler().threads_per_job,
+                progress=scheduler.report_progress,
+                **options,
+            )
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, stats
 
-@st.cache_data
-def to_grayscale(image: Image.Image) -> Image.Image:
-    return image.convert("L").convert("RGB")
 
+def session_artifacts():
+    """このセッションの一時ファイルの置き場所 (セッションが終わると削除される)"""
+    if "pixelart_artifacts" not in st.session_state:
+        st.session_state.pixelart_artifacts = artifacts.SessionArtifacts()
+    return st.session_state.pixelart_artifacts
 
-@st.cache_data
-def to_colorful(image: Image.Image, factor=2.0) -> Image.Image:
-    enhancer = ImageEnhance.Color(image.convert("RGB"))
-    return enhancer.enhance(factor)
 
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
 
-def apply_palette_style(image: Image.Image, style: str) -> Image.Image:
-    if style == "16ビット風":
-        return quantize_to_16bit(image)
-    elif style == "モノクロ":
-        return to_grayscale(image)
-    elif style == "カラフル":
-        return to_colorful(image)
-    else:  # "オリジナル"
-        return image.convert("RGB")
+
+def first_frame(path):
+    """変換したアニメーションの1フレーム目 (ファイル全体はデコードしない)"""
+    with Image.open(path) as img:
+        return img.convert("RGB")
+
+
+def render_export(image, upload_key, pixel_size, style, options, scale):
+    """ダウンロード用の画像 (scale=None なら元のサイズ、整数ならドット数 × scale)"""
+    key = cache.make_key(
+        upload_key,
+        "pixelart_export",
+        pixel_size=pixel_size,
+        style=style,
+        scale=scale,
+        **options,
+    )
+    return cache.get_cache().get_or_compute(
+        key,
+        render_pixel_art,
+        image,
+        pixel_size,
+        style,
+        scale=scale,
+        persist=False,
+        **options,
+    )
+
+
+def render_download(image, upload_key, pixel_size, style, options, scale, fmt):
+    """ダウンロード用に描画してエンコードする (ダウンロードボタンのクリック時にだけ実行)"""
+    with metrics.record(
+        "pixelart_download", pixel_size=pixel_size, style=style, scale=scale, fmt=fmt
+    ):
+        return scheduler.run(
+            _render_download, image, upload_key, pixel_size, style, options, scale, fmt
+        )
+
+
+def _render_download(image, upload_key, pixel_size, style, options, scale, fmt):
+    key = cache.make_key(
+        upload_key,
+        "pixelart_encoded",
+        pixel_size=pixel_size,
+        style=style,
+        scale=scale,
+        fmt=fmt,
+        **options,
+    )
+    return cache.get_cache().get_or_compute(
+        key,
+        lambda: encoding.encode_image(
+            render_export(image, upload_key, pixel_size, style, options, scale), fmt
+        ),
+    )
 
 
 # --- サイドバー ---
@@ -68,14 +211,14 @@ with st.sidebar:
     st.header("⚙️ 操作パネル")
     st.markdown("---")
     uploaded_file = st.file_uploader(
-        "画像をアップロード", type=["png", "jpg", "jpeg", "gif", "bmp"]
+        "画像をアップロード", type=["png", "jpg", "jpeg", "gif", "bmp", "webp"]
     )
     st.markdown("---")
 
     st.header("🎨 スタイル設定")
     style = st.selectbox(
         "カラースタイル",
-        ["オリジナル", "16ビット風", "モノクロ", "カラフル"],
+        PALETTE_STYLES,
         help="ピクセルアートの雰囲気を変えられます。",
     )
     pixel_size = st.slider(
@@ -86,46 +229,247 @@ with st.sidebar:
         step=1,
         help="大きいほどドットが粗くなります。",
     )
+    options = {}
+    options["method"] = st.radio(
+        "ドットの色の決め方",
+        list(DOWNSAMPLE_METHODS),
+        index=list(DOWNSAMPLE_METHODS).index("nearest"),
+        format_func=DOWNSAMPLE_METHODS.get,
+        horizontal=True,
+        help="最近傍: 従来どおりブロックの1画素の色。平均: ブロック内の色の平均。中央値: 細い線やノイズに引きずられにくくなります。",
+    )
+    options["custom_palette"] = ()
+    if style == CUSTOM_PALETTE:
+        palette_text = st.text_area(
+            "パレット (16進カラーコード)",
+            "#000000 #FFFFFF",
+            help="例: #1A1C2C, #5D275D, ... 空白・カンマ・改行区切り。Lospec の .hex 形式も貼り付けられます。",
+        )
+        options["custom_palette"] = parse_palette(palette_text)
+        if not options["custom_palette"]:
+            st.warning("有効なカラーコードがありません。")
+        elif len(options["custom_palette"]) > MAX_PALETTE_COLORS:
+            st.warning(
+                f"パレットは{MAX_PALETTE_COLORS}色までです。先頭の{MAX_PALETTE_COLORS}色を使います。"
+            )
+            options["custom_palette"] = options["custom_palette"][:MAX_PALETTE_COLORS]
+    options["dither"] = 0.0
+    if style in RETRO_PALETTES or style == CUSTOM_PALETTE:
+        options["dither"] = st.slider(
+            "ディザリング",
+            0.0,
+            1.0,
+            0.0,
+            0.05,
+            help="4×4 の組織的ディザで、少ない色数でもグラデーションを表現します。",
+        )
     st.markdown("---")
 
 # --- メインエリア ---
 if uploaded_file is not None:
     try:
-        original_image = Image.open(uploaded_file).convert("RGB")
+        image_bytes = uploaded_file.getvalue()
+        upload_key = cache.content_hash(image_bytes)
+        original_image, decode_info = load_image(image_bytes, upload_key)
     except Exception as e:
         st.error(f"画像の読み込みに失敗しました: {e}")
         st.stop()
 
-    with st.spinner("ピクセルアートを作成中..."):
-        pixelated_image = create_pixel_art(original_image, pixel_size)
-        styled_art = apply_palette_style(pixelated_image, style)
-
+    # スライダー操作のたびに表示サイズのプレビューだけを作り直す
+    preview_key = cache.make_key(
+        upload_key, "pixelart_preview", pixel_size=pixel_size, style=style, **options
+    )
     col1, col2 = st.columns(2)
-    with col1:
-        st.markdown(
-            "<h4 style='text-align:center;'>🖼️ オリジナル</h4>", unsafe_allow_html=True
-        )
-        st.image(original_image, use_container_width=True)
-    with col2:
-        st.markdown(
-            f"<h4 style='text-align:center;'>✨ ピクセルアート</h4>",
-            unsafe_allow_html=True,
-        )
-        st.image(styled_art, use_container_width=True)
+    with metrics.record(
+        "pixelart_preview",
+        width=original_image.width,
+        height=original_image.height,
+        pixel_size=pixel_size,
+        style=style,
+        **options,
+    ) as preview_run:
+        with col1:
+            st.markdown(
+                "<h4 style='text-align:center;'>🖼️ オリジナル</h4>",
+                unsafe_allow_html=True,
+            )
+            displayed_bytes = show_image(upload_key, original_image)
+            st.caption(ingest.describe(decode_info))
+        with col2:
+            st.markdown(
+                f"<h4 style='text-align:center;'>✨ ピクセルアート</h4>",
+                unsafe_allow_html=True,
+            )
+            with st.spinner("ピクセルアートを作成中..."):
+                # ドットがにじまないよう可逆圧縮で送る
+                displayed_bytes += show_image(
+                    preview_key,
+                    lambda: run_job(
+                        render_preview,
+                        original_image,
+                        upload_key,
+                        pixel_size,
+                        style,
+                        options,
+                    ),
+                    lossless=True,
+                )
+    st.caption(
+        f"📶 表示用の画像: {displayed_bytes / 1024:.0f}KB"
+        " (フル解像度の画像はダウンロード時にだけ作ります)"
+    )
 
     st.markdown("---")
 
-    # ダウンロードボタン
-    buf = io.BytesIO()
-    styled_art.save(buf, format="PNG")
+    # ダウンロードボタン (描画とエンコードはクリック時にだけ行う)
     filename, _ = os.path.splitext(uploaded_file.name)
+    grid_w = max(1, original_image.size[0] // pixel_size)
+    grid_h = max(1, original_image.size[1] // pixel_size)
+    save_col1, save_col2 = st.columns(2)
+    with save_col1:
+        export_scale = st.selectbox(
+            "保存サイズ",
+            [None, 1, 2, 4, 8],
+            format_func=lambda s: (
+                f"元のサイズ ({original_image.size[0]} × {original_image.size[1]})"
+                if s is None
+                else f"ドット数 × {s} ({grid_w * s} × {grid_h * s})"
+            ),
+            help="「ドット数 × 1」は1ドット = 1px のネイティブサイズです。拡大してもぼやけません。",
+        )
+    with save_col2:
+        output_format = st.selectbox(
+            "保存形式",
+            list(encoding.OUTPUT_FORMATS),
+            index=list(encoding.OUTPUT_FORMATS).index("png_palette"),
+            format_func=encoding.format_label,
+            help="PNG (パレット): 256色以下なら色を変えずに小さく保存します (257色以上なら通常の PNG)。",
+        )
+    ext = encoding.OUTPUT_FORMATS[output_format]["ext"]
+    size_tag = "" if export_scale is None else f"_x{export_scale}"
     st.download_button(
         label=f"💾 ピクセルアートをダウンロード",
-        data=buf.getvalue(),
-        file_name=f"pixelart_{style}_{pixel_size}_{filename}.png",
-        mime="image/png",
+        data=lambda: render_download(
+            original_image,
+            upload_key,
+            pixel_size,
+            style,
+            options,
+            export_scale,
+            output_format,
+        ),
+        file_name=f"pixelart_{style}_{pixel_size}{size_tag}_{filename}.{ext}",
+        mime=encoding.OUTPUT_FORMATS[output_format]["mime"],
         use_container_width=True,
     )
+    with st.expander("📦 保存形式ごとのサイズとエンコード時間"):
+        st.caption("選択中の保存サイズで各形式にエンコードして比較します。")
+        if st.button("計測する", key="pixelart_measure_encodings"):
+            with st.spinner("エンコード中..."):
+                export_image = run_job(
+                    render_export,
+                    original_image,
+                    upload_key,
+                    pixel_size,
+                    style,
+                    options,
+                    export_scale,
+                )
+                results = run_job(
+                    encoding.measure_encodings,
+                    export_image,
+                    list(encoding.OUTPUT_FORMATS),
+                )
+            st.table(encoding.encodings_table(results))
+
+    n_frames = count_frames(image_bytes, upload_key)
+    if n_frames > 1:
+        st.subheader(f"🎞️ アニメーション ({n_frames}フレーム)")
+        st.caption(
+            "上のプレビューは1フレーム目です。全フレームを変換すると、"
+            "元の表示時間のままアニメーションとして保存できます。"
+        )
+        anim_format = st.radio(
+            "出力形式",
+            list(animation.ANIMATION_FORMATS),
+            horizontal=True,
+            help="GIF: 全フレーム共通の256色パレットで保存します。WebP: フルカラー (可逆圧縮) で保存します。",
+        )
+        anim_key = cache.make_key(
+            upload_key,
+            "pixelart_animation",
+            fmt=anim_format,
+            pixel_size=pixel_size,
+            style=style,
+            **options,
+        )
+        anim = st.session_state.get("pixelart_animation")
+        if anim and (anim["key"] != anim_key or not os.path.exists(anim["path"])):
+            anim = None
+        if anim is None and st.button(
+            "🎞️ 全フレームを変換", use_container_width=True, type="primary"
+        ):
+            # 前回の変換結果のファイルは削除する
+            st.session_state.pop("pixelart_animation", None)
+            session_artifacts().attach_file("animation", None)
+            progress_bar = st.progress(0.0, text="フレームを変換しています...")
+
+            def show_progress(job):
+                if job.position():
+                    progress_bar.progress(0.0, text=scheduler.describe_wait(job))
+                elif job.progress is None:
+                    progress_bar.progress(0.0, text="フレームを変換しています...")
+                else:
+                    done, total = job.progress
+                    progress_bar.progress(
+                        done / total, text=f"フレームを変換しています... {done}/{total}"
+                    )
+
+            try:
+                path, stats = scheduler.run(
+                    render_animation_file,
+                    image_bytes,
+                    anim_format,
+                    pixel_size,
+                    style,
+                    options,
+                    on_wait=show_progress,
+                )
+            finally:
+                progress_bar.empty()
+            # ファイルはセッションが終わったとき (または次の変換のとき) に削除する
+            session_artifacts().attach_file("animation", path)
+            anim = {"key": anim_key, "path": path, "stats": stats}
+            st.session_state.pixelart_animation = anim
+        if anim is not None:
+            stats = anim["stats"]
+            # 表示は縮小した1フレーム目だけ (フル解像度のファイルはダウンロードにだけ使う)
+            show_image(anim_key, lambda: first_frame(anim["path"]), lossless=True)
+            st.caption(
+                "変換結果の1フレーム目 / "
+                f"{stats['frames']}フレーム / {stats['seconds']:.1f}秒"
+                f" ({stats['fps']:.1f}フレーム/秒)"
+                + (
+                    f" / 共通パレット {stats['palette_colors']}色"
+                    if stats["palette_colors"]
+                    else ""
+                )
+            )
+            st.download_button(
+                label=f"💾 アニメーションをダウンロード ({anim_format})",
+                data=lambda: read_file(anim["path"]),
+                file_name=f"pixelart_{style}_{pixel_size}_{filename}.{anim_format.lower()}",
+                mime=animation.ANIMATION_FORMATS[anim_format],
+                use_container_width=True,
+            )
+        st.markdown("---")
+
+    with st.expander("⏱️ 処理時間の内訳"):
+        st.write(f"**プレビュー**: {metrics.describe(preview_run)}")
+        if preview_run.stages:
+            st.table(metrics.stages_table(preview_run))
+        else:
+            st.caption("すべてキャッシュから表示しました。")
 
     with st.expander("📝 画像情報"):
         st.write(
@@ -139,3 +483,5 @@ else:
     st.info(
         "サイドバーから画像をアップロードして、ピクセルアート作成を開始してください。"
     )
+
+startup.end_page(__file__)
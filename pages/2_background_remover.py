@@ -1,9 +1,25 @@
 # pages/2_🪄_背景リムーバー.py
+from imageforge import startup
+
+startup.begin_page(__file__)  # 初回表示の時間に import も含めるため、最初に呼ぶ
+
 import streamlit as st
-from rembg import remove
-from PIL import Image
-from io import BytesIO
 import os
+import tempfile
+import time
+import zipfile
+
+from imageforge import (
+    artifacts,
+    cache,
+    encoding,
+    ingest,
+    matte,
+    metrics,
+    scheduler,
+    segmentation,
+)
+from imageforge.preview import cached_display_image
 
 # --- CSSでメインコンテンツの幅を調整 ---
 st.markdown(
@@ -24,37 +40,300 @@ st.info("👈 サイドバーから画像をアップロードするか、サン
 # --- 定数 ---
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 SAMPLE_IMAGE_PATH = "assets/sample.png"
+BATCH_MODE = "まとめて処理 (バッチ)"
+OUTPUT_FORMATS = ["png", "webp", "jpeg"]  # 透明部分があるのでパレット PNG は使わない
 
 
 # --- 関数 ---
-@st.cache_data
-def convert_image_to_bytes(img):
-    """PIL Imageをバイトに変換"""
-    buf = BytesIO()
-    img.save(buf, format="PNG")
-    return buf.getvalue()
+@st.cache_resource(show_spinner="背景除去モデルを読み込んでいます...")
+def get_segmentation_pool():
+    """サーバープロセス全体で共有する推論セッション (起動時にウォームアップ済み)"""
+    segmentation.start_warmup(SAMPLE_IMAGE_PATH).join()
+    return segmentation.get_pool()
+
 
+def run_job(fn, *args, **kwargs):
+    """重い処理をサーバー共有のスケジューラで実行する (待っている間は待ち順を表示)
+
+    設定が変わってページが再実行されると、待ち行列の処理は取り消されます。
+    """
+    status = st.empty()
+
+    def on_wait(job):
+        message = scheduler.describe_wait(job)
+        if message:
+            status.info(message)
+        else:
+            status.empty()
 
-@st.cache_data
-def process_image_rembg(image_bytes):
-    """rembgで背景を除去"""
     try:
-        original_image = Image.open(BytesIO(image_bytes)).convert("RGB")
-        processed_image = remove(original_image)
-        return original_image, processed_image
+        return scheduler.run(fn, *args, on_wait=on_wait, **kwargs)
+    finally:
+        status.empty()
+
+
+def process_image_rembg(image_bytes, matte_mode="full"):
+    """rembgでアルファマットを推論 (画像の内容・推論のモードごとにキャッシュ)
+
+    背景の差し替えや縁の調整はキャッシュしたマットから合成するので、
+    設定を変えてもモデルは再実行しません。マットはディスクにも保存されますが、
+    デコードした元画像はメモリにだけ置きます。
+    """
+    upload_key = cache.content_hash(image_bytes)
+    result_cache = cache.get_cache()
+    try:
+        # EXIF の向きの適用・画素数の上限の確認もここで行う (ピクセルアートと共有)
+        original_image, _ = result_cache.get_or_compute(
+            cache.make_key(upload_key, "ingest_decode"),
+            ingest.decode,
+            image_bytes,
+            persist=False,
+        )
+        mask = result_cache.get_or_compute(
+            cache.make_key(
+                upload_key,
+                "matte",
+                model=segmentation.get_pool().model_name,
+                mode=matte_mode,
+            ),
+            lambda: run_job(
+                get_segmentation_pool().predict_masks, [original_image], matte_mode
+            )[0],
+        )
+        return original_image, mask
     except Exception as e:
         st.error(f"画像処理中にエラーが発生しました: {e}")
         return None, None
 
 
+def finishing_controls():
+    """サイドバーの仕上げ設定 (背景・影・縁・切り抜き)
+
+    (設定の dict, 設定を表すキャッシュキー) を返します。
+    """
+    defaults = matte.DEFAULT_EFFECTS
+    effects = {}
+    background_key = None
+    with st.expander("✨ 仕上げ (モデルの再実行なし)", expanded=True):
+        effects["background_mode"] = st.radio(
+            "背景", matte.BACKGROUND_MODES, horizontal=True
+        )
+        if effects["background_mode"] == "単色":
+            color = st.color_picker("背景色", "#FFFFFF")
+            effects["background_color"] = tuple(
+                int(color[i : i + 2], 16) for i in (1, 3, 5)
+            )
+        elif effects["background_mode"] == "画像":
+            bg_file = st.file_uploader("背景画像", type=["png", "jpg", "jpeg"])
+            if bg_file:
+                background_bytes = bg_file.getvalue()
+                background_key = cache.content_hash(background_bytes)
+                effects["background_image"] = load_background(background_bytes)
+        effects["erode"] = st.slider(
+            "縁の縮小 / 拡大 (px)",
+            -10,
+            10,
+            defaults["erode"],
+            help="正の値で被写体の縁を内側に削り、負の値で外側に広げます。",
+        )
+        effects["feather"] = st.slider("縁のぼかし (px)", 0, 20, defaults["feather"])
+        effects["shadow"] = st.checkbox("ドロップシャドウ", defaults["shadow"])
+        if effects["shadow"]:
+            offset = st.slider("影のずれ (px)", 0, 50, defaults["shadow_offset"][0])
+            effects["shadow_offset"] = (offset, offset)
+            effects["shadow_blur"] = st.slider(
+                "影のぼかし (px)", 0, 40, defaults["shadow_blur"]
+            )
+            effects["shadow_opacity"] = st.slider(
+                "影の濃さ", 0.0, 1.0, defaults["shadow_opacity"], 0.05
+            )
+        effects["crop"] = st.checkbox("被写体に合わせて切り抜く", defaults["crop"])
+        if effects["crop"]:
+            effects["crop_margin"] = st.slider(
+                "余白 (px)", 0, 100, defaults["crop_margin"]
+            )
+    settings = {k: v for k, v in effects.items() if k != "background_image"}
+    return effects, cache.make_key(background_key, "effects", **settings)
+
+
+def load_background(image_bytes):
+    key = cache.make_key(cache.content_hash(image_bytes), "ingest_decode")
+    image, _ = cache.get_cache().get_or_compute(
+        key, ingest.decode, image_bytes, persist=False
+    )
+    return image
+
+
+def zip_entry_name(filename, used_names, ext="png"):
+    """ZIP 内のファイル名 (同名のファイルには連番を付ける)"""
+    stem, _ = os.path.splitext(os.path.basename(filename))
+    name = f"removed_bg_{stem}.{ext}"
+    n = 2
+    while name in used_names:
+        name = f"removed_bg_{stem}_{n}.{ext}"
+        n += 1
+    used_names.add(name)
+    return name
+
+
+def write_batch_zip(sources, fmt, pool, matte_mode="full"):
+    """背景を除去した結果を1枚ずつ一時ファイルの ZIP に書き込む
+
+    (ZIP のパス, 成功した枚数, エラーのリスト) を返します。スケジューラのワーカーで実行し、
+    1枚ごとに進み具合の報告と取り消しの確認をします。取り消された場合や失敗した場合は
+    途中までの ZIP を削除します。
+    """
+    succeeded = 0
+    errors = []
+    used_names = set()
+    fd, zip_path = tempfile.mkstemp(prefix="imageforge_batch_", suffix=".zip")
+    try:
+        # どの形式も圧縮済みなので ZIP では無圧縮で格納する
+        with os.fdopen(fd, "wb") as fp, zipfile.ZipFile(
+            fp, "w", zipfile.ZIP_STORED
+        ) as zf:
+            # アップロードファイルのバイト列は、デコードの直前に1枚ずつ取り出す
+            lazy_sources = ((name, f.getvalue()) for name, f in sources)
+            results = segmentation.iter_remove_background(
+                lazy_sources, pool=pool, mode=matte_mode
+            )
+            for i, (name, result, error) in enumerate(results, start=1):
+                if error is None:
+                    zf.writestr(
+                        zip_entry_name(
+                            name, used_names, encoding.OUTPUT_FORMATS[fmt]["ext"]
+                        ),
+                        encoding.encode_image(result, fmt),
+                    )
+                    succeeded += 1
+                else:
+                    errors.append((name, str(error)))
+                del result
+                scheduler.report_progress(i, len(sources))
+                scheduler.checkpoint()
+    except BaseException:
+        os.remove(zip_path)
+        raise
+    return zip_path, succeeded, errors
+
+
+def session_artifacts():
+    """このセッションの一時ファイルの置き場所 (セッションが終わると削除される)"""
+    if "remover_artifacts" not in st.session_state:
+        st.session_state.remover_artifacts = artifacts.SessionArtifacts()
+    return st.session_state.remover_artifacts
+
+
+def run_batch(files, fmt="png", matte_mode="full"):
+    """複数の画像の背景を除去し、結果を1枚ずつ ZIP ファイルに書き出す
+
+    結果はエンコードしたらすぐ ZIP に書き込んで破棄するので、
+    全ての結果をメモリに保持することはありません。
+    """
+    sources = []
+    errors = []
+    for f in files:
+        if f.size > MAX_FILE_SIZE:
+            errors.append((f.name, "ファイルサイズが大きすぎます"))
+        else:
+            sources.append((f.name, f))
+
+    # 前回のバッチの ZIP は削除する
+    st.session_state.pop("remover_batch", None)
+    session_artifacts().attach_file("batch_zip", None)
+
+    pool = get_segmentation_pool()
+    progress = st.progress(0.0, text="背景を除去しています...")
+
+    def show_progress(job):
+        if job.position():
+            progress.progress(0.0, text=scheduler.describe_wait(job))
+        elif job.progress is None:
+            progress.progress(0.0, text="背景を除去しています...")
+        else:
+            done, total = job.progress
+            progress.progress(
+                done / total, text=f"背景を除去しています... {done}/{total}"
+            )
+
+    start = time.perf_counter()
+    try:
+        with metrics.record(
+            "background_removal_batch",
+            images=len(sources),
+            fmt=fmt,
+            matte_mode=matte_mode,
+        ) as run:
+            zip_path, succeeded, batch_errors = scheduler.run(
+                write_batch_zip, sources, fmt, pool, matte_mode, on_wait=show_progress
+            )
+    except scheduler.QueueFull as e:
+        st.error(str(e))
+        return
+    finally:
+        progress.empty()
+    elapsed = time.perf_counter() - start
+    errors.extend(batch_errors)
+
+    # ZIP はセッションが終わったとき (または次のバッチのとき) に削除する
+    session_artifacts().attach_file("batch_zip", zip_path)
+    st.session_state.remover_batch = {
+        "zip_path": zip_path,
+        "succeeded": succeeded,
+        "errors": errors,
+        "seconds": elapsed,
+        "metrics": run.to_dict(),
+    }
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
 # --- サイドバー ---
 with st.sidebar:
     st.header("⚙️ 操作パネル")
     st.markdown("---")
-    uploaded_file = st.file_uploader("画像をアップロード", type=["png", "jpg", "jpeg"])
-    st.markdown("または")
-    use_sample = st.button("サンプル画像を使用", use_container_width=True)
+    mode = st.radio("処理モード", ["1枚ずつ", BATCH_MODE], horizontal=True)
+    matte_mode = st.selectbox(
+        "推論の解像度",
+        list(segmentation.MATTE_MODES),
+        format_func=segmentation.MATTE_MODES.get,
+        help="縮小して推論すると、大きな写真でも速く処理できます。"
+        "縁は元の画像の輪郭に合わせて拡大し、再推論を選ぶと被写体の周りをもう一度細かく推論します。",
+    )
+    uploaded_file = None
+    uploaded_files = []
+    use_sample = False
+    run_batch_clicked = False
+    if mode == BATCH_MODE:
+        uploaded_files = st.file_uploader(
+            "画像をアップロード (複数可)",
+            type=["png", "jpg", "jpeg"],
+            accept_multiple_files=True,
+        )
+        run_batch_clicked = st.button(
+            "🚀 まとめて背景を除去",
+            use_container_width=True,
+            type="primary",
+            disabled=not uploaded_files,
+        )
+    else:
+        uploaded_file = st.file_uploader(
+            "画像をアップロード", type=["png", "jpg", "jpeg"]
+        )
+        st.markdown("または")
+        use_sample = st.button("サンプル画像を使用", use_container_width=True)
+        st.markdown("---")
+        effects, effects_key = finishing_controls()
     st.markdown("---")
+    output_format = st.selectbox(
+        "保存形式",
+        OUTPUT_FORMATS,
+        format_func=encoding.format_label,
+        help="JPEG は透明にできないため、透明な部分を白で塗りつぶします。",
+    )
 
     with st.expander("ℹ️ 画像ガイドライン"):
         st.write(
@@ -70,6 +349,13 @@ image_to_process = None
 image_bytes_to_process = None
 filename = "source_image"
 
+# サンプル画像は、仕上げの設定を変えて再実行しても表示し続ける
+if use_sample:
+    st.session_state.remover_use_sample = True
+elif uploaded_file:
+    st.session_state.remover_use_sample = False
+use_sample = st.session_state.get("remover_use_sample", False)
+
 if uploaded_file:
     if uploaded_file.size > MAX_FILE_SIZE:
         st.error(
@@ -87,29 +373,128 @@ elif use_sample:
     else:
         st.warning("サンプル画像が見つかりません。画像をアップロードしてください。")
 
-if image_bytes_to_process:
-    with st.spinner("背景を除去しています..."):
-        original_pil, processed_pil = process_image_rembg(image_bytes_to_process)
+if mode == BATCH_MODE:
+    if run_batch_clicked:
+        run_batch(uploaded_files, output_format, matte_mode)
 
-    if original_pil and processed_pil:
+    batch = st.session_state.get("remover_batch")
+    if batch and os.path.exists(batch["zip_path"]):
+        seconds = batch["seconds"]
+        throughput = batch["succeeded"] / seconds if seconds > 0 else 0.0
+        st.success(
+            f"{batch['succeeded']}枚の背景を除去しました"
+            f" ({seconds:.1f}秒, {throughput:.2f}枚/秒)"
+        )
+        if batch["errors"]:
+            with st.expander(f"⚠️ 処理できなかった画像 ({len(batch['errors'])}枚)"):
+                for name, message in batch["errors"]:
+                    st.write(f"- **{name}**: {message}")
+        if batch.get("metrics"):
+            with st.expander("⏱️ 処理時間の内訳"):
+                st.write(f"**バッチ**: {metrics.describe(batch['metrics'])}")
+                st.table(metrics.totals_table(batch["metrics"]))
+        st.download_button(
+            label="💾 背景除去画像をまとめてダウンロード (ZIP)",
+            data=lambda: read_file(batch["zip_path"]),
+            file_name="removed_bg_images.zip",
+            mime="application/zip",
+            use_container_width=True,
+        )
+    else:
+        st.info("画像を複数選択して「まとめて背景を除去」を押してください。")
+
+elif image_bytes_to_process:
+    upload_key = cache.content_hash(image_bytes_to_process)
+    result_key = cache.make_key(
+        upload_key,
+        "remover_result",
+        effects=effects_key,
+        model=segmentation.get_pool().model_name,
+        matte_mode=matte_mode,
+    )
+    # デコード・推論・仕上げ・表示用の画像の作成までを1回の処理として記録する
+    with metrics.record(
+        "background_removal", effects=effects_key, matte_mode=matte_mode
+    ) as removal_run:
+        with st.spinner("背景を除去しています..."):
+            original_pil, mask = process_image_rembg(image_bytes_to_process, matte_mode)
+        if original_pil and mask:
+            metrics.annotate(width=original_pil.width, height=original_pil.height)
+
+            def render_result():
+                # 表示用の画像がキャッシュにあれば、ダウンロード時まで合成しない
+                return matte.apply_effects(original_pil, mask, effects)
+
+            def encode_result():
+                return encoding.encode_image(render_result(), output_format)
+
+            original_display = cached_display_image(upload_key, original_pil)
+            result_display = cached_display_image(
+                result_key, lambda: run_job(render_result)
+            )
+
+    if original_pil and mask:
         col1, col2 = st.columns(2)
         with col1:
             st.subheader("🖼️ オリジナル画像")
-            st.image(original_pil, use_container_width=True)
+            st.image(original_display, use_container_width=True)
         with col2:
             st.subheader("✨ 背景除去後の画像")
-            st.image(processed_pil, use_container_width=True)
+            st.image(result_display, use_container_width=True)
+        st.caption(
+            f"📶 表示用の画像: {(len(original_display) + len(result_display)) / 1024:.0f}KB"
+            " (フル解像度の画像はダウンロード時にだけ作ります)"
+        )
+        with st.expander("⏱️ 処理時間の内訳"):
+            st.write(f"**背景除去**: {metrics.describe(removal_run)}")
+            if removal_run.stages:
+                st.table(metrics.stages_table(removal_run))
+            else:
+                st.caption("すべてキャッシュから表示しました。")
 
         # ダウンロードボタンをメインエリアの下部に配置
         st.markdown("---")
+        ext = encoding.OUTPUT_FORMATS[output_format]["ext"]
         st.download_button(
             label="💾 背景除去画像をダウンロード",
-            data=convert_image_to_bytes(processed_pil),
-            file_name=f"removed_bg_{filename}.png",
-            mime="image/png",
+            data=lambda: scheduler.run(encode_result),
+            file_name=f"removed_bg_{filename}.{ext}",
+            mime=encoding.OUTPUT_FORMATS[output_format]["mime"],
             use_container_width=True,
         )
+        with st.expander("📦 保存形式ごとのサイズとエンコード時間"):
+            if st.button("計測する", key="remover_measure_encodings"):
+                with st.spinner("エンコード中..."):
+                    results = run_job(
+                        lambda: encoding.measure_encodings(
+                            render_result(), OUTPUT_FORMATS
+                        )
+                    )
+                st.table(encoding.encodings_table(results))
     else:
         st.error("画像の処理に失敗しました。別の画像でお試しください。")
 else:
     st.info("画像をアップロードするか、サンプル画像を使用してください。")
+
+with st.expander("⏱️ モデルの読み込み時間・推論時間"):
+    pool_stats = segmentation.get_pool().stats()
+    st.write(
+        f"**モデル**: {pool_stats['model']} / **セッション数**: {pool_stats['pool_size']}"
+        f" / **スレッド数** (intra/inter): {pool_stats['intra_op_threads'] or '自動'}"
+        f" / {pool_stats['inter_op_threads'] or '自動'}"
+    )
+    if pool_stats["load_seconds"] is None:
+        st.write("モデルはまだ読み込まれていません。")
+    else:
+        st.write(f"**モデル読み込み**: {pool_stats['load_seconds']:.2f}秒")
+        if pool_stats["warmup_seconds"] is not None:
+            st.write(f"**ウォームアップ**: {pool_stats['warmup_seconds']:.2f}秒")
+    if pool_stats["inferences"]:
+        st.write(
+            f"**推論回数**: {pool_stats['inferences']}"
+            f" / **平均**: {pool_stats['latency_mean']:.2f}秒"
+            f" / **中央値**: {pool_stats['latency_p50']:.2f}秒"
+            f" / **最大**: {pool_stats['latency_max']:.2f}秒"
+        )
+
+startup.end_page(__file__)
@@ -1,12 +1,29 @@
 # pages/1_🎨_AIイラスト補正ツール.py
+from imageforge import startup
+
+startup.begin_page(__file__)  # 初回表示の時間に import も含めるため、最初に呼ぶ
+
 import streamlit as st
 import cv2
 import numpy as np
-from sklearn.cluster import KMeans
-from PIL import Image, ImageEnhance, ImageOps
-import io
+import functools
 import os
 
+from imageforge import (
+    artifacts,
+    cache,
+    colorlut,
+    correction,
+    encoding,
+    ingest,
+    metrics,
+    scheduler,
+)
+from imageforge.correction import DEFAULT_PARAMS, process_image
+from imageforge.inplace import process_image_inplace
+from imageforge.preview import cached_display_image, make_proxy
+from imageforge.quantize import apply_kmeans_fast, color_error
+
 # --- CSSでメインコンテンツの幅を調整 ---
 st.markdown(
     """
@@ -20,107 +37,149 @@ st.markdown(
 )
 
 
-# --- 画像処理関数 (変更なし) ---
-def add_noise(img_pil, strength=0.05):
-    img_np = np.array(img_pil).astype(np.float32) / 255.0
-    noise = (np.random.rand(*img_np.shape) - 0.5) * (strength * 2)
-    noisy_img = np.clip(img_np + noise, 0, 1)
-    return Image.fromarray((noisy_img * 255).astype(np.uint8))
+# --- 画像処理関数 (imageforge.correction に集約) ---
+def run_job(fn, *args, **kwargs):
+    """重い処理をサーバー共有のスケジューラで実行する (待っている間は待ち順を表示)
+
+    パラメータが変わってページが再実行されると、待ち行列の処理は取り消されます。
+    """
+    status = st.empty()
 
+    def on_wait(job):
+        message = scheduler.describe_wait(job)
+        if message:
+            status.info(message)
+        else:
+            status.empty()
 
-def add_chromatic_aberration(img_pil, strength=1):
-    if strength <= 0:
-        return img_pil
-    img_np = np.array(img_pil)
-    h, w, _ = img_np.shape
-    offset = max(1, int(strength * min(h, w) * 0.002))
-    r, g, b = img_pil.split()
     try:
-        from PIL import ImageChops
-
-        r_shifted = ImageChops.offset(r, -offset, 0)
-        b_shifted = ImageChops.offset(b, offset, 0)
-        g_shifted = g
-    except ImportError:
-        r_shifted = Image.new("L", (w, h))
-        g_shifted = Image.new("L", (w, h))
-        b_shifted = Image.new("L", (w, h))
-        r_shifted.paste(r, (-offset, 0))
-        g_shifted.paste(g, (0, 0))
-        b_shifted.paste(b, (offset, 0))
-        if offset > 0:
-            r_edge = r.crop((w - offset, 0, w, h))
-            b_edge = b.crop((0, 0, offset, h))
-            r_shifted.paste(r_edge, (0, 0))
-            b_shifted.paste(b_edge, (w - offset, 0))
-    merged = Image.merge("RGB", (r_shifted, g_shifted, b_shifted))
-    final_img = Image.blend(img_pil, merged, alpha=0.3)
-    return final_img
-
-
-@st.cache_data(show_spinner=False)
-def apply_kmeans(img_bgr, k=24):
-    img_filtered = cv2.bilateralFilter(img_bgr, d=3, sigmaColor=15, sigmaSpace=15)
-    h, w, _ = img_filtered.shape
-    pixels = cv2.cvtColor(img_filtered, cv2.COLOR_BGR2RGB).reshape(-1, 3)
-    kmeans = KMeans(n_clusters=k, random_state=42, n_init=5, max_iter=200).fit(pixels)
-    centers = kmeans.cluster_centers_
-    labels = kmeans.labels_
-    new_img = centers[labels].reshape(h, w, 3).astype("uint8")
-    return cv2.cvtColor(new_img, cv2.COLOR_RGB2BGR)
-
-
-def add_vignette(img_pil, strength=0.3):
-    img_np = np.array(img_pil)
-    h, w = img_np.shape[:2]
-    Y, X = np.ogrid[:h, :w]
-    center_y, center_x = h / 2, w / 2
-    distance = np.sqrt((X - center_x) ** 2 + (Y - center_y) ** 2)
-    max_dist = np.sqrt((w / 2) ** 2 + (h / 2) ** 2)
-    vignette = 1.0 - strength * (distance / max_dist) ** 2
-    vignette = np.clip(vignette, 0.0, 1.0)
-    vignette_mask = np.dstack([vignette] * 3)
-    img_vignette = (img_np * vignette_mask).astype(np.uint8)
-    return Image.fromarray(img_vignette)
-
-
-def process_image(img_pil, params):
-    processed_img = img_pil.copy()
-    if params["noise_strength"] > 0:
-        processed_img = add_noise(processed_img, params["noise_strength"])
-    if params["brightness"] != 1.0:
-        processed_img = ImageEnhance.Brightness(processed_img).enhance(
-            params["brightness"]
-        )
-    if params["contrast"] != 1.0:
-        processed_img = ImageEnhance.Contrast(processed_img).enhance(params["contrast"])
-    if params["saturation"] != 1.0:
-        processed_img = ImageEnhance.Color(processed_img).enhance(params["saturation"])
-    img_bgr = cv2.cvtColor(np.array(processed_img), cv2.COLOR_RGB2BGR)
-    if params["use_kmeans"]:
-        img_bgr = apply_kmeans(img_bgr, params["k_value"])
-    sharpness_val = params["sharpness"]
-    if sharpness_val > 0:
-        original_bgr = img_bgr.copy()
-        sigma_blur = max(0.5, 1.5 - sharpness_val * 0.1)
-        blurred = cv2.GaussianBlur(img_bgr, (0, 0), sigma_blur)
-        sharpness_factor = 1.0 + sharpness_val * 0.3
-        img_bgr = cv2.addWeighted(
-            original_bgr, sharpness_factor, blurred, 1 - sharpness_factor, 0
+        return scheduler.run(fn, *args, on_wait=on_wait, **kwargs)
+    finally:
+        status.empty()
+
+
+def apply_kmeans(img_bgr, k, input_key=None):
+    """厳密モードの K-Means (input_key = 入力の内容を表すキー を渡すと k ごとにキャッシュ)"""
+    if input_key is None:
+        return correction.apply_kmeans(img_bgr, k)
+    key = cache.make_key(input_key, "kmeans_exact", k=k)
+    return cache.get_cache().get_or_compute(key, correction.apply_kmeans, img_bgr, k)
+
+
+def bind_kmeans(kmeans_fn, input_key, params, seed, scale=1.0):
+    """厳密モードなら、上流の段階のキーでキャッシュする K-Means 関数にする
+
+    入力の画素をハッシュし直さずに済むよう、キーは元画像のキーとパラメータ・シードから作る。
+    """
+    if kmeans_fn is not apply_kmeans:
+        return kmeans_fn
+    key = correction.stage_input_key(input_key, "kmeans", params, seed, scale)
+    return functools.partial(apply_kmeans, input_key=key)
+
+
+def compare_kmeans_modes(upload_key, img_bgr, k):
+    """高速モードと厳密モードの色差を計算する (元画像と k ごとにキャッシュ)"""
+    key = cache.make_key(upload_key, "kmeans_compare", k=k)
+    return cache.get_cache().get_or_compute(
+        key,
+        lambda: color_error(
+            apply_kmeans_fast(img_bgr, k), apply_kmeans(img_bgr, k, upload_key)
+        ),
+    )
+
+
+def render_full_resolution(
+    upload_key, img_pil, params, seed, kmeans_fn, low_memory, memo
+):
+    """フル解像度で補正し、(補正後の画像, 省メモリモードの統計 or None) を返す
+
+    通常モードでは段階ごとの結果を memo に残し、変更した段階から後ろだけを再計算する。
+    """
+    kmeans_fn = bind_kmeans(kmeans_fn, upload_key, params, seed)
+    if low_memory:
+        return process_image_inplace(img_pil, params, seed=seed, kmeans_fn=kmeans_fn)
+    fixed_pil = process_image(
+        img_pil,
+        params,
+        seed=seed,
+        kmeans_fn=kmeans_fn,
+        memo=memo,
+        input_key=upload_key,
+    )
+    return fixed_pil, None
+
+
+def encode_stored_result(store, output_format):
+    """預けておいた補正結果をエンコードする (ダウンロードボタンが押されたときに呼ぶ)"""
+    return scheduler.run(encoding.encode_image, store.get("result"), output_format)
+
+
+def render_download(
+    upload_key, img_pil, params, seed, kmeans_fn, low_memory, memo, fmt
+):
+    """ダウンロードボタンのクリック時にだけ呼ばれ、フル解像度の画像をエンコードして返す
+
+    シードを指定した場合は結果が決まるので、元画像・パラメータ・シード・形式ごとにキャッシュする。
+    """
+
+    def render():
+        fixed_pil, _ = render_full_resolution(
+            upload_key, img_pil, params, seed, kmeans_fn, low_memory, memo
         )
-        img_bgr = np.clip(img_bgr, 0, 255).astype(np.uint8)
-    elif sharpness_val < 0:
-        sigma_val = abs(sharpness_val) * 0.8 + 0.5
-        if sigma_val > 0.3:
-            img_bgr = cv2.GaussianBlur(img_bgr, (0, 0), sigmaX=sigma_val)
-    processed_img = Image.fromarray(cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB))
-    if params["chromatic_aberration"] > 0:
-        processed_img = add_chromatic_aberration(
-            processed_img, params["chromatic_aberration"]
+        return encoding.encode_image(fixed_pil, fmt)
+
+    # クリック時の処理はログ (と metrics ファイル) にだけ記録する
+    with metrics.record(
+        "correction_download", params=correction.params_for_log(params), fmt=fmt
+    ):
+        if seed is None:
+            return scheduler.run(render)
+        key = cache.make_key(
+            upload_key, "correction_encoded", params=params, seed=seed, fmt=fmt
         )
-    if params["vignette_strength"] > 0:
-        processed_img = add_vignette(processed_img, params["vignette_strength"])
-    return processed_img
+        return cache.get_cache().get_or_compute(key, scheduler.run, render)
+
+
+def render_cube(img_pil, params):
+    """明るさ・コントラスト・彩度と取り込んだ LUT を1つの .cube にまとめる (クリック時にだけ呼ばれる)"""
+    mean = 0
+    if params["contrast"] != 1.0:
+        mean = colorlut.contrast_mean(img_pil, params["brightness"])
+    lut = colorlut.compile_lut(
+        params["brightness"],
+        params["contrast"],
+        params["saturation"],
+        mean,
+        params["color_lut"],
+    )
+    return colorlut.to_cube(lut, title="ImageForge").encode("utf-8")
+
+
+def preview_key(upload_key, proxy, params, seed):
+    return cache.make_key(
+        upload_key, "correction_preview", params=params, seed=seed, size=proxy[0].size
+    )
+
+
+def render_preview(upload_key, proxy, params, seed, kmeans_fn, memo):
+    """縮小画像で補正したプレビュー (元画像・パラメータ・シードごとにメモリにキャッシュ)
+
+    キャッシュにない場合も、memo に残っている段階の結果から続きだけを計算する。
+    """
+    proxy_pil, proxy_scale = proxy
+    input_key = cache.make_key(upload_key, "correction_proxy", size=proxy_pil.size)
+    return cache.get_cache().get_or_compute(
+        preview_key(upload_key, proxy, params, seed),
+        process_image,
+        proxy_pil,
+        params,
+        seed=seed,
+        kmeans_fn=bind_kmeans(kmeans_fn, input_key, params, seed, proxy_scale),
+        scale=proxy_scale,
+        memo=memo,
+        input_key=input_key,
+        persist=False,
+    )
 
 
 # --- Streamlit UI ---
@@ -131,16 +190,39 @@ st.info("👈 サイドバーから画像をアップロードし、パラメー
 # --- Session Stateの初期化 ---
 if "corrector_image_processed" not in st.session_state:
     st.session_state.corrector_image_processed = False
-if "corrector_download_buffer" not in st.session_state:
-    st.session_state.corrector_download_buffer = None
-if "corrector_last_processed_image_pil" not in st.session_state:
-    st.session_state.corrector_last_processed_image_pil = None
 if "corrector_processing_error" not in st.session_state:
     st.session_state.corrector_processing_error = None
-if "corrector_original_image_pil" not in st.session_state:
-    st.session_state.corrector_original_image_pil = None
 if "corrector_uploaded_filename" not in st.session_state:
     st.session_state.corrector_uploaded_filename = None
+if "corrector_memory_stats" not in st.session_state:
+    st.session_state.corrector_memory_stats = None
+if "corrector_decode_info" not in st.session_state:
+    st.session_state.corrector_decode_info = None
+if "corrector_proxy_scale" not in st.session_state:
+    st.session_state.corrector_proxy_scale = None
+if "corrector_upload_key" not in st.session_state:
+    st.session_state.corrector_upload_key = None
+if "corrector_result_key" not in st.session_state:
+    st.session_state.corrector_result_key = None
+if "corrector_metrics" not in st.session_state:
+    st.session_state.corrector_metrics = None
+# 元画像・プレビュー用の縮小画像・補正結果はセッションの外 (imageforge.artifacts) に置く。
+# メモリの予算を超えると、しばらく操作のないセッションの画像からディスクへ退避する
+if "corrector_artifacts" not in st.session_state:
+    st.session_state.corrector_artifacts = artifacts.SessionArtifacts()
+artifact_store = st.session_state.corrector_artifacts
+# 補正の段階ごとの結果 (プレビュー用とフル解像度用)。スライダーを1つ動かしたときは
+# その段階から後ろだけを再計算する
+if "corrector_preview_memo" not in st.session_state:
+    st.session_state.corrector_preview_memo = correction.StageMemo(
+        artifact_store, prefix="preview_memo"
+    )
+if "corrector_full_memo" not in st.session_state:
+    st.session_state.corrector_full_memo = correction.StageMemo(
+        artifact_store, prefix="full_memo"
+    )
+if "corrector_noise_seed" not in st.session_state:
+    st.session_state.corrector_noise_seed = None
 
 # --- サイドバー ---
 with st.sidebar:
@@ -161,133 +243,403 @@ with st.sidebar:
         if uploaded is not None:
             try:
                 st.session_state.corrector_image_processed = False
-                st.session_state.corrector_download_buffer = None
-                st.session_state.corrector_last_processed_image_pil = None
+                artifact_store.put("result", None)
                 st.session_state.corrector_processing_error = None
-                st.session_state.corrector_original_image_pil = Image.open(
-                    uploaded
-                ).convert("RGB")
+                image_bytes = uploaded.getvalue()
+                st.session_state.corrector_upload_key = cache.content_hash(image_bytes)
+                # EXIF の向きを適用し、画素数が上限を超える画像はデコードせずに断る
+                original_pil, st.session_state.corrector_decode_info = ingest.decode(
+                    image_bytes
+                )
+                proxy_pil, st.session_state.corrector_proxy_scale = make_proxy(
+                    original_pil
+                )
+                artifact_store.put("original", original_pil)
+                artifact_store.put("proxy", proxy_pil)
+                del original_pil, proxy_pil
+                st.session_state.corrector_preview_memo.clear()
+                st.session_state.corrector_full_memo.clear()
+                # シード未指定のときのノイズの模様は画像ごとに決める (パラメータを
+                # 変えても模様が変わらないので、段階ごとの結果を再利用できる)
+                st.session_state.corrector_noise_seed = int(np.random.randint(2**31))
                 st.session_state.corrector_uploaded_filename = uploaded.name
             except Exception as e:
                 st.error(f"画像読み込みエラー: {e}")
-                st.session_state.corrector_original_image_pil = None
+                artifact_store.clear()
                 st.session_state.corrector_uploaded_filename = None
         else:  # ファイルがクリアされた場合
-            st.session_state.corrector_original_image_pil = None
+            artifact_store.clear()
             st.session_state.corrector_uploaded_filename = None
             st.session_state.corrector_image_processed = False
-            st.session_state.corrector_download_buffer = None
-            st.session_state.corrector_last_processed_image_pil = None
             st.session_state.corrector_processing_error = None
 
+    # 以降はこのローカル変数で扱う (退避中なら、ここでディスクから読み込み直す)
+    original_pil = artifact_store.get("original")
+
     st.header("🛠️ 調整パラメータ")
     params = {}
     params["noise_strength"] = st.slider(
-        "ノイズ強度", 0.0, 0.2, 0.03, 0.01, help="アナログ感を加える"
+        "ノイズ強度",
+        0.0,
+        0.2,
+        DEFAULT_PARAMS["noise_strength"],
+        0.01,
+        help="アナログ感を加える",
+    )
+    params["brightness"] = st.slider(
+        "明るさ", 0.5, 1.5, DEFAULT_PARAMS["brightness"], 0.05
+    )
+    params["contrast"] = st.slider(
+        "コントラスト", 0.5, 1.5, DEFAULT_PARAMS["contrast"], 0.01
     )
-    params["brightness"] = st.slider("明るさ", 0.5, 1.5, 1.0, 0.05)
-    params["contrast"] = st.slider("コントラスト", 0.5, 1.5, 0.98, 0.01)
-    params["saturation"] = st.slider("彩度", 0.0, 2.0, 0.95, 0.05)
+    params["saturation"] = st.slider(
+        "彩度", 0.0, 2.0, DEFAULT_PARAMS["saturation"], 0.05
+    )
+    lut_file = st.file_uploader(
+        "カラー LUT (.cube)",
+        type=["cube"],
+        key="corrector_lut_uploader",
+        help="他のツールやこのページで書き出した 3D LUT を、彩度の後に適用します。",
+    )
+    params["color_lut"] = None
+    if lut_file is not None:
+        try:
+            lut_text = lut_file.getvalue().decode("utf-8")
+            colorlut.parse_cube(lut_text)
+            params["color_lut"] = lut_text
+        except (UnicodeDecodeError, ValueError) as e:
+            st.error(f"LUT を読み込めませんでした: {e}")
     params["sharpness"] = st.slider(
-        "シャープネス", -5.0, 5.0, 0.4, 0.1, help="(-:ぼかし, +:強調)"
+        "シャープネス",
+        -5.0,
+        5.0,
+        DEFAULT_PARAMS["sharpness"],
+        0.1,
+        help="(-:ぼかし, +:強調)",
     )
     params["chromatic_aberration"] = st.slider(
-        "色収差", 0.0, 5.0, 0.4, 0.1, help="レンズ風の色ずれ効果"
+        "色収差",
+        0.0,
+        5.0,
+        DEFAULT_PARAMS["chromatic_aberration"],
+        0.1,
+        help="レンズ風の色ずれ効果",
+    )
+    params["aberration_mode"] = st.radio(
+        "色収差の種類",
+        ["shift", "radial"],
+        index=["shift", "radial"].index(DEFAULT_PARAMS["aberration_mode"]),
+        format_func=lambda mode: {"shift": "水平シフト", "radial": "放射状 (レンズ風)"}[
+            mode
+        ],
+        horizontal=True,
+        help="放射状: 中心から離れるほど色ずれが大きくなる、実際のレンズに近い効果です。",
     )
     params["vignette_strength"] = st.slider(
-        "ビネット効果", 0.0, 0.8, 0.15, 0.05, help="周辺減光効果"
+        "ビネット効果",
+        0.0,
+        0.8,
+        DEFAULT_PARAMS["vignette_strength"],
+        0.05,
+        help="周辺減光効果",
     )
     st.markdown("---")
     params["use_kmeans"] = st.checkbox(
-        "K-Means減色", value=False, help="色数を減らしフラット化"
+        "K-Means減色", value=DEFAULT_PARAMS["use_kmeans"], help="色数を減らしフラット化"
     )
     params["k_value"] = st.slider(
-        "K-Means色数 (k)", 8, 48, 24, 1, disabled=not params["use_kmeans"]
+        "K-Means色数 (k)",
+        8,
+        48,
+        DEFAULT_PARAMS["k_value"],
+        1,
+        disabled=not params["use_kmeans"],
+    )
+    params["kmeans_mode"] = st.radio(
+        "K-Meansモード",
+        ["exact", "fast"],
+        index=["exact", "fast"].index(DEFAULT_PARAMS["kmeans_mode"]),
+        format_func=lambda mode: {"exact": "厳密", "fast": "高速"}[mode],
+        horizontal=True,
+        disabled=not params["use_kmeans"],
+        help="高速: 色ヒストグラムで学習します。大きな画像で数倍〜数十倍速くなります。",
+    )
+    if params["kmeans_mode"] == "fast":
+        kmeans_fn = apply_kmeans_fast
+    else:
+        kmeans_fn = apply_kmeans
+    low_memory = st.checkbox(
+        "省メモリモード",
+        value=False,
+        help="1枚の作業バッファ上で処理し、大きな画像でのメモリ使用量を抑えます。結果は通常モードと同じです。",
     )
+    seed = st.number_input(
+        "乱数シード",
+        min_value=0,
+        value=None,
+        step=1,
+        help="指定するとノイズが再現可能になり、CLI (imageforge.batch) と同じ結果になります。空欄なら画像ごとにランダム。",
+    )
+    run_seed = st.session_state.corrector_noise_seed if seed is None else int(seed)
     st.markdown("---")
 
+    live_preview = st.checkbox(
+        "ライブプレビュー",
+        value=True,
+        help="スライダーを動かすたびに縮小画像で補正結果を表示します。フル解像度の処理はダウンロード時にだけ行います。",
+    )
     process_button_pressed = st.button(
         "🔄 補正実行",
         key="process_button",
         use_container_width=True,
-        disabled=st.session_state.corrector_original_image_pil is None,
+        disabled=original_pil is None or live_preview,
     )
 
 # --- メインエリア ---
-if st.session_state.corrector_original_image_pil is not None:
+if original_pil is not None:
     # ボタン押下時の処理ロジック
     if process_button_pressed:
         st.session_state.corrector_processing_error = None
         with st.spinner("ナチュラル処理中…🪄"):
             try:
-                fixed_pil = process_image(
-                    st.session_state.corrector_original_image_pil.copy(), params
+                with metrics.record(
+                    "correction",
+                    params=correction.params_for_log(params),
+                    low_memory=low_memory,
+                ) as run:
+                    fixed_pil, st.session_state.corrector_memory_stats = run_job(
+                        render_full_resolution,
+                        st.session_state.corrector_upload_key,
+                        original_pil,
+                        params,
+                        run_seed,
+                        kmeans_fn,
+                        low_memory,
+                        st.session_state.corrector_full_memo,
+                    )
+                st.session_state.corrector_metrics = run.to_dict()
+                artifact_store.put("result", fixed_pil)
+                st.session_state.corrector_result_key = cache.make_key(
+                    st.session_state.corrector_upload_key,
+                    "correction_result",
+                    params=params,
+                    seed=run_seed,
+                    low_memory=low_memory,
                 )
-                buffer = io.BytesIO()
-                fixed_pil.save(buffer, format="PNG")
-                buffer.seek(0)
-                st.session_state.corrector_download_buffer = buffer.getvalue()
-                st.session_state.corrector_last_processed_image_pil = fixed_pil
                 st.session_state.corrector_image_processed = True
             except Exception as e:
                 st.session_state.corrector_processing_error = (
                     f"画像処理中にエラーが発生しました: {e}"
                 )
                 st.session_state.corrector_image_processed = False
-                st.session_state.corrector_download_buffer = None
-                st.session_state.corrector_last_processed_image_pil = None
+                artifact_store.put("result", None)
         # rerunを使わずに直接表示を更新する
 
+    # 表示には縮小・圧縮した画像を使う (フル解像度はダウンロードにだけ使う)
     col1, col2 = st.columns(2)
     with col1:
         st.subheader("🖼️ オリジナル画像")
-        st.image(
-            st.session_state.corrector_original_image_pil, use_container_width=True
+        original_display = cached_display_image(
+            st.session_state.corrector_upload_key,
+            original_pil,
         )
+        displayed_bytes = len(original_display)
+        st.image(original_display, use_container_width=True)
+        if st.session_state.corrector_decode_info:
+            st.caption(ingest.describe(st.session_state.corrector_decode_info))
     with col2:
         st.subheader("✨ 補正後の画像")
-        if st.session_state.corrector_processing_error:
+        if live_preview:
+            proxy = (
+                artifact_store.get("proxy"),
+                st.session_state.corrector_proxy_scale,
+            )
+            try:
+                with metrics.record(
+                    "correction_preview", params=correction.params_for_log(params)
+                ) as run:
+                    preview_display = cached_display_image(
+                        preview_key(
+                            st.session_state.corrector_upload_key,
+                            proxy,
+                            params,
+                            run_seed,
+                        ),
+                        lambda: run_job(
+                            render_preview,
+                            st.session_state.corrector_upload_key,
+                            proxy,
+                            params,
+                            run_seed,
+                            kmeans_fn,
+                            st.session_state.corrector_preview_memo,
+                        ),
+                    )
+                st.session_state.corrector_metrics = run.to_dict()
+                displayed_bytes += len(preview_display)
+                st.image(
+                    preview_display,
+                    caption="👀 プレビュー (縮小画像で処理)",
+                    use_container_width=True,
+                )
+            except Exception as e:
+                st.error(f"プレビューの作成中にエラーが発生しました: {e}")
+        elif st.session_state.corrector_processing_error:
             st.error(st.session_state.corrector_processing_error)
-        elif (
-            st.session_state.corrector_image_processed
-            and st.session_state.corrector_last_processed_image_pil
+        elif st.session_state.corrector_image_processed and artifact_store.has(
+            "result"
         ):
-            st.image(
-                st.session_state.corrector_last_processed_image_pil,
-                caption="🌟 補正結果",
-                use_container_width=True,
+            result_display = cached_display_image(
+                st.session_state.corrector_result_key,
+                lambda: artifact_store.get("result"),
             )
+            displayed_bytes += len(result_display)
+            st.image(result_display, caption="🌟 補正結果", use_container_width=True)
+            memory_stats = st.session_state.corrector_memory_stats
+            if memory_stats:
+                st.caption(
+                    f"省メモリモード: 最大確保量 {memory_stats['peak_bytes'] / 1024 / 1024:.1f}MB"
+                    f" (画像1枚の {memory_stats['peak_ratio']:.1f} 倍)"
+                )
         else:
             st.info("パラメータを調整し、「補正実行」ボタンを押してください。")
+    st.caption(
+        f"📶 表示用の画像: {displayed_bytes / 1024:.0f}KB"
+        " (フル解像度の画像はダウンロード時にだけ作ります)"
+    )
+
+    last_run = st.session_state.corrector_metrics
+    if last_run:
+        with st.expander("⏱️ 処理時間の内訳"):
+            st.write(
+                f"**{'プレビュー' if last_run['tool'] == 'correction_preview' else '補正'}**:"
+                f" {metrics.describe(last_run)}"
+            )
+            if last_run["stages"]:
+                st.table(metrics.stages_table(last_run))
+            else:
+                st.caption("すべてキャッシュから表示しました。")
+
+    if params["use_kmeans"] and params["kmeans_mode"] == "fast":
+        with st.expander("🎯 K-Means 高速モードの精度"):
+            st.write(
+                "元画像に対して高速モードと厳密モードを両方実行し、色差 (CIE76 ΔE) を比較します。"
+                "厳密モードの計算に時間がかかる場合があります。"
+            )
+            if st.button("色差を計算", key="kmeans_compare_button"):
+                original_bgr = cv2.cvtColor(
+                    np.array(original_pil),
+                    cv2.COLOR_RGB2BGR,
+                )
+                with st.spinner("厳密モードと比較中..."):
+                    error = run_job(
+                        compare_kmeans_modes,
+                        st.session_state.corrector_upload_key,
+                        original_bgr,
+                        params["k_value"],
+                    )
+                st.write(
+                    f"**平均ΔE**: {error['mean']:.2f} / **95%点**: {error['p95']:.2f}"
+                    f" / **最大**: {error['max']:.2f}"
+                )
+                st.caption("ΔE が 2 前後以下なら、見た目の差はほとんど分かりません。")
 else:
     st.info("サイドバーから補正したい画像をアップロードしてください。")
 
 # --- ダウンロードボタンをヒントの下に移動 ---
-buffer_data = st.session_state.get("corrector_download_buffer")
-download_data = buffer_data if buffer_data is not None else b""
-can_download = (
-    st.session_state.corrector_image_processed
-    and st.session_state.corrector_download_buffer is not None
+# K-Means減色の結果は k 色なのでパレット PNG で劣化なく保存できる
+# (後段のシャープ・色収差・周辺減光で257色以上になった場合は通常の PNG で保存する)
+output_formats = ["png", "webp", "jpeg"]
+if params["use_kmeans"]:
+    output_formats.insert(0, "png_palette")
+output_format = st.radio(
+    "保存形式",
+    output_formats,
+    format_func=encoding.format_label,
+    horizontal=True,
+    key="corrector_output_format",
+    help=(
+        "エンコードはダウンロードボタンを押したときにだけ行います。"
+        "PNG (パレット) は256色以下のとき色を変えずに小さく保存します"
+        " (シャープ・色収差・周辺減光で色が増えた場合は通常の PNG)。"
+    ),
 )
-download_filename = "fixed_image.png"
+if live_preview and original_pil is not None:
+    # フル解像度の補正とエンコードはクリック時にだけ実行する
+    render_args = (
+        st.session_state.corrector_upload_key,
+        original_pil,
+        dict(params),
+        run_seed,
+        kmeans_fn,
+        low_memory,
+        st.session_state.corrector_full_memo,
+    )
+    download_data = functools.partial(render_download, *render_args, output_format)
+    can_download = True
+else:
+    # 補正結果は押されたときに取り出す (退避中でも、押されるまで読み込まない)
+    can_download = st.session_state.corrector_image_processed and artifact_store.has(
+        "result"
+    )
+    download_data = b""
+    if can_download:
+        download_data = functools.partial(
+            encode_stored_result, artifact_store, output_format
+        )
+ext = encoding.OUTPUT_FORMATS[output_format]["ext"]
+download_filename = f"fixed_image.{ext}"
 uploaded_filename_state = st.session_state.get("corrector_uploaded_filename")
 if uploaded_filename_state:
     base_name, _ = os.path.splitext(uploaded_filename_state)
-    download_filename = f"fixed_{base_name}.png"
+    download_filename = f"fixed_{base_name}.{ext}"
 st.download_button(
     label="💾 画像をダウンロード",
     data=download_data,
     file_name=download_filename,
-    mime="image/png",
+    mime=encoding.OUTPUT_FORMATS[output_format]["mime"],
     key="download_button",
     disabled=not can_download,
     use_container_width=True,
     help=(
-        "補正後の画像をPNG形式でダウンロードします。"
+        f"補正後の画像を{encoding.format_label(output_format)}でダウンロードします。"
         if can_download
         else "補正を実行するとダウンロード可能になります。"
     ),
 )
+if can_download:
+    with st.expander("📦 保存形式ごとのサイズとエンコード時間"):
+        st.caption(
+            "フル解像度の補正結果を各形式でエンコードして比較します"
+            "(ライブプレビュー中は先にフル解像度の補正を行います)。"
+        )
+        if st.button("計測する", key="corrector_measure_encodings"):
+            with st.spinner("エンコード中..."):
+                if live_preview:
+                    fixed_pil, _ = run_job(render_full_resolution, *render_args)
+                else:
+                    fixed_pil = artifact_store.get("result")
+                results = run_job(encoding.measure_encodings, fixed_pil, output_formats)
+            st.table(encoding.encodings_table(results))
+
+if original_pil is not None:
+    with st.expander("🎨 色の調整を LUT (.cube) で書き出す"):
+        st.caption(
+            "明るさ・コントラスト・彩度 (と取り込んだ LUT) を1つの 3D LUT にまとめて保存します。"
+            "他のツールや、ほかの画像の補正 (「カラー LUT」・`imageforge.batch --lut`) で"
+            "同じ色味を再現できます。コントラストの基準の明るさは、この画像の平均で固定されます。"
+            "このページで取り込むときは、明るさ・コントラスト・彩度を 1.0 に戻してください。"
+        )
+        lut_name = "imageforge"
+        if uploaded_filename_state:
+            lut_name = os.path.splitext(uploaded_filename_state)[0]
+        st.download_button(
+            label="💾 LUT をダウンロード",
+            data=functools.partial(render_cube, original_pil, params),
+            file_name=f"{lut_name}.cube",
+            mime="text/plain",
+            key="corrector_lut_download",
+        )
 
 
 with st.expander("💡 調整のヒントを見る"):
@@ -295,9 +647,12 @@ with st.expander("💡 調整のヒントを見る"):
         """
     - **ノイズ強度:** アナログ感を加え、均一さを崩します。
     - **明るさ/コントラスト/彩度:** 全体の色味や雰囲気を調整します。AI絵は彩度高めが多いので少し下げると自然かも。
+    - **カラー LUT:** 他のツールで作った色味 (.cube) をそのまま適用できます。
     - **シャープネス:** +でディテール強調、-でソフトに。滑らかすぎる場合に+が有効。
     - **色収差:** 微妙な色ずれでデジタル感を薄めます。
     - **ビネット:** 周辺減光で中央に視線を集めます。
     - **K-Means:** 色数を減らしフラット化。グラデーションは失われやすいです。
     """
     )
+
+startup.end_page(__file__)
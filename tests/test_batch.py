@@ -0,0 +1,53 @@
+# tests/test_batch.py
+"""imageforge.batch の出力がページの process_image() と同じであることの確認"""
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from imageforge import batch
+from imageforge.correction import DEFAULT_PARAMS, process_image
+
+SAMPLE_IMAGE_PATH = os.path.join(
+    os.path.dirname(__file__), os.pardir, "assets", "sample.png"
+)
+SEED = 42
+
+
+@pytest.mark.parametrize("low_memory", [False, True])
+def test_process_file_matches_process_image(tmp_path, low_memory):
+    dst_path = str(tmp_path / "out.png")
+    batch.process_file(
+        SAMPLE_IMAGE_PATH, dst_path, dict(DEFAULT_PARAMS), SEED, low_memory
+    )
+    with Image.open(SAMPLE_IMAGE_PATH) as img:
+        expected = process_image(img.convert("RGB"), dict(DEFAULT_PARAMS), seed=SEED)
+    with Image.open(dst_path) as out:
+        assert np.array_equal(np.asarray(out), np.asarray(expected))
+
+
+def test_run_batch_rejects_output_collisions(tmp_path):
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    for name in ("a.png", "a.jpg"):
+        (input_dir / name).write_bytes(b"")
+    with pytest.raises(ValueError, match="a.png"):
+        batch.run_batch(str(input_dir), str(tmp_path / "out"), dict(DEFAULT_PARAMS))
+    assert not (tmp_path / "out").exists()
+
+
+def test_run_batch_redoes_replaced_source(tmp_path):
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    output_dir = str(tmp_path / "out")
+    Image.new("RGB", (32, 24), (200, 40, 40)).save(input_dir / "a.png")
+    params = dict(DEFAULT_PARAMS)
+
+    def run():
+        return batch.run_batch(str(input_dir), output_dir, params, SEED, workers=1)
+
+    assert run() == (1, 0, 0)
+    assert run() == (0, 0, 1)  # 変わっていなければスキップ
+    Image.new("RGB", (40, 30), (40, 200, 40)).save(input_dir / "a.png")
+    assert run() == (1, 0, 0)